@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+# Virtual meter, that sums several Shelly channels into one D-Bus service, for grid connections
+# that are measured by more than one clamp (split feeds, a Pro 3EM plus an EM50, ...).
+#
+# Every input has its own topics, phase and compiled mapping, which stores the values of a
+# payload in its own namespace. The sums of all inputs and of each phase are updated
+# incrementally: a new value of an input only replaces its old contribution, the other inputs
+# are never summed again.
+#
+#   power, current, forward, reverse    summed
+#   apparent                            summed, the reactive power from the values of each input
+#   voltage, frequency                  average of the inputs, that send it
+#   pf                                  only available, if one input measures the phase
+#
+# The inputs are configured in [INPUT:<name>] sections of the config.ini, see the
+# config.sample.ini. The virtual meter is stale, as long as one input did not send values for
+# stale_timeout seconds, then all values are published as not available.
+
+import logging
+import math
+import threading
+from time import monotonic
+
+from mapping import compile_mapping, read_mapping
+
+NAMES = ("power", "current", "voltage", "frequency", "pf", "forward", "reverse", "apparent")
+
+# variables of the namespace of an input, that the compiled mapping writes
+KEYS = tuple("grid_" + name for name in NAMES)
+
+AVERAGED = ("voltage", "frequency")
+
+ENERGY = ("forward", "reverse")
+
+_POWER = NAMES.index("power")
+_APPARENT = NAMES.index("apparent")
+
+# the sums are calculated again from the values of the inputs after this many updates, so the
+# rounding errors of the incremental updates do not pile up
+RESUM_INTERVAL = 1000
+
+
+class _Sum:
+    __slots__ = ("value", "missing", "inputs")
+
+    def __init__(self):
+        self.value = 0.0
+        self.missing = 0  # inputs without this value
+        self.inputs = 0
+
+    def replace(self, old, new):
+        if old is None:
+            self.missing -= 1
+        else:
+            self.value -= old
+        if new is None:
+            self.missing += 1
+        else:
+            self.value += new
+
+
+class AggregateInput:
+    __slots__ = (
+        "name",
+        "topic_instant",
+        "topic_energy",
+        "phase",
+        "mapping",
+        "namespace",
+        "values",
+        "sums",
+        "updated",
+    )
+
+    def __init__(self, name, topic_instant, topic_energy, phase, mapping, constants):
+        self.name = name
+        self.topic_instant = topic_instant
+        self.topic_energy = topic_energy
+        self.phase = phase
+        # the compiled mapping stores the values in the "grid_*" variables of the namespace
+        self.namespace = dict.fromkeys(KEYS)
+        self.mapping = compile_mapping(dict(mapping), self.namespace, constants=constants)
+        # the values already contained in the sums
+        self.values = (None,) * len(NAMES)
+        # per value: the sum of all inputs and the sum of the phase
+        self.sums = ()
+        self.updated = None  # monotonic time of the last payload
+
+
+# reads the [INPUT:<name>] sections into tuples (name, topic_instant, topic_energy, phase,
+# mapping items), which can be compared to detect changes on reload
+def read_inputs(config, constants):
+    base = read_mapping(config)
+    inputs = []
+    for section in config.sections():
+        if not section.startswith("INPUT:"):
+            continue
+        name = section.partition(":")[2]
+        input_config = config[section]
+        if "topic_instant" not in input_config:
+            raise ValueError('The [%s] has no "topic_instant"' % section)
+        phase = int(input_config.get("phase", "1"))
+        if phase not in (1, 2, 3):
+            raise ValueError('The "phase" of [%s] has to be 1, 2 or 3' % section)
+
+        # mapping lines of the input section override the [MAPPING] section
+        overrides = {
+            path: text
+            for path, text in config.items(section, raw=True)
+            if path.startswith("/")
+        }
+        mapping = {path: overrides.pop(path.lower(), text) for path, text in base.items()}
+        mapping.update(overrides)
+        # compiled once here, so an invalid mapping is reported like any other invalid setting
+        compile_mapping(mapping, {}, constants=constants)
+
+        inputs.append(
+            (
+                name,
+                input_config["topic_instant"],
+                input_config.get("topic_energy", ""),
+                phase,
+                tuple(sorted(mapping.items())),
+            )
+        )
+
+    if not inputs:
+        raise ValueError(
+            'The "source = aggregate" needs at least one [INPUT:<name>] section in the "config.ini"'
+        )
+    return tuple(inputs)
+
+
+class AggregateMeter:
+    def __init__(self, inputs, constants, alignment=0.0, stale_timeout=10.0):
+        self.inputs = [
+            AggregateInput(name, topic_instant, topic_energy, phase, mapping, constants)
+            for name, topic_instant, topic_energy, phase, mapping in inputs
+        ]
+        # 0 = the sums are published after every payload, else after all inputs sent a payload,
+        # but at the latest alignment seconds after the first one
+        self.alignment = alignment
+        self.stale_timeout = stale_timeout
+        self.stale = True
+        self.updates = 0
+
+        # topic -> ((input, role), ...), one topic can be used by several inputs, e.g. the
+        # phases of a Pro 3EM
+        routes = {}
+        for meter_input in self.inputs:
+            routes.setdefault(meter_input.topic_instant, []).append((meter_input, "instant"))
+            if meter_input.topic_energy:
+                routes.setdefault(meter_input.topic_energy, []).append(
+                    (meter_input, "energy")
+                )
+        self.routes = {topic: tuple(targets) for topic, targets in routes.items()}
+
+        # (phase, name) -> _Sum, phase 0 is the sum of all inputs
+        self._sums = {(phase, name): _Sum() for phase in range(4) for name in NAMES}
+        for meter_input in self.inputs:
+            sums = []
+            for name in NAMES:
+                if name in ENERGY and not meter_input.topic_energy:
+                    # an input without energy payloads is not part of the energy sums
+                    sums.append((_Sum(), _Sum()))
+                    continue
+                sums.append((self._sums[(0, name)], self._sums[(meter_input.phase, name)]))
+                for value_sum in sums[-1]:
+                    value_sum.inputs += 1
+                    value_sum.missing += 1
+            meter_input.sums = tuple(sums)
+
+        self._pending = set()
+        self._window_start = None
+        self._lock = threading.Lock()
+
+    @property
+    def phases(self):
+        return sorted({meter_input.phase for meter_input in self.inputs})
+
+    # called after the mapping of the input stored the values of a payload. Returns True, if
+    # the sums should be published now
+    def update(self, meter_input):
+        namespace = meter_input.namespace
+        new = tuple(namespace[key] for key in KEYS)
+        with self._lock:
+            old = meter_input.values
+            if old != new:
+                for old_value, new_value, (total, phase) in zip(old, new, meter_input.sums):
+                    if old_value != new_value:
+                        total.replace(old_value, new_value)
+                        phase.replace(old_value, new_value)
+                meter_input.values = new
+
+            now = monotonic()
+            meter_input.updated = now
+            self._pending.add(meter_input)
+            if self.alignment > 0 and len(self._pending) < len(self.inputs):
+                if self._window_start is None:
+                    self._window_start = now
+                    return False
+                if now - self._window_start < self.alignment:
+                    return False
+            self._emit(now)
+            return True
+
+    # called regularly: publishes the sums of an expired alignment window and detects stale
+    # inputs, that do not send anymore. Returns True, if the sums should be published now
+    def check(self):
+        with self._lock:
+            now = monotonic()
+            stale = self.stale
+            if self._window_start is not None and now - self._window_start >= self.alignment:
+                self._emit(now)
+                return True
+            self._check_stale(now)
+            return self.stale != stale
+
+    def _emit(self, now):
+        self._pending.clear()
+        self._window_start = None
+        self.updates += 1
+        if self.updates % RESUM_INTERVAL == 0:
+            self._resum()
+        self._check_stale(now)
+
+    def _check_stale(self, now):
+        stale = [
+            meter_input.name
+            for meter_input in self.inputs
+            if meter_input.updated is None
+            or (self.stale_timeout > 0 and now - meter_input.updated > self.stale_timeout)
+        ]
+        if bool(stale) != self.stale:
+            self.stale = bool(stale)
+            if stale:
+                logging.warning(
+                    "Aggregate: Stale, since no values were received from: " + ", ".join(stale)
+                )
+            elif not stale:
+                logging.info("Aggregate: Values of all inputs received")
+
+    def _resum(self):
+        for (phase, name), value_sum in self._sums.items():
+            index = NAMES.index(name)
+            values = [
+                meter_input.values[index]
+                for meter_input in self.inputs
+                if (phase == 0 or meter_input.phase == phase)
+                and (name not in ENERGY or meter_input.topic_energy)
+            ]
+            value_sum.missing = values.count(None)
+            value_sum.value = math.fsum(value for value in values if value is not None)
+
+    # value of a phase (1 to 3) or of all inputs (0), None if not available or stale
+    def value(self, phase, name):
+        value_sum = self._sums[(phase, name)]
+        if self.stale or value_sum.inputs == 0:
+            return None
+        if name in AVERAGED:
+            available = value_sum.inputs - value_sum.missing
+            return value_sum.value / available if available else None
+        if value_sum.missing:
+            return None
+        if name == "pf":
+            return value_sum.value if value_sum.inputs == 1 else None
+        return value_sum.value
+
+    # reactive power of a phase (1 to 3) or of all inputs (0), None if not available or stale.
+    # Summed from the reactive power of each input: from the summed apparent and active power,
+    # an input exporting while another one imports would show up as reactive power
+    def reactive(self, phase):
+        if self.stale:
+            return None
+        total = 0.0
+        for meter_input in self.inputs:
+            if phase != 0 and meter_input.phase != phase:
+                continue
+            values = meter_input.values
+            power, apparent = values[_POWER], values[_APPARENT]
+            if power is None or apparent is None:
+                return None
+            total += math.sqrt(max(apparent * apparent - power * power, 0.0))
+        return total
+
+    def state(self):
+        now = monotonic()
+        return {
+            "stale": self.stale,
+            "updates": self.updates,
+            "inputs": {
+                meter_input.name: {
+                    "phase": meter_input.phase,
+                    "seconds_since_update": (
+                        round(now - meter_input.updated, 1)
+                        if meter_input.updated is not None
+                        else None
+                    ),
+                    "values": dict(zip(NAMES, meter_input.values)),
+                }
+                for meter_input in self.inputs
+            },
+        }
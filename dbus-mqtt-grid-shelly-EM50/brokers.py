@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# The MQTT brokers of the broker_address list and the selection between them, used by the driver
+# and the gateway.py. All brokers are probed with a plain TCP connect, the client is connected to
+# the best one that answers and fails over to another one, when its broker is lost. The TLS and
+# login settings of the [MQTT] section are applied to the client the same way by both.
+
+import logging
+import socket
+import threading
+from time import monotonic
+
+
+# "host1, host2:1884, [fd00::1]:1884" -> (("host1", 1883), ("host2", 1884), ("fd00::1", 1884)),
+# the port defaults to broker_port. An IPv6 address needs brackets to be followed by a port
+def parse_brokers(broker_address, broker_port):
+    brokers = []
+    for entry in broker_address.split(","):
+        entry = entry.strip()
+        if entry == "":
+            continue
+        if entry.startswith("["):
+            host, _, port = entry[1:].partition("]")
+            brokers.append((host, int(port[1:]) if port.startswith(":") else broker_port))
+        elif entry.count(":") == 1:
+            host, _, port = entry.partition(":")
+            brokers.append((host, int(port)))
+        else:
+            # a host name, an IPv4 address or an IPv6 address without brackets
+            brokers.append((entry, broker_port))
+    if not brokers:
+        raise ValueError('The "broker_address" in the "config.ini" is empty.')
+    return tuple(brokers)
+
+
+# applies the TLS and login settings of the [MQTT] section to a paho client
+def configure_client(client, tls_enabled, tls_path_to_ca, tls_insecure, username, password):
+    if tls_enabled:
+        logging.info("MQTT client: TLS is enabled")
+
+        if tls_path_to_ca != "":
+            logging.info('MQTT client: TLS: custom ca "%s" used' % tls_path_to_ca)
+            client.tls_set(tls_path_to_ca, tls_version=2)
+        else:
+            client.tls_set(tls_version=2)
+
+        if tls_insecure:
+            logging.info("MQTT client: TLS certificate server hostname verification disabled")
+            client.tls_insecure_set(True)
+
+    # check if username and password are set
+    if username != "" and password != "":
+        logging.info('MQTT client: Using username "%s" and password to connect' % username)
+        client.username_pw_set(username=username, password=password)
+
+
+# the arguments of configure_client() from the [MQTT] section of a config.ini
+def client_settings(mqtt_config):
+    return (
+        mqtt_config.get("tls_enabled", "0") == "1",
+        mqtt_config.get("tls_path_to_ca", ""),
+        mqtt_config.get("tls_insecure", "") not in ("", "0"),
+        mqtt_config.get("username", ""),
+        mqtt_config.get("password", ""),
+    )
+
+
+class Broker:
+    """One MQTT broker of the broker_address list, with its own connection counters."""
+
+    __slots__ = (
+        "host",
+        "port",
+        "connect_latency",
+        "connects",
+        "failures",
+        "uptime",
+        "connected_since",
+    )
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.connect_latency = None  # seconds until the last successful TCP connect
+        self.connects = 0
+        self.failures = 0
+        self.uptime = 0.0  # seconds connected, without the current connection
+        self.connected_since = None
+
+    def __str__(self):
+        if ":" in self.host:
+            return f"[{self.host}]:{self.port}"
+        return f"{self.host}:{self.port}"
+
+    def get_uptime(self):
+        if self.connected_since is None:
+            return self.uptime
+        return self.uptime + monotonic() - self.connected_since
+
+
+class BrokerPool:
+    """Selects the broker to connect to and switches to another one on failures.
+
+    All brokers are probed at the same time with a plain TCP connect. With broker_selection
+    "ordered" the first broker of the list that answers is used and the driver switches back
+    to the first broker as soon as it answers again, with "fastest" the broker that answered
+    first is used until it fails."""
+
+    def __init__(self, brokers, selection="ordered", connect_timeout=5.0):
+        self.brokers = [Broker(host, port) for host, port in brokers]
+        self.selection = selection
+        self.connect_timeout = connect_timeout
+        self.current = None
+        # GLibMqttLoop of the client, if it runs in the GLib main loop (mqtt_loop = glib)
+        self.glib_loop = None
+        self._fallback_running = False
+
+    def probe(self, brokers, timeout):
+        # returns the brokers that accepted a TCP connection within the timeout, fastest first
+        import selectors
+
+        selector = selectors.DefaultSelector()
+        start = monotonic()
+        answered = []
+        for broker in brokers:
+            try:
+                family, socktype, proto, _, address = socket.getaddrinfo(
+                    broker.host, broker.port, type=socket.SOCK_STREAM
+                )[0]
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(False)
+                sock.connect_ex(address)
+                selector.register(sock, selectors.EVENT_WRITE, broker)
+            except OSError as err:
+                logging.debug(f"MQTT client: Broker {broker} can not be probed: {err}")
+                broker.failures += 1
+
+        while selector.get_map():
+            remaining = timeout - (monotonic() - start)
+            events = selector.select(remaining) if remaining > 0 else []
+            if not events:
+                break
+            for key, _ in events:
+                sock, broker = key.fileobj, key.data
+                selector.unregister(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    broker.connect_latency = monotonic() - start
+                    answered.append(broker)
+                else:
+                    broker.failures += 1
+                sock.close()
+
+        for key in list(selector.get_map().values()):
+            key.data.failures += 1
+            key.fileobj.close()
+        selector.close()
+        return answered
+
+    def candidates(self):
+        answered = self.probe(self.brokers, self.connect_timeout)
+        if self.selection == "ordered":
+            answered.sort(key=self.brokers.index)
+        for broker in answered:
+            logging.debug(
+                "MQTT client: Broker %s answered after %.1f ms"
+                % (broker, broker.connect_latency * 1000)
+            )
+        return answered
+
+    # connects the client to the best broker that answers, raises if none can be connected
+    def connect(self, client):
+        answered = self.candidates()
+        error = None
+        # if no broker answered the probe, try them all anyway to get a proper error
+        for broker in answered or self.brokers:
+            logging.info(
+                f"MQTT client: Connecting to broker {broker.host} on port {broker.port}"
+            )
+            try:
+                client.connect(host=broker.host, port=broker.port)
+                self.current = broker
+                return broker
+            except Exception as err:
+                logging.error(f"MQTT client: Connecting to broker {broker} failed: {err}")
+                broker.failures += 1
+                error = err
+        raise error
+
+    # called from the paho thread: points the automatic reconnect of paho to the best broker that answers.
+    # With mqtt_loop = glib the GLibMqttLoop calls connect() in its connect thread instead
+    def failover(self, client):
+        answered = self.candidates()
+        if answered:
+            broker = answered[0]
+        else:
+            # nobody answers, try the next one of the list with the next reconnect
+            index = self.brokers.index(self.current) if self.current is not None else -1
+            broker = self.brokers[(index + 1) % len(self.brokers)]
+        if broker is not self.current:
+            logging.warning(f"MQTT client: Failing over from broker {self.current} to {broker}")
+        self.current = broker
+        client.connect_async(host=broker.host, port=broker.port)
+
+    # called regularly, e.g. by a GLib timer: switches back to the preferred broker as soon as it answers again.
+    # The probe can take up to broker_connect_timeout, so it runs in its own thread.
+    def fallback(self, client):
+        if (
+            self.selection == "ordered"
+            and self.current is not self.brokers[0]
+            and client.is_connected()
+            and not self._fallback_running
+        ):
+            self._fallback_running = True
+            threading.Thread(target=self._fallback, args=(client,), daemon=True).start()
+        return True
+
+    def _fallback(self, client):
+        try:
+            if self.probe([self.brokers[0]], self.connect_timeout):
+                if self.glib_loop is not None:
+                    from gi.repository import GLib  # pyright: ignore[reportMissingImports]
+
+                    # the client is only used from the main loop, which connects in its connect thread
+                    GLib.idle_add(self.glib_loop.reconnect, self._switch_to_preferred)
+                else:
+                    self._switch_to_preferred(client)
+        finally:
+            self._fallback_running = False
+
+    # with mqtt_loop = glib called in the connect thread of the GLibMqttLoop, which stopped
+    # watching the connection
+    def _switch_to_preferred(self, client):
+        preferred = self.brokers[0]
+        logging.warning(
+            f"MQTT client: Preferred broker {preferred} is back, switching over from {self.current}"
+        )
+        if self.glib_loop is None:
+            client.loop_stop()
+        self.disconnected()
+        try:
+            client.connect(host=preferred.host, port=preferred.port)
+            self.current = preferred
+        except Exception as err:
+            logging.error(f"MQTT client: Switching to broker {preferred} failed: {err}")
+            if self.glib_loop is not None:
+                # the GLibMqttLoop reconnects with connect()
+                raise
+            client.connect_async(host=self.current.host, port=self.current.port)
+        if self.glib_loop is None:
+            client.loop_start()
+
+    def connected(self):
+        if self.current is not None:
+            self.current.connects += 1
+            self.current.connected_since = monotonic()
+
+    def disconnected(self):
+        if self.current is not None and self.current.connected_since is not None:
+            self.current.uptime += monotonic() - self.current.connected_since
+            self.current.connected_since = None
+
+    def stats(self):
+        return {
+            str(broker): {
+                "connect_latency_ms": (
+                    round(broker.connect_latency * 1000, 1)
+                    if broker.connect_latency is not None
+                    else None
+                ),
+                "connects": broker.connects,
+                "failures": broker.failures,
+                "uptime": round(broker.get_uptime()),
+                "current": broker is self.current,
+            }
+            for broker in self.brokers
+        }
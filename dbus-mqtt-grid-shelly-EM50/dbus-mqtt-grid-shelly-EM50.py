@@ -2,51 +2,196 @@
 
 from gi.repository import GLib  # pyright: ignore[reportMissingImports]
 import platform
+import atexit
+import signal
 import logging
 import sys
 import os
-from time import sleep, time
+from time import sleep, time, monotonic
+from datetime import date, datetime, timedelta
 import json
+import math
 import paho.mqtt.client as mqtt
 import configparser  # for config/ini file
+from typing import NamedTuple
+from types import SimpleNamespace
 import _thread
+import threading
 
-# import Victron Energy packages
+# Victron Energy packages, vedbus is imported by the D-Bus sink
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext", "velib_python"))
-from vedbus import VeDbusService
 
-
-# get values from config.ini file
-try:
-    config_file = (os.path.dirname(os.path.realpath(__file__))) + "/config.ini"
-    if os.path.exists(config_file):
-        config = configparser.ConfigParser()
-        config.read(config_file)
-        if config["MQTT"]["broker_address"] == "IP_ADDR_OR_FQDN":
-            print(
-                'ERROR:The "config.ini" is using invalid default values like IP_ADDR_OR_FQDN. The driver restarts in 60 seconds.'
+# the modules of the optional features are imported when they are enabled, to save memory
+from brokers import BrokerPool, configure_client, parse_brokers
+from mapping import CompiledMapping, compile_mapping, read_mapping
+
+
+# get values from config.ini file, or from the file given as argument (used by the gateway.py)
+config_file = (
+    sys.argv[1]
+    if len(sys.argv) > 1
+    else (os.path.dirname(os.path.realpath(__file__))) + "/config.ini"
+)
+
+
+class Settings(NamedTuple):
+    """Typed settings compiled once from the config.ini, never changed afterwards.
+    A reload builds a new instance and swaps the module level reference."""
+
+    logging_level: int
+    device_name: str
+    device_type: str
+    device_type_name: str
+    device_instance: int
+    timeout: int
+    voltage: float
+    dbus_autobatch: int
+    dbus_compact: int
+    output: str
+    output_file: str
+    output_flush_interval: float
+    low_memory: bool
+    debug_path: str
+    profile_duration: float
+    profile_interval: float
+    latency: bool
+    latency_window: float
+    latency_report_interval: float
+    config_watch: bool
+    publish_interval_slow: float
+    update_interval_min: float
+    update_interval_max: float
+    source: str
+    http_host: str
+    http_port: int
+    http_interval: float
+    http_timeout: float
+    http_pipelining: bool
+    pipe_fd: int
+    history: bool
+    derived_paths: int
+    derived_file: str
+    recorder_enabled: bool
+    recorder_path: str
+    recorder_size_kb: int
+    recorder_flush_interval: int
+    capture: bool
+    replay_file: str
+    replay_speed: float
+    replay_exit: bool
+    influx_enabled: bool
+    influx_target: str
+    influx_measurement: str
+    influx_flush_interval: float
+    influx_batch_size: int
+    influx_buffer_size: int
+    aggregate_inputs: tuple
+    aggregate_alignment: float
+    aggregate_stale_timeout: float
+    brokers: tuple
+    broker_selection: str
+    broker_fallback_interval: int
+    broker_connect_timeout: float
+    tls_enabled: bool
+    tls_path_to_ca: str
+    tls_insecure: bool
+    username: str
+    password: str
+    topic_energy: str
+    topic_instant: str
+    mode: str
+    topic_events: str
+    channel: int
+    rpc_topic: str
+    rpc_src: str
+    rpc_on_connect: bool
+    rpc_poll_interval: float
+    mqtt_loop: str
+    republish_enabled: bool
+    republish_topic: str
+    republish_qos: int
+    republish_retain: bool
+    republish_interval: float
+    republish_max_interval: float
+    republish_deadbands: dict
+    republish_stale_after: float
+    mapping: CompiledMapping
+
+
+# settings that can only be applied by restarting the driver, since they are used to
+# register on D-Bus or to set up the MQTT connection
+settings_restart_required = (
+    "device_name",
+    "device_type",
+    "device_instance",
+    "dbus_autobatch",
+    "dbus_compact",
+    "output",
+    "output_file",
+    "low_memory",
+    "latency",
+    "config_watch",
+    "source",
+    "http_host",
+    "http_port",
+    "http_pipelining",
+    "pipe_fd",
+    "history",
+    "derived_paths",
+    "derived_file",
+    "recorder_enabled",
+    "recorder_path",
+    "recorder_size_kb",
+    "recorder_flush_interval",
+    "capture",
+    "replay_file",
+    "replay_speed",
+    "replay_exit",
+    "influx_enabled",
+    "influx_target",
+    "influx_measurement",
+    "influx_flush_interval",
+    "influx_batch_size",
+    "influx_buffer_size",
+    "aggregate_inputs",
+    "rpc_poll_interval",
+    "mqtt_loop",
+    "republish_enabled",
+    "republish_interval",
+    "brokers",
+    "broker_selection",
+    "broker_fallback_interval",
+    "broker_connect_timeout",
+    "tls_enabled",
+    "tls_path_to_ca",
+    "tls_insecure",
+    "username",
+    "password",
+)
+
+
+def read_config(path):
+    if not os.path.exists(path):
+        raise ValueError(
+            'The "'
+            + path
+            + '" is not found. Did you copy or rename the "config.sample.ini" to "config.ini"?'
+        )
+    config = configparser.ConfigParser()
+    config.read(path)
+    source = config["DEFAULT"].get("source", "mqtt")
+    if source in ("replay", "pipe"):
+        pass
+    elif source == "http":
+        if config["HTTP"]["host"] == "IP_ADDR_OR_FQDN":
+            raise ValueError(
+                'The "config.ini" is using invalid default values like IP_ADDR_OR_FQDN.'
             )
-            sleep(60)
-            sys.exit()
-    else:
-        print(
-            'ERROR:The "'
-            + config_file
-            + '" is not found. Did you copy or rename the "config.sample.ini" to "config.ini"? The driver restarts in 60 seconds.'
+    elif config["MQTT"]["broker_address"] == "IP_ADDR_OR_FQDN":
+        raise ValueError(
+            'The "config.ini" is using invalid default values like IP_ADDR_OR_FQDN.'
         )
-        sleep(60)
-        sys.exit()
-
-except Exception:
-    exception_type, exception_object, exception_traceback = sys.exc_info()
-    file = exception_traceback.tb_frame.f_code.co_filename
-    line = exception_traceback.tb_lineno
-    print(
-        f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}"
-    )
-    print("ERROR:The driver restarts in 60 seconds.")
-    sleep(60)
-    sys.exit()
+    return config
 
 
 # Get logging level from config.ini
@@ -54,54 +199,345 @@ except Exception:
 # WARNING = shows ERROR and warnings
 # INFO = shows WARNING and running functions
 # DEBUG = shows INFO and data/values
-if "DEFAULT" in config and "logging" in config["DEFAULT"]:
-    if config["DEFAULT"]["logging"] == "DEBUG":
-        logging.basicConfig(level=logging.DEBUG)
-    elif config["DEFAULT"]["logging"] == "INFO":
-        logging.basicConfig(level=logging.INFO)
-    elif config["DEFAULT"]["logging"] == "ERROR":
-        logging.basicConfig(level=logging.ERROR)
-    else:
-        logging.basicConfig(level=logging.WARNING)
-else:
-    logging.basicConfig(level=logging.WARNING)
+def get_logging_level(config):
+    if "DEFAULT" in config and "logging" in config["DEFAULT"]:
+        if config["DEFAULT"]["logging"] == "DEBUG":
+            return logging.DEBUG
+        elif config["DEFAULT"]["logging"] == "INFO":
+            return logging.INFO
+        elif config["DEFAULT"]["logging"] == "ERROR":
+            return logging.ERROR
+    return logging.WARNING
+
+
+def compile_settings(config):
+    default = config["DEFAULT"]
+    mqtt_config = config["MQTT"]
+    http_config = config["HTTP"] if config.has_section("HTTP") else default
+    recorder_config = config["RECORDER"] if config.has_section("RECORDER") else default
+    replay_config = config["REPLAY"] if config.has_section("REPLAY") else default
+    aggregate_config = config["AGGREGATE"] if config.has_section("AGGREGATE") else default
+    influx_config = config["INFLUX"] if config.has_section("INFLUX") else default
+
+    source = default.get("source", "mqtt")
+    if source not in ("mqtt", "http", "replay", "pipe", "aggregate"):
+        logging.warning(
+            'The "source" in the "config.ini" is not set to an allowed value. Fallback to "mqtt" for now.'
+        )
+        source = "mqtt"
+
+    broker_selection = mqtt_config.get("broker_selection", "ordered")
+    if broker_selection not in ("ordered", "fastest"):
+        logging.warning(
+            'The "broker_selection" in the "config.ini" is not set to an allowed value. Fallback to "ordered" for now.'
+        )
+        broker_selection = "ordered"
 
+    mqtt_loop = mqtt_config.get("mqtt_loop", "thread")
+    if mqtt_loop not in ("thread", "glib"):
+        logging.warning(
+            'The "mqtt_loop" in the "config.ini" is not set to an allowed value. Fallback to "thread" for now.'
+        )
+        mqtt_loop = "thread"
 
-# check device_type
-if "DEFAULT" in config and "device_type" in config["DEFAULT"]:
-    if config["DEFAULT"]["device_type"] == "grid":
-        device_type = "grid"
-        device_type_name = "Grid"
-    elif config["DEFAULT"]["device_type"] == "genset":
-        device_type = "genset"
-        device_type_name = "Genset"
-    elif config["DEFAULT"]["device_type"] == "acload":
-        device_type = "acload"
-        device_type_name = "AC Load"
+    mode = mqtt_config.get("mode", "status")
+    if mode not in ("status", "events"):
+        logging.warning(
+            'The "mode" in the "config.ini" is not set to an allowed value. Fallback to "status" for now.'
+        )
+        mode = "status"
+
+    output = default.get("output", "dbus")
+    if output not in ("dbus", "memory", "jsonl"):
+        logging.warning(
+            'The "output" in the "config.ini" is not set to an allowed value. Fallback to "dbus" for now.'
+        )
+        output = "dbus"
+
+    low_memory = default.get("low_memory", "0") == "1"
+
+    voltage = float(default.get("voltage", "230"))
+
+    republish_config = config["REPUBLISH"] if config.has_section("REPUBLISH") else default
+    republish_enabled = republish_config.get("enabled", "0") == "1"
+    republish_deadbands = {}
+    if republish_enabled:
+        from republish import parse_deadbands
+
+        republish_deadbands = parse_deadbands(republish_config.get("deadband", ""))
+
+    # the inputs of the virtual meter, with their own topics and mapping
+    aggregate_inputs = ()
+    if source == "aggregate":
+        from aggregate import read_inputs
+
+        aggregate_inputs = read_inputs(config, {"voltage": voltage})
+
+    # check device_type
+    if "device_type" in default:
+        if default["device_type"] == "grid":
+            device_type = "grid"
+            device_type_name = "Grid"
+        elif default["device_type"] == "genset":
+            device_type = "genset"
+            device_type_name = "Genset"
+        elif default["device_type"] == "acload":
+            device_type = "acload"
+            device_type_name = "AC Load"
+        else:
+            logging.warning(
+                'The "device_type" in the "config.ini" is not set to an allowed type. Check the config.sample.ini for allowed types. Fallback to "grid" for now.'
+            )
+            device_type = "grid"
+            device_type_name = "Grid"
     else:
         logging.warning(
-            'The "device_type" in the "config.ini" is not set to an allowed type. Check the config.sample.ini for allowed types. Fallback to "grid" for now.'
+            'The "device_type" in the "config.ini" is not set at all. Check the config.sample.ini for allowed types. Fallback to "grid" for now.'
         )
         device_type = "grid"
         device_type_name = "Grid"
-else:
-    logging.warning(
-        'The "device_type" in the "config.ini" is not set at all. Check the config.sample.ini for allowed types. Fallback to "grid" for now.'
+
+    return Settings(
+        logging_level=get_logging_level(config),
+        device_name=default["device_name"],
+        device_type=device_type,
+        device_type_name=device_type_name,
+        device_instance=int(default["device_instance"]),
+        timeout=int(default.get("timeout", "60")),
+        voltage=voltage,
+        # get D-Bus signal batching
+        # 0 = every changed value is sent immediately as PropertiesChanged signal
+        # 1 = all values changed in one main loop iteration are additionally sent as one ItemsChanged signal
+        # 2 = like 1, but without the PropertiesChanged signal per value
+        dbus_autobatch=int(default.get("dbus_autobatch", "0")),
+        # get D-Bus export layout
+        # 0 = one D-Bus object per path and per tree node
+        # 1 = one fallback D-Bus object for the whole service (uses less memory and registers faster)
+        # the low memory profile always uses the compact layout
+        dbus_compact=1 if low_memory else int(default.get("dbus_compact", "0")),
+        output=output,
+        output_file=default.get("output_file", "-"),
+        output_flush_interval=float(default.get("output_flush_interval", "1")),
+        low_memory=low_memory,
+        debug_path=default.get("debug_path", "/data/log/dbus-mqtt-grid-shelly-EM50"),
+        profile_duration=float(default.get("profile_duration", "60")),
+        profile_interval=float(default.get("profile_interval", "0.005")),
+        latency=default.get("latency", "0") == "1",
+        latency_window=float(default.get("latency_window", "600")),
+        latency_report_interval=float(default.get("latency_report_interval", "60")),
+        config_watch=default.get("config_watch", "0") == "1",
+        publish_interval_slow=float(default.get("publish_interval_slow", "5")),
+        update_interval_min=float(default.get("update_interval_min", "1")),
+        update_interval_max=float(default.get("update_interval_max", "10")),
+        source=source,
+        http_host=http_config.get("host", ""),
+        http_port=int(http_config.get("port", "80")),
+        http_interval=float(http_config.get("interval", "1")),
+        http_timeout=float(http_config.get("timeout", "2")),
+        http_pipelining=http_config.get("pipelining", "1") == "1",
+        # set by the gateway.py, 0 = stdin
+        pipe_fd=int(default.get("pipe_fd", "0")),
+        history=default.get("history", "0") == "1",
+        derived_paths=int(default.get("derived_paths", "0")),
+        derived_file=default.get(
+            "derived_file",
+            "/data/dbus-mqtt-grid-shelly-EM50_" + default["device_instance"] + "_daily_energy.json",
+        ),
+        recorder_enabled=recorder_config.get("enabled", "0") == "1",
+        recorder_path=recorder_config.get(
+            "path", "/data/dbus-mqtt-grid-shelly-EM50_samples.bin"
+        ),
+        recorder_size_kb=int(recorder_config.get("size_kb", "1024")),
+        recorder_flush_interval=int(recorder_config.get("flush_interval", "10")),
+        capture=replay_config.get("capture", "0") == "1",
+        replay_file=replay_config.get(
+            "file", "/data/dbus-mqtt-grid-shelly-EM50_capture.jsonl"
+        ),
+        replay_speed=float(replay_config.get("speed", "1")),
+        replay_exit=replay_config.get("exit_at_end", "1") == "1",
+        influx_enabled=influx_config.get("enabled", "0") == "1",
+        influx_target=influx_config.get(
+            "target", "/data/dbus-mqtt-grid-shelly-EM50_values.lp"
+        ),
+        influx_measurement=influx_config.get("measurement", device_type),
+        influx_flush_interval=float(influx_config.get("flush_interval", "10")),
+        influx_batch_size=int(influx_config.get("batch_size", "500")),
+        influx_buffer_size=int(influx_config.get("buffer_size", "10000")),
+        aggregate_inputs=aggregate_inputs,
+        aggregate_alignment=float(aggregate_config.get("alignment", "0")),
+        aggregate_stale_timeout=float(aggregate_config.get("stale_timeout", "10")),
+        brokers=parse_brokers(
+            mqtt_config["broker_address"], int(mqtt_config["broker_port"])
+        ),
+        broker_selection=broker_selection,
+        broker_fallback_interval=int(mqtt_config.get("broker_fallback_interval", "60")),
+        broker_connect_timeout=float(mqtt_config.get("broker_connect_timeout", "5")),
+        tls_enabled=mqtt_config.get("tls_enabled", "0") == "1",
+        tls_path_to_ca=mqtt_config.get("tls_path_to_ca", ""),
+        tls_insecure=mqtt_config.get("tls_insecure", "") not in ("", "0"),
+        username=mqtt_config.get("username", ""),
+        password=mqtt_config.get("password", ""),
+        topic_energy=mqtt_config["topic_energy"],
+        topic_instant=mqtt_config["topic_instant"],
+        mode=mode,
+        topic_events=mqtt_config["topic_instant"].partition("/status/")[0] + "/events/rpc",
+        # "<device id>/status/em1:<channel>"
+        channel=(
+            int(http_config.get("channel", "0"))
+            if source == "http"
+            else int(mqtt_config["topic_instant"].rpartition(":")[2] or 0)
+        ),
+        rpc_topic=mqtt_config["topic_instant"].partition("/status/")[0] + "/rpc",
+        rpc_src="MqttGrid_" + default["device_instance"],
+        rpc_on_connect=mqtt_config.get("rpc_on_connect", "1") == "1",
+        rpc_poll_interval=float(mqtt_config.get("rpc_poll_interval", "0")),
+        mqtt_loop=mqtt_loop,
+        republish_enabled=republish_enabled,
+        republish_topic=republish_config.get(
+            "topic", "dbus-mqtt-grid-shelly-EM50/" + default["device_instance"] + "/values"
+        ),
+        republish_qos=int(republish_config.get("qos", "0")),
+        republish_retain=republish_config.get("retain", "1") == "1",
+        republish_interval=float(republish_config.get("interval", "1")),
+        republish_max_interval=float(republish_config.get("max_interval", "60")),
+        republish_deadbands=republish_deadbands,
+        republish_stale_after=float(republish_config.get("stale_after", "10")),
+        # payload to measured values, compiled into functions that store the grid_* values
+        mapping=compile_mapping(
+            read_mapping(config), globals(), constants={"voltage": voltage}
+        ),
     )
-    device_type = "grid"
-    device_type_name = "Grid"
 
-# get timeout
-if "DEFAULT" in config and "timeout" in config["DEFAULT"]:
-    timeout = int(config["DEFAULT"]["timeout"])
-else:
-    timeout = 60
+
+try:
+    config = read_config(config_file)
+except Exception as err:
+    if isinstance(err, ValueError):
+        print("ERROR:" + str(err) + " The driver restarts in 60 seconds.")
+    else:
+        exception_type, exception_object, exception_traceback = sys.exc_info()
+        file = exception_traceback.tb_frame.f_code.co_filename
+        line = exception_traceback.tb_lineno
+        print(
+            f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}"
+        )
+        print("ERROR:The driver restarts in 60 seconds.")
+    sleep(60)
+    sys.exit()
+
+logging.basicConfig(level=get_logging_level(config))
+
+try:
+    settings = compile_settings(config)
+except ValueError as err:
+    logging.error(str(err) + " The driver restarts in 60 seconds.")
+    sleep(60)
+    sys.exit()
+
+
+# topics with measurements, depending on the mode
+def get_topics(current_settings):
+    if current_settings.source == "aggregate":
+        topics = set()
+        for name, topic_instant, topic_energy, phase, mapping in current_settings.aggregate_inputs:
+            topics.add(topic_instant)
+            if topic_energy:
+                topics.add(topic_energy)
+        return topics
+    if current_settings.mode == "events":
+        return {current_settings.topic_events}
+    return {current_settings.topic_instant, current_settings.topic_energy}
+
+
+# reload the config.ini without restarting the driver, triggered by SIGHUP or a change of the file
+def reload_settings():
+    global settings
+
+    try:
+        new_settings = compile_settings(read_config(config_file))
+    except Exception as err:
+        logging.error(
+            f"Reloading the config.ini failed, the current settings are kept: {repr(err)}"
+        )
+        return
+
+    old_settings = settings
+    settings = new_settings
+    logging.getLogger().setLevel(new_settings.logging_level)
+
+    if aggregate_meter is not None:
+        aggregate_meter.alignment = new_settings.aggregate_alignment
+        aggregate_meter.stale_timeout = new_settings.aggregate_stale_timeout
+
+    if snapshot_republisher is not None:
+        snapshot_republisher.topic = new_settings.republish_topic
+        snapshot_republisher.qos = new_settings.republish_qos
+        snapshot_republisher.retain = new_settings.republish_retain
+        snapshot_republisher.max_interval = new_settings.republish_max_interval
+        snapshot_republisher.set_deadbands(new_settings.republish_deadbands)
+
+    if mqtt_client is not None:
+        old_topics = get_topics(old_settings)
+        new_topics = get_topics(new_settings)
+        for topic in old_topics - new_topics:
+            mqtt_client.unsubscribe(topic)
+        for topic in new_topics - old_topics:
+            mqtt_client.subscribe(topic)
+
+    changed = [
+        name
+        for name in settings_restart_required
+        if getattr(old_settings, name) != getattr(new_settings, name)
+    ]
+    if changed:
+        logging.warning(
+            "Reloaded the config.ini, but these settings only apply after a restart of the driver: "
+            + ", ".join(changed)
+        )
+    else:
+        logging.info("Reloaded the config.ini")
+
+
+def _on_sighup():
+    reload_settings()
+    return True  # keep the signal handler
+
+
+def _on_config_changed(monitor, file, other_file, event_type):
+    from gi.repository import Gio  # pyright: ignore[reportMissingImports]
+
+    if event_type == Gio.FileMonitorEvent.CHANGES_DONE_HINT:
+        reload_settings()
 
 
 # set variables
+mqtt_client = None
+mqtt_glib_loop = None  # GLibMqttLoop, if mqtt_loop = glib
+broker_pool = BrokerPool(
+    settings.brokers, settings.broker_selection, settings.broker_connect_timeout
+)
 connected = 0
+first_data = threading.Event()
 last_changed = 0
-last_updated = 0
+sample_version = 0  # incremented with every received sample
+sample_interval = None  # average seconds between two received samples
+last_sample_time = None
+publisher = None  # DbusMqttGridService, as soon as it is registered on D-Bus
+sample_recorder = None  # SampleRecorder, if enabled in the config.ini
+rollup_engine = None  # RollupEngine, if history is enabled in the config.ini
+derived_values = None  # LazyValues, if derived_paths is enabled in the config.ini
+daily_energy = None  # DailyEnergy, if derived_paths is enabled in the config.ini
+energy_received = False  # the energy counters were received at least once
+payload_capture = None  # PayloadCapture, if capture is enabled in the config.ini
+aggregate_meter = None  # AggregateMeter, if source = aggregate
+latency_monitor = None  # LatencyMonitor, if latency is enabled in the config.ini
+influx_exporter = None  # LineProtocolExporter, if enabled in the config.ini
+snapshot_republisher = None  # SnapshotRepublisher, if enabled in the config.ini
+message_time = None  # time() when the last message was received, if latency is enabled
+message_received = None  # monotonic() when the last message was received, if latency is enabled
+sample_received = None  # monotonic() when the message of the last sample was received
+profiler = None  # SamplingProfiler, after the first SIGUSR1
+config_monitor = None  # Gio.FileMonitor, if config_watch is enabled in the config.ini
 
 grid_power = -1
 grid_current = 0
@@ -110,6 +546,7 @@ grid_forward = 0
 grid_reverse = 0
 grid_frequency = 0
 grid_pf = 0
+grid_apparent = None
 
 # MQTT requests
 def on_disconnect(client, userdata, rc):
@@ -122,109 +559,241 @@ def on_disconnect(client, userdata, rc):
     else:
         logging.warning("MQTT client: rc value:" + str(rc))
 
-    while connected == 0:
-        try:
-            logging.warning("MQTT client: Trying to reconnect")
-            client.connect(config["MQTT"]["broker_address"])
-            connected = 1
-        except Exception as err:
-            logging.error(
-                f"MQTT client: Error in retrying to connect with broker ({config['MQTT']['broker_address']}:{config['MQTT']['broker_port']}): {err}"
-            )
-            logging.error("MQTT client: Retrying in 15 seconds")
-            connected = 0
-            sleep(15)
+    connected = 0
+    broker_pool.disconnected()
+    # with mqtt_loop = glib the broker is chosen in the connect thread of the GLibMqttLoop
+    if mqtt_glib_loop is None:
+        broker_pool.failover(client)
+
+
+def on_connect_fail(client, userdata):
+    logging.error(f"MQTT client: Error in retrying to connect with broker {broker_pool.current}")
+    broker_pool.current.failures += 1
+    broker_pool.failover(client)
 
 
 def on_connect(client, userdata, flags, rc):
     global connected
     if rc == 0:
-        logging.info("MQTT client: Connected to MQTT broker!")
+        logging.info(f"MQTT client: Connected to MQTT broker {broker_pool.current}!")
         connected = 1
-        client.subscribe(config["MQTT"]["topic_instant"])
-        client.subscribe(config["MQTT"]["topic_energy"])
+        broker_pool.connected()
+        for topic in get_topics(settings):
+            client.subscribe(topic)
+        # the inputs of the virtual meter are not requested over RPC
+        if settings.source != "mqtt":
+            return
+        if settings.rpc_on_connect or settings.rpc_poll_interval > 0:
+            client.subscribe(settings.rpc_src + "/rpc")
+        if settings.rpc_on_connect:
+            rpc_get_status(client)
     else:
         logging.error("MQTT client: Failed to connect, return code %d\n", rc)
 
 
+# Shelly RPC over MQTT: requests are published to "<device>/rpc" and the device answers on "<src>/rpc"
+rpc_request_id = 0
+rpc_pending = {}  # request id -> topic role ("instant" or "energy") of the result
+
+
+def rpc_request(client, method, role):
+    global rpc_request_id
+    current_settings = settings
+    rpc_request_id += 1
+    rpc_pending[rpc_request_id] = role
+    # replies that never came must not pile up
+    if len(rpc_pending) > 32:
+        rpc_pending.pop(next(iter(rpc_pending)))
+    client.publish(
+        current_settings.rpc_topic,
+        json.dumps(
+            {
+                "id": rpc_request_id,
+                "src": current_settings.rpc_src,
+                "method": method,
+                "params": {"id": current_settings.channel},
+            }
+        ),
+    )
+
+
+# request the current values instead of waiting for the next status push of the Shelly
+def rpc_get_status(client):
+    rpc_request(client, "EM1.GetStatus", "instant")
+    rpc_request(client, "EM1Data.GetStatus", "energy")
+
+
+def rpc_poll():
+    if connected:
+        rpc_get_status(mqtt_client)
+    return True
+
+
+def handle_energy(jsonpayload, payload):
+    global last_changed, energy_received
+
+    last_changed = int(time())
+
+    if settings.mapping.full["energy"](jsonpayload):
+        energy_received = True
+        logging.debug("MQTT energy grid_forward %s -  " % grid_forward)
+        logging.debug("MQTT energy grid_reverse %s -  " % grid_reverse)
+        logging.debug("MQTT payload: " + str(payload)[1:])
+        notify_sample()
+    else:
+        logging.error(
+            "Received JSON MQTT topic_energy message does not include the values required by the mapping"
+        )
+        logging.debug("MQTT payload: " + str(payload)[1:])
+
+
+# Shelly "<device id>/events/rpc" notification with the changes of one or more components, for example
+# {"method": "NotifyStatus", "params": {"ts": 1720000000.12, "em1:0": {"id": 0, "act_power": 12.3}}}
+def handle_event(jsonpayload, payload):
+    global last_changed, energy_received
+
+    if jsonpayload.get("method") not in ("NotifyStatus", "NotifyFullStatus"):
+        return
+    params = jsonpayload.get("params", {})
+    instant = params.get("em1:%i" % settings.channel)
+    energy = params.get("em1data:%i" % settings.channel)
+    if instant is None and energy is None:
+        return
+
+    # the time of the Shelly, when it sent the notification
+    if latency_monitor is not None and "ts" in params:
+        latency_monitor.device_time(float(params["ts"]), message_time)
+
+    # apply only the values included in the delta and keep all others
+    current_mapping = settings.mapping
+    last_changed = int(time())
+    if instant is not None and current_mapping.partial["instant"](instant):
+        first_data.set()
+    if energy is not None and current_mapping.partial["energy"](energy):
+        energy_received = True
+    notify_sample()
+    logging.debug("MQTT payload: " + str(payload)[1:])
+
+
+def handle_instant(jsonpayload, payload):
+    global last_changed
+
+    last_changed = int(time())
+
+    if settings.mapping.full["instant"](jsonpayload):
+        first_data.set()
+        notify_sample()
+    else:
+        logging.error(
+            "Received JSON MQTT topic_instant message does not include the values required by the mapping"
+        )
+        logging.debug("MQTT payload: " + str(payload)[1:])
+
+
+# payload of one or more inputs of the virtual meter
+def handle_aggregate(targets, jsonpayload, payload):
+    global last_changed
+
+    last_changed = int(time())
+
+    publish = False
+    for meter_input, role in targets:
+        if meter_input.mapping.full[role](jsonpayload):
+            publish = aggregate_meter.update(meter_input) or publish
+        else:
+            logging.error(
+                'Received JSON MQTT message of the input "%s" does not include the values required by the mapping'
+                % meter_input.name
+            )
+            logging.debug("MQTT payload: " + str(payload)[1:])
+    if publish:
+        notify_aggregate()
+
+
+# called when the sums of the virtual meter should be published
+def notify_aggregate():
+    global grid_power, grid_current, grid_voltage, grid_frequency, grid_pf, grid_forward, grid_reverse
+    global grid_apparent
+
+    # the totals are used by the history, the recorder and the debug log
+    grid_power = aggregate_meter.value(0, "power")
+    grid_current = aggregate_meter.value(0, "current")
+    grid_voltage = aggregate_meter.value(0, "voltage")
+    grid_frequency = aggregate_meter.value(0, "frequency")
+    grid_pf = aggregate_meter.value(0, "pf")
+    grid_forward = aggregate_meter.value(0, "forward")
+    grid_reverse = aggregate_meter.value(0, "reverse")
+    grid_apparent = aggregate_meter.value(0, "apparent")
+    if not aggregate_meter.stale:
+        first_data.set()
+    notify_sample()
+
+
+def handle_rpc_response(jsonpayload, payload):
+    role = rpc_pending.pop(jsonpayload.get("id"), None)
+    if role is None:
+        logging.debug("Received RPC response for an unknown request: " + str(payload)[1:])
+    elif "result" not in jsonpayload:
+        logging.warning(
+            "Received RPC error response: %s" % jsonpayload.get("error")
+        )
+    elif role == "energy":
+        handle_energy(jsonpayload["result"], payload)
+    else:
+        handle_instant(jsonpayload["result"], payload)
+
+
 def on_message(client, userdata, msg):
+    global message_time, message_received
+
+    if latency_monitor is not None:
+        message_time = time()
+        message_received = monotonic()
+
     try:
-        global last_changed, grid_power, grid_current, grid_voltage, grid_forward, grid_reverse, \
-            grid_pf, grid_frequency
+        # read the reference only once, a reload may swap it in the meantime
+        current_settings = settings
 
-        # get JSON from topic
-        if msg.topic == config["MQTT"]["topic_energy"]:
-            if msg.payload != "" and msg.payload != b"":
-                jsonpayload = json.loads(msg.payload)
+        if payload_capture is not None:
+            payload_capture.write(msg.topic, msg.payload)
 
-                last_changed = int(time())
+        # get JSON from topic
+        if aggregate_meter is not None:
+            targets = aggregate_meter.routes.get(msg.topic)
+            if targets is None:
+                pass
+            elif msg.payload != "" and msg.payload != b"":
+                handle_aggregate(targets, json.loads(msg.payload), msg.payload)
+            else:
+                logging.warning(
+                    "Received JSON MQTT message of an input was empty and therefore it was ignored"
+                )
 
-                if "total_act_energy" in jsonpayload:
-                    grid_forward = (
-                        float(jsonpayload["total_act_energy"])
-                    )
-                    grid_reverse = (
-                        float(jsonpayload["total_act_ret_energy"])
-                        if "total_act_ret_energy" in jsonpayload
-                        else None
-                    )
-                    logging.debug("MQTT energy grid_forward %s -  " % grid_forward)
-                    logging.debug("MQTT energy grid_reverse %s -  " % grid_reverse)
-                    logging.debug("MQTT payload: " + str(msg.payload)[1:])
-                else:
-                    logging.error(
-                        'Received JSON MQTT topic_energy message does not include expected data: {"total_act_energy": 0}'
-                    )
-                    logging.debug("MQTT payload: " + str(msg.payload)[1:])
+        elif msg.topic == current_settings.topic_energy:
+            if msg.payload != "" and msg.payload != b"":
+                handle_energy(json.loads(msg.payload), msg.payload)
             else:
                 logging.warning(
                     "Received JSON MQTT topic_energy message was empty and therefore it was ignored"
                 )
                 logging.debug("MQTT payload: " + str(msg.payload)[1:])
 
-        elif msg.topic == config["MQTT"]["topic_instant"]:
+        elif msg.topic == current_settings.topic_instant:
             if msg.payload != "" and msg.payload != b"":
-                jsonpayload = json.loads(msg.payload)
-
-                last_changed = int(time())
-
-                if "act_power" in jsonpayload:
-                    grid_power = float(jsonpayload["act_power"])
-                    grid_voltage = (
-                        float(jsonpayload["voltage"])
-                        if "voltage" in jsonpayload
-                        else float(config["DEFAULT"]["voltage"])
-                    )
-                    grid_current = (
-                        float(jsonpayload["current"])
-                        if "current" in jsonpayload
-                        else (
-                            grid_power / grid_voltage
-                            if grid_voltage != 0
-                            else 0
-                        )
-                    )
-                    grid_frequency = (
-                        float(jsonpayload["freq"])
-                        if "freq" in jsonpayload
-                        else None
-                    )
-                    grid_pf = (
-                        float(jsonpayload["pf"])
-                        if "pf" in jsonpayload
-                        else None
-                    )
-                else:
-                    logging.error(
-                        'Received JSON MQTT topic_instant message does not include expected data: {"act_power": 0.0}'
-                    )
-                    logging.debug("MQTT payload: " + str(msg.payload)[1:])
+                handle_instant(json.loads(msg.payload), msg.payload)
             else:
                 logging.warning(
                     "Received JSON MQTT topic_instant message was empty and therefore it was ignored"
                 )
                 logging.debug("MQTT payload: " + str(msg.payload)[1:])
 
+        elif msg.topic == current_settings.topic_events:
+            if msg.payload != "" and msg.payload != b"":
+                handle_event(json.loads(msg.payload), msg.payload)
+
+        elif msg.topic == current_settings.rpc_src + "/rpc":
+            handle_rpc_response(json.loads(msg.payload), msg.payload)
+
     except ValueError as e:
         logging.error("Received message is not a valid JSON. %s" % e)
         logging.debug("MQTT payload: " + str(msg.payload)[1:])
@@ -239,106 +808,287 @@ def on_message(client, userdata, msg):
         logging.debug("MQTT payload: " + str(msg.payload)[1:])
 
 
+# returned by a value getter, if the path keeps its last published value
+KEEP = object()
+
+
+def _rounded(value):
+    return round(value, 2) if value is not None else None
+
+
+def _history_getter(name, column):
+    def getter():
+        if rollup_engine is None:
+            return KEEP
+        value = rollup_engine.last_value(name, column)
+        return None if math.isnan(value) else round(value, 2)
+
+    return getter
+
+
+# D-Bus path -> function returning the value from the last received samples. Built once, so
+# publishing a sample reads the values directly, without collecting them in a dict first
+value_getters = {
+    "/Ac/Power": lambda: _rounded(grid_power),  # positive: consumption, negative: feed into grid
+    "/Ac/L1/Power": lambda: round(grid_power, 2) if grid_current is not None else None,
+    "/Ac/L2/Power": lambda: None,
+    "/Ac/L3/Power": lambda: None,
+    "/Ac/L1/Current": lambda: _rounded(grid_current),
+    "/Ac/L1/Voltage": lambda: _rounded(grid_voltage),
+    "/Ac/L1/Frequency": lambda: _rounded(grid_frequency),
+    "/Ac/L1/PowerFactor": lambda: _rounded(grid_pf),
+    "/Ac/Energy/Forward": lambda: _rounded(grid_forward) if grid_forward is not None else KEEP,
+    "/Ac/L1/Energy/Forward": lambda: _rounded(grid_forward) if grid_forward is not None else KEEP,
+    "/Ac/L2/Energy/Forward": lambda: None if grid_forward is not None else KEEP,
+    "/Ac/L3/Energy/Forward": lambda: None if grid_forward is not None else KEEP,
+    "/Ac/Energy/Reverse": lambda: _rounded(grid_reverse) if grid_reverse is not None else KEEP,
+    "/Ac/L1/Energy/Reverse": lambda: _rounded(grid_reverse) if grid_reverse is not None else KEEP,
+    "/Ac/L2/Energy/Reverse": lambda: None if grid_reverse is not None else KEEP,
+    "/Ac/L3/Energy/Reverse": lambda: None if grid_reverse is not None else KEEP,
+}
+for history_name in ("1m", "15m"):
+    for history_path, history_column in (
+        ("/History/Power/Avg", "avg"),
+        ("/History/Power/Min", "min"),
+        ("/History/Power/Max", "max"),
+        ("/History/Energy/Forward", "forward"),
+        ("/History/Energy/Reverse", "reverse"),
+    ):
+        value_getters[history_path + history_name] = _history_getter(
+            history_name, history_column
+        )
+
+
+def _apparent_power():
+    # "aprt_power" of the Shelly, else from voltage and current
+    if grid_apparent is not None:
+        return round(grid_apparent, 2)
+    # the averaged voltage of the virtual meter times its summed current is not the sum of the
+    # apparent power of its inputs
+    if aggregate_meter is None and grid_voltage is not None and grid_current is not None:
+        return round(abs(grid_voltage * grid_current), 2)
+    return None
+
+
+def _reactive_power():
+    if aggregate_meter is not None:
+        reactive = aggregate_meter.reactive(0)
+        return round(reactive, 2) if reactive is not None else None
+    apparent = derived_values.get("/Ac/ApparentPower")
+    if apparent is None or grid_power is None:
+        return None
+    # the sign is not known from apparent and active power
+    return round(math.sqrt(max(apparent * apparent - grid_power * grid_power, 0.0)), 2)
+
+
+# D-Bus path -> function computing a derived value. Only called when the path is read, see
+# derived.py, so receiving a sample does not compute them
+derived_getters = {
+    "/Ac/ApparentPower": _apparent_power,
+    "/Ac/ReactivePower": _reactive_power,
+    "/Ac/Energy/ForwardToday": lambda: daily_energy.today(0, grid_forward),
+    "/Ac/Energy/ReverseToday": lambda: daily_energy.today(1, grid_reverse),
+    "/Ac/Energy/ForwardYesterday": lambda: daily_energy.yesterday[0],
+    "/Ac/Energy/ReverseYesterday": lambda: daily_energy.yesterday[1],
+}
+
+
+# called after the values of a new sample are stored
+def notify_sample():
+    global sample_version, sample_interval, last_sample_time, sample_received
+    sample_version += 1
+
+    # moving average of the seconds between two samples
+    now = monotonic()
+    if latency_monitor is not None:
+        # HTTP polls are not received by on_message
+        sample_received = message_received if message_received is not None else now
+    if last_sample_time is not None:
+        interval = now - last_sample_time
+        if sample_interval is None:
+            sample_interval = interval
+        else:
+            sample_interval += 0.2 * (interval - sample_interval)
+    last_sample_time = now
+
+    if rollup_engine is not None:
+        rollup_engine.add(time(), grid_power, grid_forward, grid_reverse)
+
+    if sample_recorder is not None:
+        sample_recorder.append(
+            time(),
+            grid_power,
+            grid_current,
+            grid_voltage,
+            grid_frequency,
+            grid_pf,
+            grid_forward,
+            grid_reverse,
+        )
+
+    if publisher is not None:
+        publisher.schedule_fast()
+
+
 class DbusMqttGridService:
     def __init__(
         self,
-        servicename,
+        sink,
         deviceinstance,
         paths,
-        productname="MQTT " + device_type_name,
-        customname="MQTT " + device_type_name,
-        connection="MQTT " + device_type_name + " service",
+        productname="MQTT " + settings.device_type_name,
+        customname="MQTT " + settings.device_type_name,
+        connection="MQTT " + settings.device_type_name + " service",
     ):
-        self._dbusservice = VeDbusService(servicename)
+        # DbusSink, MemorySink or JsonLinesSink, see sinks.py
+        self._sink = sink
         self._paths = paths
+        # derived path -> last sent value, with derived_paths = 2
+        self._pushed_derived = {
+            path: None
+            for path, path_settings in paths.items()
+            if path_settings.get("derived") and settings.derived_paths == 2
+        }
 
-        logging.debug("%s /DeviceInstance = %d" % (servicename, deviceinstance))
+        logging.debug("/DeviceInstance = %d" % deviceinstance)
 
         # Create the management objects, as specified in the ccgx dbus-api document
-        self._dbusservice.add_path("/Mgmt/ProcessName", __file__)
-        self._dbusservice.add_path(
+        self._sink.add_path("/Mgmt/ProcessName", __file__)
+        self._sink.add_path(
             "/Mgmt/ProcessVersion",
             "Unkown version, and running on Python " + platform.python_version(),
         )
-        self._dbusservice.add_path("/Mgmt/Connection", connection)
+        self._sink.add_path("/Mgmt/Connection", connection)
 
         # Create the mandatory objects
-        self._dbusservice.add_path("/DeviceInstance", deviceinstance)
-        self._dbusservice.add_path("/ProductId", 0xFFFF)
-        self._dbusservice.add_path("/ProductName", productname)
-        self._dbusservice.add_path("/CustomName", customname)
-        self._dbusservice.add_path("/FirmwareVersion", "0.1.6b (20240718)")
-        # self._dbusservice.add_path('/HardwareVersion', '')
-        self._dbusservice.add_path("/Connected", 1)
-
-        self._dbusservice.add_path("/Latency", None)
-
-        for path, settings in self._paths.items():
-            self._dbusservice.add_path(
+        self._sink.add_path("/DeviceInstance", deviceinstance)
+        self._sink.add_path("/ProductId", 0xFFFF)
+        self._sink.add_path("/ProductName", productname)
+        self._sink.add_path("/CustomName", customname)
+        self._sink.add_path("/FirmwareVersion", "0.1.6b (20240718)")
+        # self._sink.add_path('/HardwareVersion', '')
+        self._sink.add_path("/Connected", 1)
+
+        self._sink.add_path("/Latency", None)
+
+        for path, path_settings in self._paths.items():
+            self._sink.add_path(
                 path,
-                settings["initial"],
-                gettextcallback=settings["textformat"],
-                writeable=True,
+                path_settings["initial"],
+                gettextcallback=path_settings["textformat"],
+                writeable=path_settings.get("writeable", True),
                 onchangecallback=self._handlechangedvalue,
+                getvaluecallback=derived_values.get if path_settings.get("derived") else None,
             )
 
-        GLib.timeout_add(1000, self._update)  # pause 1000ms before the next request
+        # (path, value getter) per priority tier, see paths_dbus
+        self._tier_getters = {
+            tier: [
+                (path, value_getters[path])
+                for path, path_settings in self._paths.items()
+                if path_settings.get("tier") == tier
+            ]
+            for tier in ("fast", "slow")
+        }
+        self._published_version = {"fast": 0, "slow": 0}
+        self._fast_scheduled = False
+        self._slow_interval = settings.publish_interval_slow
+
+        self._update_interval = settings.update_interval_min
+        GLib.timeout_add(int(self._update_interval * 1000), self._update)
+        GLib.timeout_add(int(self._slow_interval * 1000), self._update_slow)
+
+    # called from the MQTT/HTTP thread on every new sample: publishes the fast tier
+    # with the next main loop iteration
+    def schedule_fast(self):
+        if not self._fast_scheduled:
+            self._fast_scheduled = True
+            GLib.idle_add(self._update_fast)
+
+    def _update_fast(self):
+        self._fast_scheduled = False
+        self._publish("fast")
+        return False
+
+    def _update_slow(self):
+        self._publish("slow")
+
+        # the interval can be changed by reloading the config.ini
+        if self._slow_interval != settings.publish_interval_slow:
+            self._slow_interval = settings.publish_interval_slow
+            GLib.timeout_add(int(self._slow_interval * 1000), self._update_slow)
+            return False
+        return True
 
-    def _update(self):
-        global last_changed, last_updated
-
-        now = int(time())
+    # publish the paths of one tier, if a new sample was received since they were published last
+    def _publish(self, tier):
+        version = sample_version
+        if self._published_version[tier] == version:
+            return
 
         try:
-
-            if last_changed != last_updated:
-                self._dbusservice["/Ac/Power"] = (
-                    round(grid_power, 2) if grid_power is not None else None
-                )  # positive: consumption, negative: feed into grid
-                self._dbusservice["/Ac/L1/Power"] = (
-                    round(grid_power, 2) if grid_current is not None else None
-                )
-                self._dbusservice["/Ac/L2/Power"] = None
-                self._dbusservice["/Ac/L3/Power"] = None
-                self._dbusservice["/Ac/L1/Current"] = (
-                    round(grid_current, 2) if grid_current is not None else None
-                )
-                self._dbusservice["/Ac/L1/Voltage"] = (
-                    round(grid_voltage, 2) if grid_voltage is not None else None
-                )
-                self._dbusservice["/Ac/L1/Frequency"] = (
-                    round(grid_frequency, 2) if grid_frequency is not None else None
-                )
-                self._dbusservice["/Ac/L1/PowerFactor"] = (
-                    round(grid_pf, 2) if grid_pf is not None else None
-                )
-                if grid_forward is not None:
-                    self._dbusservice["/Ac/Energy/Forward"] = (
-                        round(grid_forward, 2)
-                    )
-                    self._dbusservice["/Ac/L1/Energy/Forward"] = (
-                        round(grid_forward, 2)
-                    )
-                    self._dbusservice["/Ac/L2/Energy/Forward"] = None
-                    self._dbusservice["/Ac/L3/Energy/Forward"] = None
-                if grid_reverse is not None:
-                    self._dbusservice["/Ac/Energy/Reverse"] = (
-                        round(grid_reverse, 2)
-                    )
-                    self._dbusservice["/Ac/L1/Energy/Reverse"] = (
-                        round(grid_reverse, 2)
-                    )
-                    self._dbusservice["/Ac/L2/Energy/Reverse"] = None
-                    self._dbusservice["/Ac/L3/Energy/Reverse"] = None
-
+            changed = False
+            for path, getter in self._tier_getters[tier]:
+                value = getter()
+                if value is not KEEP and self._sink[path] != value:
+                    self._sink[path] = value
+                    changed = True
+
+            # also sent as signals, for consumers that do not read them. Compared with the last
+            # sent value, since reading the sink computes the current one
+            if tier == "slow":
+                for path in self._pushed_derived:
+                    value = derived_values.get(path)
+                    if self._pushed_derived[path] != value:
+                        self._pushed_derived[path] = value
+                        self._sink[path] = value
+                        changed = True
+
+            # increment UpdateIndex - to show that new data is available
+            if changed:
+                index = self._sink["/UpdateIndex"] + 1  # increment index
+                if index > 255:  # maximum value of the index
+                    index = 0  # overflow from 255 to 0
+                self._sink["/UpdateIndex"] = index
+                self._sink.commit()
+
+            if tier == "slow" and logging.getLogger().isEnabledFor(logging.DEBUG):
+                # values that are not available are shown as nan
                 logging.debug(
                     # "Grid: {:.1f} W - {:.1f} V - {:.1f} A - {:.1f} Hz - PF {:.1f} - Fwd {:.1f} kWh - Rev {:.1f} kWh".format(
                     "Grid: {:.1f} W - {:.1f} V - {:.1f} A - {:.1f} Hz - PF {:.1f}".format(
-                        grid_power, grid_voltage, grid_current, grid_frequency, grid_pf
+                        *(
+                            math.nan if value is None else value
+                            for value in (
+                                grid_power,
+                                grid_voltage,
+                                grid_current,
+                                grid_frequency,
+                                grid_pf,
+                            )
+                        )
                     )
                 )
 
-                last_updated = last_changed
+            self._published_version[tier] = version
+
+            if tier == "fast" and latency_monitor is not None:
+                latency_monitor.processed(monotonic() - sample_received)
+
+            # only buffered, written by the thread of the exporter
+            if tier == "fast" and influx_exporter is not None:
+                influx_exporter.add(
+                    time(),
+                    (
+                        grid_power,
+                        grid_current,
+                        grid_voltage,
+                        grid_frequency,
+                        grid_pf,
+                        grid_forward,
+                        grid_reverse,
+                    ),
+                )
 
         except KeyError:
             exception_type, exception_object, exception_traceback = sys.exc_info()
@@ -365,7 +1115,28 @@ class DbusMqttGridService:
             logging.error("ERROR:The driver restarts now.")
             sys.exit()
 
+    # seconds between two _update calls: follows the interval of the received samples, so a quiet
+    # meter wakes up rarely and a busy one is checked often
+    def _get_update_interval(self):
+        lower = settings.update_interval_min
+        upper = settings.update_interval_max
+        # the timeout must still be detected in time
+        if settings.timeout != 0:
+            upper = min(upper, max(lower, settings.timeout / 4))
+        interval = upper
+        if sample_interval is not None:
+            interval = max(sample_interval, monotonic() - last_sample_time)
+        return min(max(interval, lower), upper)
+
+    def _update(self):
+        now = int(time())
+
+        # the fast tier is normally published right after the sample arrived, this catches
+        # samples that came in while the idle callback was already running
+        self._publish("fast")
+
         # quit driver if timeout is exceeded
+        timeout = settings.timeout
         if timeout != 0 and (now - last_changed) > timeout:
             logging.error(
                 "Driver stopped. Timeout of %i seconds exceeded, since no new MQTT message was received in this time."
@@ -373,11 +1144,13 @@ class DbusMqttGridService:
             )
             sys.exit()
 
-        # increment UpdateIndex - to show that new data is available
-        index = self._dbusservice["/UpdateIndex"] + 1  # increment index
-        if index > 255:  # maximum value of the index
-            index = 0  # overflow from 255 to 0
-        self._dbusservice["/UpdateIndex"] = index
+        # reschedule, if the interval of the received samples changed noticeably
+        interval = self._get_update_interval()
+        if abs(interval - self._update_interval) > 0.2 * self._update_interval:
+            logging.debug("Update interval changed to %.1f seconds" % interval)
+            self._update_interval = interval
+            GLib.timeout_add(int(interval * 1000), self._update)
+            return False
         return True
 
     def _handlechangedvalue(self, path, value):
@@ -385,88 +1158,519 @@ class DbusMqttGridService:
         return True  # accept the change
 
 
-def main():
-    _thread.daemon = True  # allow the program to quit
+def start_mqtt_source():
+    global mqtt_client, mqtt_glib_loop
 
-    from dbus.mainloop.glib import (
-        DBusGMainLoop,
-    )  # pyright: ignore[reportMissingImports]
-
-    # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
-    DBusGMainLoop(set_as_default=True)
-
-    # MQTT setup
-    client = mqtt.Client("MqttGrid_" + str(config["DEFAULT"]["device_instance"]))
+    client = mqtt.Client("MqttGrid_" + str(settings.device_instance))
+    mqtt_client = client
     client.on_disconnect = on_disconnect
     client.on_connect = on_connect
+    client.on_connect_fail = on_connect_fail
     client.on_message = on_message
 
-    # check tls and use settings, if provided
-    if "tls_enabled" in config["MQTT"] and config["MQTT"]["tls_enabled"] == "1":
-        logging.info("MQTT client: TLS is enabled")
+    configure_client(
+        client,
+        settings.tls_enabled,
+        settings.tls_path_to_ca,
+        settings.tls_insecure,
+        settings.username,
+        settings.password,
+    )
+
+    # connect to broker, on failures paho reconnects to the broker chosen by the pool
+    client.reconnect_delay_set(min_delay=1, max_delay=15)
+    if settings.mqtt_loop == "glib":
+        from glib_mqtt import GLibMqttLoop
+
+        # receive the messages in the main loop, without the network thread of paho. The brokers
+        # are probed and connected in the connect thread of the loop, also for every reconnect
+        mqtt_glib_loop = GLibMqttLoop(client, broker_pool.connect, min_delay=1, max_delay=15)
+        broker_pool.glib_loop = mqtt_glib_loop
+        mqtt_glib_loop.start()
+    else:
+        broker_pool.connect(client)
+        client.loop_start()
+    if len(broker_pool.brokers) > 1 and settings.broker_fallback_interval > 0:
+        GLib.timeout_add_seconds(
+            settings.broker_fallback_interval, broker_pool.fallback, client
+        )
 
-        if (
-            "tls_path_to_ca" in config["MQTT"]
-            and config["MQTT"]["tls_path_to_ca"] != ""
-        ):
-            logging.info(
-                'MQTT client: TLS: custom ca "%s" used'
-                % config["MQTT"]["tls_path_to_ca"]
-            )
-            client.tls_set(config["MQTT"]["tls_path_to_ca"], tls_version=2)
-        else:
-            client.tls_set(tls_version=2)
 
-        if "tls_insecure" in config["MQTT"] and config["MQTT"]["tls_insecure"] != "":
-            logging.info(
-                "MQTT client: TLS certificate server hostname verification disabled"
+# poll the Shelly over HTTP in its own thread, the same way paho runs the MQTT client
+def http_poll_loop(poller):
+    while True:
+        start = monotonic()
+        try:
+            (instant, instant_body), (energy, energy_body) = poller.poll()
+            handle_instant(instant, instant_body)
+            handle_energy(energy, energy_body)
+            logging.debug(
+                "HTTP: Polled %s in %.1f ms" % (poller.host, (monotonic() - start) * 1000)
             )
-            client.tls_insecure_set(True)
-
-    # check if username and password are set
-    if (
-        "username" in config["MQTT"]
-        and "password" in config["MQTT"]
-        and config["MQTT"]["username"] != ""
-        and config["MQTT"]["password"] != ""
-    ):
-        logging.info(
-            'MQTT client: Using username "%s" and password to connect'
-            % config["MQTT"]["username"]
+        except Exception as err:
+            logging.warning(f"HTTP: Polling {poller.host}:{poller.port} failed: {repr(err)}")
+        # the interval can be changed by reloading the config.ini
+        sleep(max(0, settings.http_interval - (monotonic() - start)))
+
+
+def start_http_source():
+    logging.info(
+        f"HTTP: Polling {settings.http_host} on port {settings.http_port} every {settings.http_interval} seconds"
+    )
+    from shelly_http import ShellyHttpPoller
+
+    poller = ShellyHttpPoller(
+        settings.http_host,
+        settings.http_port,
+        channel=settings.channel,
+        timeout=settings.http_timeout,
+        pipelining=settings.http_pipelining,
+    )
+    threading.Thread(target=http_poll_loop, args=(poller,), daemon=True).start()
+
+
+def _exit_replay():
+    logging.warning("Replay: End of the capture file reached. The driver stops now.")
+    # the values of the last messages, which were not published yet
+    if publisher is not None:
+        publisher._publish("fast")
+        publisher._publish("slow")
+    sys.exit()
+
+
+def replay_loop():
+    def deliver(topic, payload):
+        on_message(None, None, SimpleNamespace(topic=topic, payload=payload))
+
+    start = monotonic()
+    from replay import replay
+
+    count = replay(settings.replay_file, deliver, settings.replay_speed)
+    logging.info(
+        "Replay: %i messages replayed in %.3f seconds" % (count, monotonic() - start)
+    )
+    if settings.replay_exit:
+        GLib.idle_add(_exit_replay)
+
+
+def start_replay_source():
+    # a replay must never show up as meter on the D-Bus of a real system
+    if settings.output == "dbus" and "DBUS_SESSION_BUS_ADDRESS" not in os.environ:
+        logging.error(
+            "Replay: Needs a private session bus, start the driver with: dbus-run-session -- python "
+            + __file__
         )
-        client.username_pw_set(
-            username=config["MQTT"]["username"], password=config["MQTT"]["password"]
+        sys.exit()
+
+    logging.info(
+        f"Replay: Replaying {settings.replay_file} with speed {settings.replay_speed}"
+    )
+    threading.Thread(target=replay_loop, daemon=True).start()
+
+
+def _exit_pipe():
+    logging.warning("Pipe: The gateway closed the pipe. The driver stops now.")
+    sys.exit()
+
+
+def pipe_loop():
+    from gateway import read_frames
+
+    if settings.pipe_fd == 0:
+        pipe = sys.stdin.buffer
+    else:
+        # a worker process of the gateway with several meters has one pipe per meter
+        pipe = open(settings.pipe_fd, "rb", closefd=False)
+    for topic, payload in read_frames(pipe):
+        on_message(None, None, SimpleNamespace(topic=topic, payload=payload))
+    GLib.idle_add(_exit_pipe)
+
+
+def start_pipe_source():
+    logging.info("Pipe: Receiving the MQTT messages from the gateway")
+    threading.Thread(target=pipe_loop, daemon=True).start()
+
+
+def flush_capture():
+    payload_capture.flush()
+    return True
+
+
+def start_capture():
+    global payload_capture
+
+    logging.info(f"Capture: Writing all received messages to {settings.replay_file}")
+    from replay import PayloadCapture
+
+    payload_capture = PayloadCapture(settings.replay_file)
+    GLib.timeout_add_seconds(10, flush_capture)
+    atexit.register(flush_capture)
+
+
+def flush_recorder():
+    try:
+        sample_recorder.flush()
+    except Exception as err:
+        logging.error(f"Recorder: Writing to {settings.recorder_path} failed: {repr(err)}")
+    return True
+
+
+def start_recorder():
+    global sample_recorder
+
+    logging.info(
+        f"Recorder: Recording samples to {settings.recorder_path} ({settings.recorder_size_kb} kB)"
+    )
+    from recorder import SampleRecorder
+
+    sample_recorder = SampleRecorder(settings.recorder_path, settings.recorder_size_kb)
+    GLib.timeout_add_seconds(settings.recorder_flush_interval, flush_recorder)
+    # write the pending samples also when the driver stops
+    atexit.register(flush_recorder)
+
+
+# starts a new day of the daily energy at local midnight
+def check_daily_energy():
+    if energy_received or aggregate_meter is not None:
+        counters = (grid_forward, grid_reverse)
+    else:
+        counters = (None, None)
+    now = time()
+    today = date.fromtimestamp(now)
+    if daily_energy.update(today, counters):
+        derived_values.invalidate()
+
+    # again at the next midnight, and every minute while a counter was not received yet
+    midnight = datetime.combine(today + timedelta(days=1), datetime.min.time()).timestamp()
+    seconds = midnight - now
+    if daily_energy.incomplete():
+        seconds = min(seconds, 60)
+    GLib.timeout_add(int(seconds * 1000) + 100, check_daily_energy)
+    return False
+
+
+def start_derived():
+    global derived_values, daily_energy
+    from derived import DailyEnergy, LazyValues
+
+    daily_energy = DailyEnergy(settings.derived_file)
+    daily_energy.load()
+    derived_values = LazyValues(derived_getters, lambda: sample_version)
+    check_daily_energy()
+
+
+def republish_snapshot():
+    current_settings = settings
+    # retried with the next interval
+    if not connected:
+        return True
+
+    age = monotonic() - last_sample_time
+    stale = age > current_settings.republish_stale_after or (
+        aggregate_meter is not None and aggregate_meter.stale
+    )
+    snapshot_republisher.tick(
+        (
+            grid_power,
+            grid_current,
+            grid_voltage,
+            grid_frequency,
+            grid_pf,
+            grid_forward,
+            grid_reverse,
+        ),
+        age,
+        stale,
+    )
+    return True
+
+
+def start_republish():
+    global snapshot_republisher
+
+    if mqtt_client is None:
+        logging.warning(
+            "Republish: Only available with the MQTT connection of source = mqtt or aggregate"
         )
+        return
 
-    # connect to broker
     logging.info(
-        f"MQTT client: Connecting to broker {config['MQTT']['broker_address']} on port {config['MQTT']['broker_port']}"
+        f"Republish: Publishing the values to {settings.republish_topic} every {settings.republish_interval} seconds"
     )
-    client.connect(
-        host=config["MQTT"]["broker_address"], port=int(config["MQTT"]["broker_port"])
+    from republish import SnapshotRepublisher
+
+    snapshot_republisher = SnapshotRepublisher(
+        mqtt_client,
+        settings.republish_topic,
+        qos=settings.republish_qos,
+        retain=settings.republish_retain,
+        deadbands=settings.republish_deadbands,
+        max_interval=settings.republish_max_interval,
     )
-    client.loop_start()
+    GLib.timeout_add(int(settings.republish_interval * 1000), republish_snapshot)
 
-    # wait to receive first data, else the JSON is empty and phase setup won't work
-    i = 0
-    while grid_power == -1:
-        if i % 12 != 0 or i == 0:
-            logging.info("Waiting 5 seconds for receiving first data...")
-        else:
-            logging.warning(
-                "Waiting since %s seconds for receiving first data..." % str(i * 5)
-            )
 
-        # check if timeout was exceeded
-        if timeout != 0 and timeout <= (i * 5):
-            logging.error(
-                "Driver stopped. Timeout of %i seconds exceeded, since no new MQTT message was received in this time."
-                % timeout
-            )
-            sys.exit()
+def start_influx():
+    global influx_exporter
 
-        sleep(5)
-        i += 1
+    logging.info(f"Influx: Exporting the values to {settings.influx_target}")
+    from influx import LineProtocolExporter
+
+    influx_exporter = LineProtocolExporter(
+        settings.influx_target,
+        settings.influx_measurement,
+        {"instance": settings.device_instance, "name": settings.device_name},
+        flush_interval=settings.influx_flush_interval,
+        batch_size=settings.influx_batch_size,
+        buffer_size=settings.influx_buffer_size,
+    )
+    influx_exporter.start()
+    # write the buffered lines also when the driver stops
+    atexit.register(influx_exporter.stop)
+
+
+def report_latency():
+    logging.info("Latency: " + latency_monitor.report())
+    return True
+
+
+def start_latency_monitor():
+    global latency_monitor
+
+    from latency import LatencyMonitor
+
+    latency_monitor = LatencyMonitor(settings.latency_window)
+    if settings.source in ("mqtt", "aggregate", "pipe") and settings.mode != "events":
+        logging.warning(
+            "Latency: The status payloads include no time of the Shelly, only the processing delay is measured. Use mode = events to measure the transport delay too."
+        )
+    if settings.latency_report_interval > 0:
+        GLib.timeout_add(int(settings.latency_report_interval * 1000), report_latency)
+
+
+def check_aggregate():
+    if aggregate_meter.check():
+        notify_aggregate()
+    return True
+
+
+def start_aggregate():
+    global aggregate_meter
+
+    from aggregate import AggregateMeter
+
+    aggregate_meter = AggregateMeter(
+        settings.aggregate_inputs,
+        {"voltage": settings.voltage},
+        settings.aggregate_alignment,
+        settings.aggregate_stale_timeout,
+    )
+    logging.info(
+        "Aggregate: Summing %s"
+        % ", ".join(
+            "%s (L%i)" % (meter_input.name, meter_input.phase)
+            for meter_input in aggregate_meter.inputs
+        )
+    )
+
+    # the values of all phases are read from the sums of the virtual meter
+    def getter(phase, name, keep=False):
+        def get():
+            value = aggregate_meter.value(phase, name)
+            if value is None:
+                return KEEP if keep else None
+            return round(value, 2)
+
+        return get
+
+    value_getters["/Ac/Power"] = getter(0, "power")
+    value_getters["/Ac/L1/Frequency"] = getter(0, "frequency")
+    value_getters["/Ac/Energy/Forward"] = getter(0, "forward", True)
+    value_getters["/Ac/Energy/Reverse"] = getter(0, "reverse", True)
+    for phase in (1, 2, 3):
+        prefix = "/Ac/L%i/" % phase
+        value_getters[prefix + "Power"] = getter(phase, "power")
+        value_getters[prefix + "Current"] = getter(phase, "current")
+        value_getters[prefix + "Voltage"] = getter(phase, "voltage")
+        value_getters[prefix + "PowerFactor"] = getter(phase, "pf")
+        value_getters[prefix + "Energy/Forward"] = getter(phase, "forward", True)
+        value_getters[prefix + "Energy/Reverse"] = getter(phase, "reverse", True)
+
+    # publishes the sums of an expired alignment window and detects stale inputs
+    interval = settings.aggregate_alignment if settings.aggregate_alignment > 0 else 1
+    GLib.timeout_add(int(min(max(interval, 0.1), 1) * 1000), check_aggregate)
+
+
+def wait_for_first_data(seconds):
+    if mqtt_glib_loop is None:
+        return first_data.wait(seconds)
+
+    # the MQTT messages are only received while the main loop runs
+    context = GLib.MainContext.default()
+    wakeup = GLib.timeout_add(500, lambda: True)
+    end = monotonic() + seconds
+    while not first_data.is_set() and monotonic() < end:
+        context.iteration(True)
+    GLib.source_remove(wakeup)
+    return first_data.is_set()
+
+
+# start a sampling profile of all threads, or stop it early if one is running
+def _on_sigusr1():
+    global profiler
+
+    if profiler is None:
+        from profiler import SamplingProfiler
+
+        profiler = SamplingProfiler()
+
+    if profiler.running:
+        logging.warning("Profiler: Stopping the profile")
+        profiler.stop()
+    else:
+        logging.warning(
+            "Profiler: Sampling all threads every %g seconds for %g seconds, send SIGUSR1 again to stop earlier"
+            % (settings.profile_interval, settings.profile_duration)
+        )
+        profiler.start(
+            settings.profile_duration, settings.profile_interval, settings.debug_path
+        )
+    return True  # keep the signal handler
+
+
+# internal counters and the current measurement values
+def get_state():
+    state = {
+        "time": time(),
+        "source": settings.source,
+        "connected": connected,
+        "last_changed": last_changed,
+        "seconds_since_last_change": round(time() - last_changed, 1),
+        "sample_version": sample_version,
+        "sample_interval": sample_interval,
+        "values": {
+            "power": grid_power,
+            "current": grid_current,
+            "voltage": grid_voltage,
+            "frequency": grid_frequency,
+            "pf": grid_pf,
+            "forward": grid_forward,
+            "reverse": grid_reverse,
+        },
+        "rpc_pending": len(rpc_pending),
+        "brokers": (
+            broker_pool.stats() if settings.source in ("mqtt", "aggregate") else None
+        ),
+        "threads": [thread.name for thread in threading.enumerate()],
+    }
+    if publisher is not None:
+        state["publisher"] = {
+            "published_version": dict(publisher._published_version),
+            "update_interval": publisher._update_interval,
+            "slow_interval": publisher._slow_interval,
+            "update_index": publisher._sink["/UpdateIndex"],
+        }
+    if sample_recorder is not None:
+        state["recorder"] = {
+            "pending": len(sample_recorder._pending),
+            "dropped": sample_recorder.dropped,
+            "count": sample_recorder.count,
+        }
+    if payload_capture is not None:
+        state["capture"] = {"messages": payload_capture.messages}
+    if aggregate_meter is not None:
+        state["aggregate"] = aggregate_meter.state()
+    if latency_monitor is not None:
+        state["latency"] = latency_monitor.summary()
+    if influx_exporter is not None:
+        state["influx"] = influx_exporter.stats()
+    if snapshot_republisher is not None:
+        state["republish"] = snapshot_republisher.stats()
+    if rollup_engine is not None:
+        # all closed buckets, only written to the file, see _on_sigusr2
+        state["history"] = rollup_engine.state()
+    if derived_values is not None:
+        state["derived"] = derived_values.stats()
+        state["daily_energy"] = {
+            "day": str(daily_energy.day),
+            "start": daily_energy.start,
+            "yesterday": daily_energy.yesterday,
+        }
+    return state
+
+
+def _on_sigusr2():
+    state = get_state()
+    # the buckets of the history are too long for the log
+    history = state.pop("history", None)
+    logging.warning("State: " + json.dumps(state, default=str))
+    if history is not None:
+        state["history"] = history
+    try:
+        os.makedirs(settings.debug_path, exist_ok=True)
+        # a worker process of the gateway.py can hold several meters
+        path = os.path.join(
+            settings.debug_path, "state_%i_%i.json" % (settings.device_instance, time())
+        )
+        with open(path, "w") as file:
+            file.write(json.dumps(state, default=str) + "\n")
+        logging.warning("State: Written to " + path)
+    except OSError as err:
+        logging.error("State: Writing the state failed: %s" % repr(err))
+    return True  # keep the signal handler
+
+
+# every thread gets its own glibc malloc arena by default, which keeps freed memory of
+# short peaks (TLS handshake, JSON decoding) for the thread. One arena is shared by all threads
+def limit_malloc_arenas():
+    try:
+        import ctypes
+
+        ctypes.CDLL("libc.so.6").mallopt(-8, 1)  # M_ARENA_MAX
+    except (OSError, AttributeError) as err:
+        logging.debug("Low memory: Limiting the malloc arenas failed: %s" % repr(err))
+
+
+def flush_sink(sink):
+    try:
+        sink.flush()
+    except Exception as err:
+        logging.error(f"Output: Writing to {settings.output_file} failed: {repr(err)}")
+    return True
+
+
+# the output backend of the publisher
+def create_sink(servicename):
+    if settings.output == "memory":
+        from sinks import MemorySink
+
+        return MemorySink()
+
+    if settings.output == "jsonl":
+        from sinks import JsonLinesSink
+
+        logging.info(f"Output: Writing the values to {settings.output_file}")
+        sink = JsonLinesSink(settings.output_file)
+        GLib.timeout_add(int(settings.output_flush_interval * 1000), flush_sink, sink)
+        # write the buffered lines also when the driver stops
+        atexit.register(flush_sink, sink)
+        return sink
+
+    from sinks import DbusSink
+
+    return DbusSink(
+        servicename,
+        autobatch=settings.dbus_autobatch != 0,
+        itemsignals=settings.dbus_autobatch != 2,
+        compact=settings.dbus_compact == 1,
+        # a worker process of the gateway.py can hold several meters
+        private=settings.pipe_fd != 0,
+    )
+
+
+# registers the D-Bus service, or the service of the configured output, with all paths
+def create_publisher():
+    global rollup_engine
 
     # formatting
     def _wh(p, v):
@@ -487,34 +1691,205 @@ def main():
     def _n(p, v):
         return str("%i" % v)
 
+    def _va(p, v):
+        return str("%i" % v) + "VA"
+
+    def _var(p, v):
+        return str("%i" % v) + "var"
+
+    # tier "fast" = published as soon as a new sample arrives, used by ESS for control
+    # tier "slow" = published every publish_interval_slow seconds, informational only
     paths_dbus = {
-        "/Ac/Power": {"initial": 0, "textformat": _w},
-        "/Ac/Energy/Forward": {"initial": None,"textformat": _wh},  # energy bought from the grid
-        "/Ac/Energy/Reverse": {"initial": None,"textformat": _wh},  # energy sold to the grid
-        "/Ac/L1/Energy/Forward": {"initial": None,"textformat": _wh},  # energy bought from the grid
-        "/Ac/L1/Energy/Reverse": {"initial": None,"textformat": _wh},  # energy sold to the grid
-        "/Ac/L2/Energy/Forward": {"initial": None,"textformat": _wh},  # energy bought from the grid
-        "/Ac/L2/Energy/Reverse": {"initial": None,"textformat": _wh},  # energy sold to the grid
-        "/Ac/L3/Energy/Forward": {"initial": None,"textformat": _wh},  # energy bought from the grid
-        "/Ac/L3/Energy/Reverse": {"initial": None,"textformat": _wh},  # energy sold to the grid
-        "/Ac/L1/Power": {"initial": 0, "textformat": _w},
-        "/Ac/L2/Power": {"initial": 0, "textformat": _w},
-        "/Ac/L3/Power": {"initial": 0, "textformat": _w},
-        "/Ac/L1/Current": {"initial": 0, "textformat": _a},
-        "/Ac/L1/Voltage": {"initial": 0, "textformat": _v},
-        "/Ac/L1/Frequency": {"initial": None, "textformat": _hz},
-        "/Ac/L1/PowerFactor": {"initial": None, "textformat": _n},
+        "/Ac/Power": {"initial": 0, "textformat": _w, "tier": "fast"},
+        "/Ac/Energy/Forward": {"initial": None,"textformat": _wh, "tier": "slow"},  # energy bought from the grid
+        "/Ac/Energy/Reverse": {"initial": None,"textformat": _wh, "tier": "slow"},  # energy sold to the grid
+        "/Ac/L1/Energy/Forward": {"initial": None,"textformat": _wh, "tier": "slow"},  # energy bought from the grid
+        "/Ac/L1/Energy/Reverse": {"initial": None,"textformat": _wh, "tier": "slow"},  # energy sold to the grid
+        "/Ac/L2/Energy/Forward": {"initial": None,"textformat": _wh, "tier": "slow"},  # energy bought from the grid
+        "/Ac/L2/Energy/Reverse": {"initial": None,"textformat": _wh, "tier": "slow"},  # energy sold to the grid
+        "/Ac/L3/Energy/Forward": {"initial": None,"textformat": _wh, "tier": "slow"},  # energy bought from the grid
+        "/Ac/L3/Energy/Reverse": {"initial": None,"textformat": _wh, "tier": "slow"},  # energy sold to the grid
+        "/Ac/L1/Power": {"initial": 0, "textformat": _w, "tier": "fast"},
+        "/Ac/L2/Power": {"initial": 0, "textformat": _w, "tier": "fast"},
+        "/Ac/L3/Power": {"initial": 0, "textformat": _w, "tier": "fast"},
+        "/Ac/L1/Current": {"initial": 0, "textformat": _a, "tier": "slow"},
+        "/Ac/L1/Voltage": {"initial": 0, "textformat": _v, "tier": "slow"},
+        "/Ac/L1/Frequency": {"initial": None, "textformat": _hz, "tier": "slow"},
+        "/Ac/L1/PowerFactor": {"initial": None, "textformat": _n, "tier": "slow"},
         "/UpdateIndex": {"initial": 0, "textformat": _n},
     }
 
-    DbusMqttGridService(
-        servicename="com.victronenergy." + device_type + ".mqtt_" + device_type + "_"
-        + str(config["DEFAULT"]["device_instance"]),
-        deviceinstance=int(config["DEFAULT"]["device_instance"]),
-        customname=config["DEFAULT"]["device_name"] if config["DEFAULT"]["device_name"] != "MQTT Grid" else "MQTT " + device_type_name,
+    # the virtual meter has values for every phase of its inputs
+    if aggregate_meter is not None:
+        for phase in aggregate_meter.phases:
+            for path, textformat in (
+                ("/Ac/L%i/Current" % phase, _a),
+                ("/Ac/L%i/Voltage" % phase, _v),
+                ("/Ac/L%i/PowerFactor" % phase, _n),
+            ):
+                paths_dbus.setdefault(
+                    path, {"initial": None, "textformat": textformat, "tier": "slow"}
+                )
+
+    # statistics of the last complete minute and 15 minutes
+    if settings.history:
+        from rollup import RollupEngine
+
+        rollup_engine = RollupEngine()
+        logging.info(
+            "History: Using %i bytes for the statistics" % rollup_engine.memory_bytes()
+        )
+        for name in ("1m", "15m"):
+            for path, textformat in (
+                ("/History/Power/Avg", _w),
+                ("/History/Power/Min", _w),
+                ("/History/Power/Max", _w),
+                ("/History/Energy/Forward", _wh),
+                ("/History/Energy/Reverse", _wh),
+            ):
+                paths_dbus[path + name] = {
+                    "initial": None,
+                    "textformat": textformat,
+                    "tier": "slow",
+                    "writeable": False,
+                }
+
+    # computed only when they are read, see derived.py
+    if settings.derived_paths:
+        start_derived()
+        for path, textformat in (
+            ("/Ac/ApparentPower", _va),
+            ("/Ac/ReactivePower", _var),
+            ("/Ac/Energy/ForwardToday", _wh),
+            ("/Ac/Energy/ReverseToday", _wh),
+            ("/Ac/Energy/ForwardYesterday", _wh),
+            ("/Ac/Energy/ReverseYesterday", _wh),
+        ):
+            paths_dbus[path] = {
+                "initial": None,
+                "textformat": textformat,
+                "writeable": False,
+                "derived": True,
+            }
+
+    return DbusMqttGridService(
+        sink=create_sink(
+            "com.victronenergy." + settings.device_type + ".mqtt_" + settings.device_type + "_"
+            + str(settings.device_instance)
+        ),
+        deviceinstance=settings.device_instance,
+        customname=settings.device_name if settings.device_name != "MQTT Grid" else "MQTT " + settings.device_type_name,
         paths=paths_dbus,
     )
 
+
+# starts receiving the values. The gateway.py calls start(), wait_for_first_values() and
+# start_publishing() for every meter of a worker process, which share one main loop
+def start():
+    global config_monitor
+
+    # before the MQTT/HTTP thread is started
+    if settings.low_memory:
+        limit_malloc_arenas()
+
+    _thread.daemon = True  # allow the program to quit
+
+    if settings.output == "dbus":
+        from dbus.mainloop.glib import (
+            DBusGMainLoop,
+        )  # pyright: ignore[reportMissingImports]
+
+        # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
+        DBusGMainLoop(set_as_default=True)
+
+    # reload the config.ini on SIGHUP and, if enabled, when the file changes
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGHUP, _on_sighup)
+
+    # profile all threads on SIGUSR1 and write the internal state on SIGUSR2
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, _on_sigusr1)
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR2, _on_sigusr2)
+    if settings.config_watch:
+        from gi.repository import Gio  # pyright: ignore[reportMissingImports]
+
+        # kept in a global, the monitor stops when it is garbage collected
+        config_monitor = Gio.File.new_for_path(config_file).monitor_file(
+            Gio.FileMonitorFlags.NONE, None
+        )
+        config_monitor.connect("changed", _on_config_changed)
+
+    # measure the transport and processing delay of the received values
+    if settings.latency:
+        start_latency_monitor()
+
+    # export the published values as line protocol
+    if settings.influx_enabled:
+        start_influx()
+
+    # record every sample to a ring file for later analysis
+    if settings.recorder_enabled:
+        start_recorder()
+
+    # write all received messages to a file, that can be replayed later
+    if settings.capture and settings.source in ("mqtt", "aggregate"):
+        start_capture()
+
+    # sum the payloads of several meters into one virtual meter
+    if settings.source == "aggregate":
+        start_aggregate()
+
+    if settings.source == "http":
+        start_http_source()
+    elif settings.source == "replay":
+        start_replay_source()
+    elif settings.source == "pipe":
+        start_pipe_source()
+    else:
+        start_mqtt_source()
+
+
+# wait to receive first data, else the JSON is empty and phase setup won't work
+def wait_for_first_values():
+    i = 0
+    while not first_data.is_set():
+        if i % 12 != 0 or i == 0:
+            logging.info("Waiting 5 seconds for receiving first data...")
+        else:
+            logging.warning(
+                "Waiting since %s seconds for receiving first data..." % str(i * 5)
+            )
+
+        # check if timeout was exceeded
+        timeout = settings.timeout
+        if timeout != 0 and timeout <= (i * 5):
+            logging.error(
+                "Driver stopped. Timeout of %i seconds exceeded, since no new MQTT message was received in this time."
+                % timeout
+            )
+            sys.exit()
+
+        wait_for_first_data(5)
+        i += 1
+
+
+def start_publishing():
+    global publisher
+
+    publisher = create_publisher()
+
+    # one normalized message for other MQTT consumers
+    if settings.republish_enabled:
+        start_republish()
+
+    # poll the Shelly, if its own status push is too slow
+    if settings.source == "mqtt" and settings.rpc_poll_interval > 0:
+        GLib.timeout_add(int(settings.rpc_poll_interval * 1000), rpc_poll)
+
+
+def main():
+    start()
+    wait_for_first_values()
+    start_publishing()
+
     logging.info(
         "Connected to dbus and switching over to GLib.MainLoop() (= event based)"
     )
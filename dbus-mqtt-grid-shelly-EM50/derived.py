@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Values derived from the received ones, which are only computed when they are read. Their
+# D-Bus paths are registered with a getvaluecallback, that is called for GetValue, GetText and
+# GetItems. A value is computed at most once per received sample: receiving a sample only
+# increments the sample version, which the driver does anyway, so the derived paths cost nothing
+# until somebody reads them.
+#
+# The energy of today and yesterday is the difference of the meter counters to their values at
+# the start of the day. These are taken by a timer at local midnight and kept in a small JSON
+# file, so a restart of the driver does not reset the values of today.
+
+import json
+import logging
+import os
+from datetime import date, timedelta
+
+_MISSING = object()
+
+
+class LazyValues:
+    def __init__(self, functions, version):
+        # path -> function() computing the value
+        self._functions = functions
+        # function() returning the version of the current sample
+        self._version = version
+        self._cached_version = None
+        self._cache = {}
+        self.reads = 0
+        self.evaluations = 0
+
+    @property
+    def paths(self):
+        return tuple(self._functions)
+
+    # used as getvaluecallback of the paths
+    def get(self, path):
+        self.reads += 1
+        version = self._version()
+        if version != self._cached_version:
+            self._cache = {}
+            self._cached_version = version
+        value = self._cache.get(path, _MISSING)
+        if value is _MISSING:
+            value = self._cache[path] = self._functions[path]()
+            self.evaluations += 1
+        return value
+
+    # forgets the cached values, if something else than a new sample changed them
+    def invalidate(self):
+        self._cached_version = None
+
+    def stats(self):
+        return {"paths": len(self._functions), "reads": self.reads, "evaluations": self.evaluations}
+
+
+class DailyEnergy:
+    # counters: forward, reverse
+
+    def __init__(self, path):
+        self.path = path
+        self.day = None  # date of the start values
+        self.start = [None, None]  # counters at the start of the day
+        self.yesterday = [None, None]
+        # the previous day was seen by this process, so its end is known
+        self._running = False
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                state = json.load(file)
+            self.day = date.fromisoformat(state["day"])
+            self.start = [state["start"][0], state["start"][1]]
+            self.yesterday = [state["yesterday"][0], state["yesterday"][1]]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, IndexError, TypeError) as err:
+            logging.warning(
+                "Daily energy: Ignoring the invalid file %s: %s" % (self.path, repr(err))
+            )
+            self.day = None
+            self.start = [None, None]
+            self.yesterday = [None, None]
+
+    def save(self):
+        state = {"day": self.day.isoformat(), "start": self.start, "yesterday": self.yesterday}
+        # replaced at once, so a power loss never leaves a partial file
+        try:
+            with open(self.path + ".tmp", "w") as file:
+                json.dump(state, file)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as err:
+            logging.warning("Daily energy: Writing %s failed: %s" % (self.path, repr(err)))
+
+    # called by a timer at midnight and while a start value is missing. Returns True, if the
+    # values changed
+    def update(self, today, counters):
+        changed = False
+        if self.day != today:
+            # without the counters at midnight, yesterday is not known
+            if self._running and self.day + timedelta(days=1) == today:
+                self.yesterday = [
+                    round(counter - start, 2)
+                    if counter is not None and start is not None
+                    else None
+                    for counter, start in zip(counters, self.start)
+                ]
+            else:
+                self.yesterday = [None, None]
+            self.day = today
+            self.start = list(counters)
+            changed = True
+        else:
+            for i, counter in enumerate(counters):
+                # the first value after the start, or the counter of a new meter
+                if counter is not None and (self.start[i] is None or counter < self.start[i]):
+                    self.start[i] = counter
+                    changed = True
+        self._running = True
+        if changed:
+            self.save()
+        return changed
+
+    def today(self, index, counter):
+        start = self.start[index]
+        if counter is None or start is None:
+            return None
+        return round(max(counter - start, 0.0), 2)
+
+    # True, while a counter was not received since the start of the day
+    def incomplete(self):
+        return None in self.start
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+## Checks that removing paths from a VeDbusService leaves no tree nodes behind, in the export
+# with one object per path and in the compact mode. Thousands of paths are added and removed
+# again in random order, partly while other paths below the same nodes still exist.
+#
+# Runs on a private session bus:
+#   dbus-run-session -- python test_vedbus_nodes.py
+# Skipped without dbus-python or a session bus.
+
+import os
+import random
+import sys
+import unittest
+
+try:
+	import dbus
+	from dbus.mainloop.glib import DBusGMainLoop
+	from gi.repository import GLib
+except ImportError:
+	dbus = None
+
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)))
+
+PATHS = 3000
+
+
+def make_paths(count):
+	return ['/Ac/L%i/Group%i/Sub%i/Value%i' % (i % 3 + 1, i // 100, i // 10, i) for i in range(count)]
+
+
+## the object paths of the given paths and of all tree nodes above them, without /
+def with_nodes(paths):
+	result = set()
+	for path in paths:
+		parts = path.split('/')
+		for i in range(2, len(parts) + 1):
+			result.add('/'.join(parts[:i]))
+	return result
+
+
+def setUpModule():
+	global VeDbusService
+	if dbus is None or 'DBUS_SESSION_BUS_ADDRESS' not in os.environ:
+		raise unittest.SkipTest('needs dbus-python and a session bus')
+	from vedbus import VeDbusService
+	DBusGMainLoop(set_as_default=True)
+
+
+class TestNodeRefcount(unittest.TestCase):
+	def setUp(self):
+		self.bus = dbus.SessionBus(private=True)
+		self.client = dbus.SessionBus(private=True)
+		# libdbus would end the process, when the main loop of a later test handles the disconnect
+		self.bus.set_exit_on_disconnect(False)
+		self.client.set_exit_on_disconnect(False)
+		self.addCleanup(self.bus.close)
+		self.addCleanup(self.client.close)
+
+	def _service(self, servicename, compact):
+		## removed again before the connection is closed, also when the test fails
+		service = VeDbusService(servicename, bus=self.bus, compact=compact)
+		self.addCleanup(service.__del__)
+		return service
+
+	def _exported(self, path='/'):
+		## all object paths that are still registered on the connection below path
+		result = []
+		for child in self.bus.list_exported_child_objects(path):
+			child = path.rstrip('/') + '/' + child
+			result.append(child)
+			result.extend(self._exported(child))
+		return result
+
+	def _call(self, servicename, path, method):
+		## calls the service over the bus, while the main loop of this process answers the call
+		result = []
+		self.client.call_async(servicename, path, 'com.victronenergy.BusItem', method, '', [],
+			reply_handler=result.append, error_handler=result.append, timeout=10)
+		context = GLib.MainContext.default()
+		while not result:
+			context.iteration(True)
+		if isinstance(result[0], Exception):
+			raise result[0]
+		return result[0]
+
+	def _check(self, compact):
+		servicename = 'com.victronenergy.test.nodes_%i' % compact
+		service = self._service(servicename, compact)
+		paths = make_paths(PATHS)
+		for i, path in enumerate(paths):
+			service.add_path(path, i)
+
+		# remove half, the other half keeps the nodes above them alive
+		rng = random.Random(1)
+		rng.shuffle(paths)
+		half = len(paths) // 2
+		for path in paths[:half]:
+			del service[path]
+		for path in paths[:half]:
+			self.assertNotIn(path, service)
+		for path in paths[half:]:
+			self.assertIn(path, service)
+		self.assertEqual(set(self._call(servicename, '/', 'GetItems')), set(paths[half:]))
+		if not compact:
+			self.assertEqual(set(self._exported()), with_nodes(paths[half:]))
+
+		for path in paths[half:]:
+			del service[path]
+		self.assertEqual(dict(self._call(servicename, '/', 'GetItems')), {})
+		if not compact:
+			self.assertEqual(self._exported(), [])
+
+	def test_objects(self):
+		self._check(False)
+
+	def test_compact(self):
+		self._check(True)
+
+	def test_readd(self):
+		## in compact mode a path added again replaces its value, and removing it removes the nodes above it
+		servicename = 'com.victronenergy.test.readd'
+		service = self._service(servicename, True)
+		service.add_path('/Ac/L1/Power', 1)
+		service.add_path('/Ac/L1/Power', 2)
+		self.assertEqual(service['/Ac/L1/Power'], 2)
+		self.assertEqual(self._call(servicename, '/Ac/L1/Power', 'GetValue'), 2)
+		del service['/Ac/L1/Power']
+		self.assertNotIn('/Ac/L1/Power', service)
+		self.assertEqual(dict(self._call(servicename, '/', 'GetItems')), {})
+		with self.assertRaises(dbus.exceptions.DBusException):
+			self._call(servicename, '/Ac/L1', 'GetValue')
+
+	def _check_get_items(self, compact):
+		## GetItems is only answered on /
+		servicename = 'com.victronenergy.test.getitems_%i' % compact
+		service = self._service(servicename, compact)
+		service.add_path('/Ac/L1/Power', 1)
+		service.add_path('/Ac/L2/Power', 2)
+		self.assertEqual(set(self._call(servicename, '/', 'GetItems')), {'/Ac/L1/Power', '/Ac/L2/Power'})
+		for path in ('/Ac', '/Ac/L1', '/Ac/L1/Power'):
+			with self.assertRaises(dbus.exceptions.DBusException) as context:
+				self._call(servicename, path, 'GetItems')
+			self.assertEqual(context.exception.get_dbus_name(), 'org.freedesktop.DBus.Error.UnknownMethod')
+
+	def test_get_items_objects(self):
+		self._check_get_items(False)
+
+	def test_get_items_compact(self):
+		self._check_get_items(True)
+
+if __name__ == '__main__':
+	unittest.main()
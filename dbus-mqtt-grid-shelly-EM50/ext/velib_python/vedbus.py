@@ -58,13 +58,31 @@ from ve_utils import wrap_dbus_value, unwrap_dbus_value
 
 # Export ourselves as a D-Bus service.
 class VeDbusService(object):
-	def __init__(self, servicename, bus=None):
+	## Constructor of VeDbusService
+	# @param autobatch	When True, values set with service[path] = value are collected during one
+	#					GLib main loop iteration and sent as a single ItemsChanged signal from an idle
+	#					callback, as if every write was done inside a 'with service as ctx' block.
+	# @param itemsignals	Only used together with autobatch. Set to False to suppress the per-item
+	#					PropertiesChanged signals, for services whose consumers only listen to the root.
+	# @param compact	When True, no dbus.service.Object is registered per path and per tree node. A
+	#					single fallback object on / dispatches GetValue, SetValue, GetText etc. by
+	#					object path, and the values are kept in slotted VeDbusCompactItem records.
+	def __init__(self, servicename, bus=None, autobatch=False, itemsignals=True, compact=False):
 		# dict containing the VeDbusItemExport objects, with their path as the key.
 		self._dbusobjects = {}
 		self._dbusnodes = {}
+		# number of paths below each tree node, so a node can be removed as soon as its last path is gone
+		self._nodechildren = defaultdict(int)
 		self._ratelimiters = []
 		self._dbusname = None
 
+		# pending changes of the current main loop iteration when autobatch is enabled
+		self._autobatch = autobatch
+		self._itemsignals = itemsignals
+		self._batchedchanges = {}
+		self._batchsource = None
+		self._compact = compact
+
 		# dict containing the onchange callbacks, for each object. Object path is the key
 		self._onchangecallbacks = {}
 
@@ -78,19 +96,27 @@ class VeDbusService(object):
 		self._dbusname = dbus.service.BusName(servicename, self._dbusconn, do_not_queue=True)
 
 		# Add the root item that will return all items as a tree
-		self._dbusnodes['/'] = VeDbusRootExport(self._dbusconn, '/', self)
+		if compact:
+			self._dbusnodes['/'] = VeDbusFallbackExport(self._dbusconn, self)
+		else:
+			self._dbusnodes['/'] = VeDbusRootExport(self._dbusconn, '/', self)
 
 		logging.info("registered ourselves on D-Bus as %s" % servicename)
 
 	# To force immediate deregistering of this dbus service and all its object paths, explicitly
 	# call __del__().
 	def __del__(self):
+		if self._batchsource is not None:
+			from gi.repository import GLib
+			GLib.source_remove(self._batchsource)
+			self._batchsource = None
 		for node in list(self._dbusnodes.values()):
 			node.__del__()
 		self._dbusnodes.clear()
 		for item in list(self._dbusobjects.values()):
-			item.__del__()
+			self._remove_item(item)
 		self._dbusobjects.clear()
+		self._nodechildren.clear()
 		if self._dbusname:
 			self._dbusname.__del__()  # Forces call to self._bus.release_name(self._name), see source code
 		self._dbusname = None
@@ -98,21 +124,36 @@ class VeDbusService(object):
 	# @param callbackonchange	function that will be called when this value is changed. First parameter will
 	#							be the path of the object, second the new value. This callback should return
 	#							True to accept the change, False to reject it.
+	# @param getvaluecallback	function that computes the value when it is read, with the path as parameter.
+	#							Used for GetValue, GetText, GetItems and service[path], so a value that is
+	#							expensive to compute is only computed when somebody asks for it. Values set
+	#							with service[path] = value are still sent as signals.
 	def add_path(self, path, value, description="", writeable=False,
-					onchangecallback=None, gettextcallback=None, valuetype=None):
+					onchangecallback=None, gettextcallback=None, valuetype=None, getvaluecallback=None):
 
 		if onchangecallback is not None:
 			self._onchangecallbacks[path] = onchangecallback
 
+		if self._compact:
+			# the fallback object on / serves all paths and tree nodes, nothing to register
+			if path not in self._dbusobjects:
+				for subPath in self._ancestors(path):
+					self._nodechildren[subPath] += 1
+			self._dbusobjects[path] = VeDbusCompactItem(
+				self, path, value, description, writeable, gettextcallback, valuetype, getvaluecallback)
+			logging.debug('added %s with start value %s. Writeable is %s' % (path, value, writeable))
+			return
+
 		item = VeDbusItemExport(
 				self._dbusconn, path, value, description, writeable,
-				self._value_changed, gettextcallback, deletecallback=self._item_deleted, valuetype=valuetype)
-
-		spl = path.split('/')
-		for i in range(2, len(spl)):
-			subPath = '/'.join(spl[:i])
-			if subPath not in self._dbusnodes and subPath not in self._dbusobjects:
-				self._dbusnodes[subPath] = VeDbusTreeExport(self._dbusconn, subPath, self)
+				self._value_changed, gettextcallback, deletecallback=self._item_deleted, valuetype=valuetype,
+				getvaluecallback=getvaluecallback)
+
+		if path not in self._dbusobjects:
+			for subPath in self._ancestors(path):
+				self._nodechildren[subPath] += 1
+				if subPath not in self._dbusnodes and subPath not in self._dbusobjects:
+					self._dbusnodes[subPath] = VeDbusTreeExport(self._dbusconn, subPath, self)
 		self._dbusobjects[path] = item
 		logging.debug('added %s with start value %s. Writeable is %s' % (path, value, writeable))
 
@@ -139,27 +180,78 @@ class VeDbusService(object):
 
 		return self._onchangecallbacks[path](path, newvalue)
 
+	# Returns the tree nodes above a path, for example /Ac and /Ac/L1 for /Ac/L1/Power. The root is left out.
+	@staticmethod
+	def _ancestors(path):
+		spl = path.split('/')
+		return ['/'.join(spl[:i]) for i in range(2, len(spl))]
+
+	# Only the nodes above the deleted path are touched: each one loses a child, and is removed
+	# when that was its last one.
 	def _item_deleted(self, path):
 		self._dbusobjects.pop(path)
-		for np in list(self._dbusnodes.keys()):
-			if np != '/':
-				for ip in self._dbusobjects:
-					if ip.startswith(np + '/'):
-						break
-				else:
-					self._dbusnodes[np].__del__()
-					self._dbusnodes.pop(np)
+		for np in self._ancestors(path):
+			self._nodechildren[np] -= 1
+			if self._nodechildren[np] > 0:
+				continue
+			del self._nodechildren[np]
+			node = self._dbusnodes.pop(np, None)
+			if node is not None:
+				node.__del__()
 
 	def __getitem__(self, path):
 		return self._dbusobjects[path].local_get_value()
 
 	def __setitem__(self, path, newvalue):
-		self._dbusobjects[path].local_set_value(newvalue)
+		if not self._autobatch:
+			self._dbusobjects[path].local_set_value(newvalue)
+			return
+
+		item = self._dbusobjects[path]
+		c = item._local_set_value(newvalue)
+		if c is None:
+			return
+		if self._itemsignals:
+			item.PropertiesChanged(c)
+		self._batchedchanges[path] = c
+		if self._batchsource is None:
+			# imported here, so that vedbus can still be used without GLib when autobatch is off
+			from gi.repository import GLib
+			self._batchsource = GLib.idle_add(self._batch_idle)
+
+	# Idle callback that sends all changes collected with autobatch in one ItemsChanged signal.
+	def _batch_idle(self):
+		self._batchsource = None
+		self._send_batch()
+		return False
+
+	def _send_batch(self):
+		changes, self._batchedchanges = self._batchedchanges, {}
+		# paths deleted in the meantime must not show up in the signal
+		changes = {p: c for p, c in changes.items() if p in self._dbusobjects}
+		if changes:
+			self._dbusnodes['/'].ItemsChanged(changes)
+
+	## Sends the changes collected with autobatch right away, instead of waiting for the idle callback.
+	def flush_batch(self):
+		if self._batchsource is not None:
+			from gi.repository import GLib
+			GLib.source_remove(self._batchsource)
+			self._batchsource = None
+		self._send_batch()
 
 	def __delitem__(self, path):
-		self._dbusobjects[path].__del__()  # Invalidates and then removes the object path
+		self._remove_item(self._dbusobjects[path])  # Invalidates and then removes the object path
 		assert path not in self._dbusobjects
 
+	# A VeDbusCompactItem is removed explicitly, since it is no dbus.service.Object and its
+	# removal must not depend on the garbage collector.
+	def _remove_item(self, item):
+		if self._compact:
+			item.remove()
+		else:
+			item.__del__()
+
 	def __contains__(self, path):
 		return path in self._dbusobjects
 
@@ -464,10 +556,11 @@ class VeDbusItemExport(dbus.service.Object):
 	#					  value. This callback should return True to accept the change, False to reject it.
 	def __init__(self, bus, objectPath, value=None, description=None, writeable=False,
 					onchangecallback=None, gettextcallback=None, deletecallback=None,
-					valuetype=None):
+					valuetype=None, getvaluecallback=None):
 		dbus.service.Object.__init__(self, bus, objectPath)
 		self._onchangecallback = onchangecallback
 		self._gettextcallback = gettextcallback
+		self._getvaluecallback = getvaluecallback
 		self._value = value
 		self._description = description
 		self._writeable = writeable
@@ -511,6 +604,8 @@ class VeDbusItemExport(dbus.service.Object):
 		}
 
 	def local_get_value(self):
+		if self._getvaluecallback is not None:
+			return self._getvaluecallback(self.__dbus_object_path__)
 		return self._value
 
 	# ==== ALL FUNCTIONS BELOW THIS LINE WILL BE CALLED BY OTHER PROCESSES OVER THE DBUS ====
@@ -564,29 +659,30 @@ class VeDbusItemExport(dbus.service.Object):
 	# @return the value when valid, and otherwise an empty array
 	@dbus.service.method('com.victronenergy.BusItem', out_signature='v')
 	def GetValue(self):
-		return wrap_dbus_value(self._value)
+		return wrap_dbus_value(self.local_get_value())
 
 	## Dbus exported method GetText
 	# Returns the value as string of the dbus-object-path.
 	# @return text A text-value. '---' when local value is invalid
 	@dbus.service.method('com.victronenergy.BusItem', out_signature='s')
 	def GetText(self):
-		if self._value is None:
+		value = self.local_get_value()
+		if value is None:
 			return '---'
 
 		# Default conversion from dbus.Byte will get you a character (so 'T' instead of '84'), so we
 		# have to convert to int first. Note that if a dbus.Byte turns up here, it must have come from
 		# the application itself, as all data from the D-Bus should have been unwrapped by now.
-		if self._gettextcallback is None and type(self._value) == dbus.Byte:
-			return str(int(self._value))
+		if self._gettextcallback is None and type(value) == dbus.Byte:
+			return str(int(value))
 
 		if self._gettextcallback is None and self.__dbus_object_path__ == '/ProductId':
-			return "0x%X" % self._value
+			return "0x%X" % value
 
 		if self._gettextcallback is None:
-			return str(self._value)
+			return str(value)
 
-		return self._gettextcallback(self.__dbus_object_path__, self._value)
+		return self._gettextcallback(self.__dbus_object_path__, value)
 
 	## The signal that indicates that the value has changed.
 	# Other processes connected to this BusItem object will have subscribed to the
@@ -595,6 +691,182 @@ class VeDbusItemExport(dbus.service.Object):
 	def PropertiesChanged(self, changes):
 		pass
 
+## Value record used by VeDbusService in compact mode, instead of a VeDbusItemExport.
+# It offers the same local interface (local_get_value, local_set_value, GetText), but is not a
+# dbus.service.Object: the D-Bus calls are handled by VeDbusFallbackExport. It has no finalizer,
+# a record replaced by add_path on the same path is just dropped, and remove() takes it off the service.
+class VeDbusCompactItem(object):
+	__slots__ = ('_service', '_path', '_value', '_description', '_writeable', '_gettextcallback', '_type',
+		'_getvaluecallback')
+
+	def __init__(self, service, path, value=None, description=None, writeable=False,
+					gettextcallback=None, valuetype=None, getvaluecallback=None):
+		self._service = service
+		self._path = path
+		self._value = value
+		self._description = description
+		self._writeable = writeable
+		self._gettextcallback = gettextcallback
+		self._type = valuetype
+		self._getvaluecallback = getvaluecallback
+
+	# Removes the item from the service. Safe to call more than once.
+	def remove(self):
+		service = self._service
+		if service is None:
+			return
+		self._service = None
+		service._item_deleted(self._path)
+		logging.debug("VeDbusCompactItem %s has been removed" % self._path)
+
+	def local_set_value(self, newvalue):
+		changes = self._local_set_value(newvalue)
+		if changes is not None:
+			self.PropertiesChanged(changes)
+
+	# Sends the signal through the fallback object, as if it came from our own object path
+	def PropertiesChanged(self, changes):
+		self._service._dbusnodes['/'].PropertiesChanged(changes, rel_path=self._path[1:])
+
+	def _local_set_value(self, newvalue):
+		if self._value == newvalue:
+			return None
+
+		self._value = newvalue
+		return {
+			'Value': wrap_dbus_value(newvalue),
+			'Text': self.GetText()
+		}
+
+	def local_get_value(self):
+		if self._getvaluecallback is not None:
+			return self._getvaluecallback(self._path)
+		return self._value
+
+	# Same rules as VeDbusItemExport.SetValue. Returns 0 when OK, 1 or 2 when NOT OK.
+	def set_value(self, newvalue):
+		if not self._writeable:
+			return 1
+
+		newvalue = unwrap_dbus_value(newvalue)
+		if self._type is not None and newvalue is not None:
+			try:
+				newvalue = self._type(newvalue)
+			except (ValueError, TypeError):
+				return 1
+
+		if newvalue == self._value:
+			return 0
+
+		if self._service._value_changed(self._path, newvalue):
+			self.local_set_value(newvalue)
+			return 0
+
+		return 2
+
+	def GetText(self):
+		value = self.local_get_value()
+		if value is None:
+			return '---'
+
+		if self._gettextcallback is None and type(value) == dbus.Byte:
+			return str(int(value))
+
+		if self._gettextcallback is None and self._path == '/ProductId':
+			return "0x%X" % value
+
+		if self._gettextcallback is None:
+			return str(value)
+
+		return self._gettextcallback(self._path, value)
+
+## Single object that serves all paths of a VeDbusService in compact mode.
+# Registered as fallback on /, so dbus-python dispatches every object path of the service to it. Calls on
+# a path that holds a value are answered from the VeDbusCompactItem, calls on a tree node return the
+# values below it, the same as VeDbusTreeExport does.
+class VeDbusFallbackExport(dbus.service.FallbackObject):
+	def __init__(self, bus, service):
+		dbus.service.FallbackObject.__init__(self, bus, '/')
+		self._service = service
+		logging.debug("VeDbusFallbackExport has been created")
+
+	def __del__(self):
+		if len(self._locations) == 0:
+			return
+		self.remove_from_connection()
+		logging.debug("VeDbusFallbackExport has been removed")
+
+	def _get_item(self, path):
+		item = self._service._dbusobjects.get(path)
+		if item is None:
+			raise dbus.exceptions.DBusException(
+				'No such object path: %s' % path, name='org.freedesktop.DBus.Error.UnknownObject')
+		return item
+
+	def _get_value_handler(self, path, get_text=False):
+		r = {}
+		px = path
+		if not px.endswith('/'):
+			px += '/'
+		for p, item in self._service._dbusobjects.items():
+			if p.startswith(px):
+				v = item.GetText() if get_text else wrap_dbus_value(item.local_get_value())
+				r[p[len(px):]] = v
+		if not r and path != '/':
+			raise dbus.exceptions.DBusException(
+				'No such object path: %s' % path, name='org.freedesktop.DBus.Error.UnknownObject')
+		return r
+
+	@dbus.service.method('com.victronenergy.BusItem', out_signature='v', path_keyword='path')
+	def GetValue(self, path='/'):
+		item = self._service._dbusobjects.get(path)
+		if item is not None:
+			return wrap_dbus_value(item.local_get_value())
+		value = self._get_value_handler(path)
+		return dbus.Dictionary(value, signature=dbus.Signature('sv'), variant_level=1)
+
+	# No out_signature, so dbus-python takes it from the returned value: a plain string for value paths
+	# like VeDbusItemExport, and a variant with the texts below a tree node like VeDbusTreeExport.
+	@dbus.service.method('com.victronenergy.BusItem', path_keyword='path')
+	def GetText(self, path='/'):
+		item = self._service._dbusobjects.get(path)
+		if item is not None:
+			return dbus.String(item.GetText())
+		return dbus.Dictionary(self._get_value_handler(path, True), signature=dbus.Signature('sv'), variant_level=1)
+
+	@dbus.service.method('com.victronenergy.BusItem', in_signature='v', out_signature='i', path_keyword='path')
+	def SetValue(self, newvalue, path='/'):
+		return self._get_item(path).set_value(newvalue)
+
+	@dbus.service.method('com.victronenergy.BusItem', in_signature='si', out_signature='s', path_keyword='path')
+	def GetDescription(self, language, length, path='/'):
+		description = self._get_item(path)._description
+		return description if description is not None else 'No description given'
+
+	# Like VeDbusRootExport, only / answers with all items. Below it there is no GetItems, as on the
+	# objects of the tree nodes and values in the export with one object per path.
+	@dbus.service.method('com.victronenergy.BusItem', out_signature='a{sa{sv}}', path_keyword='path')
+	def GetItems(self, path='/'):
+		if path != '/':
+			raise dbus.exceptions.DBusException(
+				'No method GetItems on object path: %s' % path, name='org.freedesktop.DBus.Error.UnknownMethod')
+		return {
+			path: {
+				'Value': wrap_dbus_value(item.local_get_value()),
+				'Text': item.GetText() }
+			for path, item in self._service._dbusobjects.items()
+		}
+
+	@dbus.service.signal('com.victronenergy.BusItem', signature='a{sa{sv}}')
+	def ItemsChanged(self, changes):
+		pass
+
+	# Emitted from the object path of the item. A fallback object takes the path relative to where
+	# it is registered, and as that is /, the item path is passed without the leading slash.
+	@dbus.service.signal('com.victronenergy.BusItem', signature='a{sv}', rel_path_keyword='rel_path')
+	def PropertiesChanged(self, changes, rel_path=None):
+		pass
+
 ## This class behaves like a regular reference to a class method (eg. self.foo), but keeps a weak reference
 ## to the object which method is to be called.
 ## Use this object to break circular references.
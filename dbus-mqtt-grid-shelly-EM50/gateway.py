@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+
+# Gateway for sites with many meters: one process owns the MQTT connection and subscription and
+# forwards the raw payloads of each meter over its own pipe to a worker process, which runs this
+# driver with "source = pipe" and owns the D-Bus service of the meter. So the JSON decoding and the
+# D-Bus export of the meters run in parallel on all CPU cores. With "workers = N" the meters are
+# distributed over N worker processes, each of them loads the driver once per meter.
+#
+# The pipes are never written blocking: while a worker does not keep up, the frames of a meter
+# wait in a buffer of the gateway, further ones are dropped and counted.
+#
+# The meters are configured in [DEVICE:<name>] sections of the config.ini, see the
+# config.sample.ini. Every section overrides the [DEFAULT] and [MQTT] settings for its meter.
+#
+# Usage:
+#   python gateway.py [config.ini]
+#   python gateway.py --benchmark [maximum number of workers] [number of meters]
+
+import configparser
+import fcntl
+import json
+import logging
+import os
+import select
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import termios
+import threading
+from time import monotonic, sleep
+
+from brokers import BrokerPool, client_settings, configure_client, parse_brokers
+
+# topic length, payload length
+FRAME = struct.Struct("<HI")
+
+DRIVER = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "dbus-mqtt-grid-shelly-EM50.py"
+)
+
+
+# yields (topic, payload) of the frames read from a binary file, until the pipe is closed
+def read_frames(file):
+    header = bytearray(FRAME.size)
+    while file.readinto(header) == FRAME.size:
+        topic_length, payload_length = FRAME.unpack(header)
+        topic = file.read(topic_length)
+        payload = file.read(payload_length)
+        if len(payload) != payload_length:
+            return
+        yield topic.decode("utf-8"), payload
+
+
+def cpu_seconds(pid):
+    # user and system time of a process, only available on Linux
+    try:
+        with open("/proc/%i/stat" % pid) as file:
+            fields = file.read().rpartition(")")[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+
+class Meter:
+    # one [DEVICE:<name>] section: the pipe to its worker process and the counters of its messages
+
+    def __init__(self, name, config_path, topics, buffer_size):
+        self.name = name
+        self.config_path = config_path
+        self.topics = topics
+        self.buffer_size = buffer_size
+        # the gateway keeps the read end open, so a restarted worker continues with the frames
+        # still in the pipe
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.write_fd, False)
+        self.messages = 0
+        self.bytes = 0
+        self.dropped = 0
+        self._pending = bytearray()  # frames that did not fit into the pipe
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return len(self._pending) > 0
+
+    # called from the paho thread, never blocks: while the worker does not keep up, the frames
+    # wait in a buffer of buffer_size bytes, further ones are dropped
+    def send(self, topic, payload):
+        header = FRAME.pack(len(topic), len(payload))
+        size = len(header) + len(topic) + len(payload)
+        with self._lock:
+            if self._pending:
+                self._flush()
+            written = 0
+            if not self._pending:
+                try:
+                    # one system call per message, without joining topic and payload first
+                    written = os.writev(self.write_fd, (header, topic, payload))
+                except BlockingIOError:
+                    pass
+            if written < size:
+                # the rest of a partly written frame is always kept, else the stream would break
+                if written == 0 and len(self._pending) + size > self.buffer_size:
+                    self.dropped += 1
+                    return
+                self._pending += b"".join((header, topic, payload))[written:]
+            self.messages += 1
+            self.bytes += len(payload)
+
+    # called from the main thread, when the pipe is writable again
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        try:
+            written = os.write(self.write_fd, self._pending)
+        except BlockingIOError:
+            return
+        del self._pending[:written]
+
+    def close(self):
+        os.close(self.write_fd)
+        os.close(self.read_fd)
+
+
+class Worker:
+    # one process, which runs the driver for each of its meters
+
+    def __init__(self, name, meters):
+        self.name = name
+        self.meters = meters
+        self.process = None
+        self.restarts = -1
+        self._last = (monotonic(), 0, 0, 0.0)
+
+    @property
+    def messages(self):
+        return sum(meter.messages for meter in self.meters)
+
+    @property
+    def bytes(self):
+        return sum(meter.bytes for meter in self.meters)
+
+    @property
+    def dropped(self):
+        return sum(meter.dropped for meter in self.meters)
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.realpath(__file__), "--worker"]
+            + [meter.config_path for meter in self.meters],
+            pass_fds=[meter.read_fd for meter in self.meters],
+        )
+        self.restarts += 1
+        logging.info(
+            "Gateway: Started worker %s with PID %i for %s"
+            % (
+                self.name,
+                self.process.pid,
+                ", ".join(
+                    "%s (%s)" % (meter.name, ", ".join(sorted(meter.topics)))
+                    for meter in self.meters
+                ),
+            )
+        )
+
+    def stop(self):
+        # the worker stops, when its pipes are closed
+        for meter in self.meters:
+            meter.close()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(5)
+
+    # messages per second, kB per second and CPU usage in % since the last call
+    def load(self):
+        now = monotonic()
+        cpu = cpu_seconds(self.process.pid)
+        messages, size = self.messages, self.bytes
+        last_time, last_messages, last_size, last_cpu = self._last
+        seconds = max(now - last_time, 1e-6)
+        self._last = (now, messages, size, cpu)
+        return (
+            (messages - last_messages) / seconds,
+            (size - last_size) / seconds / 1024,
+            max(cpu - last_cpu, 0) / seconds * 100,
+        )
+
+
+def _topics(section):
+    topic_instant = section["topic_instant"]
+    if section.get("mode", "status") == "events":
+        return {topic_instant.partition("/status/")[0] + "/events/rpc"}
+    return {topic_instant, section["topic_energy"]}
+
+
+# writes a config.ini per device, with the settings of the device section and "source = pipe"
+def write_device_configs(path, directory):
+    config = configparser.ConfigParser()
+    config.read(path)
+    gateway_config = config["GATEWAY"] if config.has_section("GATEWAY") else config["DEFAULT"]
+    buffer_size = int(gateway_config.get("buffer_kb", "256")) * 1024
+    # a second time without inheriting the DEFAULT section, to copy each section as written
+    raw = configparser.ConfigParser(interpolation=None, default_section="\x00")
+    raw.read(path)
+
+    devices = [section for section in raw.sections() if section.startswith("DEVICE:")]
+    if not devices:
+        raise ValueError('The "%s" has no [DEVICE:<name>] sections' % path)
+
+    meters = []
+    instances = set()
+    for device in devices:
+        name = device.partition(":")[2]
+        child = configparser.ConfigParser(interpolation=None)
+        for section in raw.sections():
+            if section == "GATEWAY" or section.startswith("DEVICE:"):
+                continue
+            if section == "DEFAULT":
+                child["DEFAULT"].update(raw["DEFAULT"])
+            else:
+                child[section] = dict(raw[section])
+        for key, value in raw[device].items():
+            if key.startswith("/"):
+                # mapping lines override the [MAPPING] section for this meter
+                if not child.has_section("MAPPING"):
+                    child.add_section("MAPPING")
+                child["MAPPING"][key] = value
+            elif child.has_section("MQTT") and key in raw["MQTT"]:
+                child["MQTT"][key] = value
+            else:
+                child["DEFAULT"][key] = value
+        instance = config[device]["device_instance"]
+        if instance in instances:
+            raise ValueError(
+                'The device_instance %s of [%s] is used more than once' % (instance, device)
+            )
+        instances.add(instance)
+
+        merged = dict(config["MQTT"])
+        merged.update(config[device])
+        meter = Meter(
+            name, os.path.join(directory, "config_%s.ini" % name), _topics(merged), buffer_size
+        )
+        child["DEFAULT"]["source"] = "pipe"
+        child["DEFAULT"]["pipe_fd"] = str(meter.read_fd)
+        with open(meter.config_path, "w") as file:
+            child.write(file)
+        meters.append(meter)
+    return config, meters
+
+
+# distributes the meters round-robin over count worker processes, 0 = one process per meter
+def assign_workers(meters, count):
+    if count <= 0 or count >= len(meters):
+        return [Worker(meter.name, [meter]) for meter in meters]
+    return [Worker(str(index + 1), meters[index::count]) for index in range(count)]
+
+
+# the raw payloads are routed by topic, without decoding them. Returns the routes by topic and
+# the on_message callback for the paho client
+def create_router(meters):
+    routes = {}
+    for meter in meters:
+        for topic in meter.topics:
+            if topic in routes:
+                raise ValueError(
+                    'The topic "%s" is used by [DEVICE:%s] and [DEVICE:%s]'
+                    % (topic, routes[topic][0].name, meter.name)
+                )
+            routes[topic] = (meter, topic.encode("utf-8"))
+
+    def on_message(client, userdata, msg):
+        route = routes.get(msg.topic)
+        if route is not None:
+            route[0].send(route[1], msg.payload)
+
+    return routes, on_message
+
+
+def run(path):
+    import paho.mqtt.client as mqtt
+
+    directory = tempfile.mkdtemp(prefix="dbus-mqtt-grid-gateway-")
+    config, meters = write_device_configs(path, directory)
+    logging.getLogger().setLevel(config["DEFAULT"].get("logging", "WARNING").upper())
+    gateway_config = config["GATEWAY"] if config.has_section("GATEWAY") else config["DEFAULT"]
+    report_interval = float(gateway_config.get("report_interval", "60"))
+    workers = assign_workers(meters, int(gateway_config.get("workers", "0")))
+    routes, on_message = create_router(meters)
+    for worker in workers:
+        worker.start()
+
+    mqtt_config = config["MQTT"]
+    # the same brokers and failover as the driver
+    broker_pool = BrokerPool(
+        parse_brokers(mqtt_config["broker_address"], int(mqtt_config["broker_port"])),
+        mqtt_config.get("broker_selection", "ordered"),
+        float(mqtt_config.get("broker_connect_timeout", "5")),
+    )
+    fallback_interval = int(mqtt_config.get("broker_fallback_interval", "60"))
+
+    def on_connect(client, userdata, flags, rc):
+        if rc == 0:
+            logging.info("Gateway: Connected to the MQTT broker %s" % broker_pool.current)
+            broker_pool.connected()
+            client.subscribe([(topic, 0) for topic in routes])
+        else:
+            logging.error("Gateway: Connecting to the MQTT broker failed with code %i" % rc)
+
+    def on_disconnect(client, userdata, rc):
+        logging.warning("Gateway: Disconnected from the MQTT broker %s" % broker_pool.current)
+        broker_pool.disconnected()
+        broker_pool.failover(client)
+
+    def on_connect_fail(client, userdata):
+        broker_pool.current.failures += 1
+        broker_pool.failover(client)
+
+    client = mqtt.Client(client_id="MqttGridGateway_" + str(os.getpid()))
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_connect_fail = on_connect_fail
+    client.on_message = on_message
+    # the same TLS and login settings as the driver
+    configure_client(client, *client_settings(mqtt_config))
+    client.reconnect_delay_set(min_delay=1, max_delay=15)
+    try:
+        broker_pool.connect(client)
+    except Exception:
+        # paho keeps retrying in its thread, on_connect_fail fails over to the next broker
+        broker_pool.failover(client)
+    client.loop_start()
+
+    def stop(signum, frame):
+        raise SystemExit()
+
+    signal.signal(signal.SIGTERM, stop)
+    next_report = monotonic() + report_interval
+    # switch back to the first broker of the list, as soon as it answers again
+    if len(broker_pool.brokers) > 1 and fallback_interval > 0:
+        next_fallback = monotonic() + fallback_interval
+    else:
+        next_fallback = float("inf")
+    try:
+        while True:
+            # the frames buffered while a worker did not keep up are written as soon as it reads
+            # again, the paho thread would only write them with the next message of the meter
+            timeout = min(max(min(next_report, next_fallback) - monotonic(), 0), 0.1)
+            pending = {meter.write_fd: meter for meter in meters if meter.pending}
+            if pending:
+                for fd in select.select([], list(pending), [], timeout)[1]:
+                    pending[fd].flush()
+            else:
+                sleep(timeout)
+            if monotonic() >= next_fallback:
+                next_fallback += fallback_interval
+                broker_pool.fallback(client)
+            if monotonic() < next_report:
+                continue
+            next_report += report_interval
+            for worker in workers:
+                messages, kbytes, cpu = worker.load()
+                logging.info(
+                    "Gateway: Worker %s: %.1f messages/s, %.1f kB/s, %.1f %% CPU, %i dropped, %i restarts"
+                    % (worker.name, messages, kbytes, cpu, worker.dropped, worker.restarts)
+                )
+                if worker.process.poll() is not None:
+                    logging.warning(
+                        "Gateway: Worker %s exited with code %i, restarting it"
+                        % (worker.name, worker.process.returncode)
+                    )
+                    worker.start()
+    finally:
+        client.loop_stop()
+        for worker in workers:
+            worker.stop()
+
+
+# a worker process: loads the driver once per meter as its own module, so every meter keeps its
+# own settings, values and D-Bus service, while all meters share the main loop of the process.
+# A meter that stops the driver, e.g. after its timeout, restarts the whole worker
+def run_worker(config_paths):
+    import importlib.util
+
+    from gi.repository import GLib  # pyright: ignore[reportMissingImports]
+
+    meters = []
+    for index, config_path in enumerate(config_paths):
+        # the driver reads the path of its config.ini from the command line
+        sys.argv = [DRIVER, config_path]
+        spec = importlib.util.spec_from_file_location("dbus_mqtt_grid_meter_%i" % index, DRIVER)
+        meter = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(meter)
+        meters.append(meter)
+
+    for meter in meters:
+        meter.start()
+    for meter in meters:
+        meter.wait_for_first_values()
+    for meter in meters:
+        meter.start_publishing()
+    GLib.MainLoop().run()
+
+
+def _unread(fd):
+    # bytes in a pipe, that its reader did not read yet
+    return struct.unpack("i", fcntl.ioctl(fd, termios.FIONREAD, b"\0\0\0\0"))[0]
+
+
+def _write_benchmark_config(directory, meters):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(DRIVER), "config.sample.ini"))
+    # the values are kept in memory, so only the decoding, mapping and publishing is measured
+    config["DEFAULT"]["output"] = "memory"
+    config["DEFAULT"]["timeout"] = "0"
+    config["DEFAULT"]["logging"] = "WARNING"
+    for index in range(meters):
+        config["DEVICE:bench%i" % index] = {
+            "device_instance": str(200 + index),
+            "topic_instant": "mqttgridbenchmark-%i/status/em1:0" % index,
+            "topic_energy": "mqttgridbenchmark-%i/status/em1data:0" % index,
+        }
+    path = os.path.join(directory, "config.ini")
+    with open(path, "w") as file:
+        config.write(file)
+    return path
+
+
+# pushes the messages through the on_message callback of the gateway to real worker processes,
+# which run the driver with "output = memory" for each meter. The same meters are distributed
+# over 1 to max_workers workers. The rate is measured until the workers read all frames. The
+# gateway waits while a pipe is full, so nothing is dropped unless buffer_kb is too small
+def benchmark(max_workers, meters=None, messages=100000):
+    import paho.mqtt.client as mqtt
+
+    meters = meters or max_workers
+    logging.getLogger().setLevel(logging.WARNING)
+    payload = json.dumps(
+        {
+            "id": 0,
+            "current": 2.054,
+            "voltage": 231.4,
+            "act_power": 468.7,
+            "aprt_power": 475.3,
+            "pf": 0.99,
+            "freq": 50.0,
+            "calibration": "factory",
+        }
+    ).encode()
+
+    print("%i meters, %i messages" % (meters, messages))
+    print("workers  messages/s  speedup  gateway CPU %  worker CPU %  dropped")
+    base = None
+    for count in range(1, max_workers + 1):
+        with tempfile.TemporaryDirectory(prefix="dbus-mqtt-grid-gateway-") as directory:
+            _, device_meters = write_device_configs(
+                _write_benchmark_config(directory, meters), directory
+            )
+            workers = assign_workers(device_meters, count)
+            routes, on_message = create_router(device_meters)
+            for worker in workers:
+                worker.start()
+
+            incoming = []
+            for topic in routes:
+                if "/status/em1:" in topic:
+                    message = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+                    message.payload = payload
+                    incoming.append(message)
+
+            def push(total):
+                for index in range(total):
+                    on_message(None, None, incoming[index % len(incoming)])
+                    if index % 100 == 99:
+                        _wait(device_meters, workers, drained=False)
+                _wait(device_meters, workers, drained=True)
+
+            # until all workers have loaded the driver and receive the messages
+            push(len(incoming) * 100)
+            cpu_start = [cpu_seconds(worker.process.pid) for worker in workers]
+            gateway_start = cpu_seconds(os.getpid())
+            time_start = monotonic()
+            push(messages)
+            elapsed = monotonic() - time_start
+            gateway_cpu = cpu_seconds(os.getpid()) - gateway_start
+            worker_cpu = sum(
+                cpu_seconds(worker.process.pid) - start
+                for worker, start in zip(workers, cpu_start)
+            )
+            dropped = sum(worker.dropped for worker in workers)
+            for worker in workers:
+                worker.stop()
+
+        rate = messages / elapsed
+        base = base or rate
+        print(
+            "%7i  %10.0f  %7.2f  %13.1f  %12.1f  %7i"
+            % (
+                len(workers),
+                rate,
+                rate / base,
+                gateway_cpu / elapsed * 100,
+                worker_cpu / elapsed / len(workers) * 100,
+                dropped,
+            )
+        )
+
+
+# waits until the buffered frames are written to the pipes, and with drained until the workers
+# also read them
+def _wait(meters, workers, drained):
+    while True:
+        pending = {meter.write_fd: meter for meter in meters if meter.pending}
+        if not pending and not (drained and any(_unread(meter.read_fd) for meter in meters)):
+            return
+        for worker in workers:
+            if worker.process.poll() is not None:
+                raise RuntimeError(
+                    "Worker %s exited with code %i" % (worker.name, worker.process.returncode)
+                )
+        if pending:
+            for fd in select.select([], list(pending), [], 0.1)[1]:
+                pending[fd].flush()
+        else:
+            sleep(0.001)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        # the logging is set up by the driver
+        run_worker(sys.argv[2:])
+        sys.exit()
+
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        benchmark(
+            int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count(),
+            int(sys.argv[3]) if len(sys.argv) > 3 else None,
+        )
+    else:
+        run(
+            sys.argv[1]
+            if len(sys.argv) > 1
+            else os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.ini")
+        )
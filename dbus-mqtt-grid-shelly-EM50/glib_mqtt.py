@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+# Runs the network loop of a paho MQTT client in the GLib main loop instead of its own thread.
+# The socket is watched with GLib.io_add_watch, so the messages are received, decoded and
+# published in the same thread, without switching threads for every message.
+#
+# paho only reconnects by itself in its own thread, so the reconnect with an increasing delay
+# is done here. Connecting (probing the brokers, the TCP connect and the TLS handshake) runs in
+# a short-lived thread, so the main loop keeps serving D-Bus. The main loop only takes over the
+# socket, when the connect thread is done.
+
+import logging
+import threading
+
+from gi.repository import GLib  # pyright: ignore[reportMissingImports]
+
+
+class GLibMqttLoop:
+    # connect: function(client), which connects the client in the connect thread and raises on
+    # failures, by default client.reconnect()
+    def __init__(self, client, connect=None, min_delay=1, max_delay=15):
+        self._client = client
+        self._connect = connect if connect is not None else lambda client: client.reconnect()
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._delay = min_delay
+        self._running = False
+        self._connecting = False
+        self._sock = None
+        self._tls = False
+        self._read_source = None
+        self._write_source = None
+        self._misc_source = None
+        self._reconnect_source = None
+
+        # the socket callbacks are also called from the connect thread, they are ignored there
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    # like loop_start() of paho, connects at once if the client is not connected yet
+    def start(self):
+        self._running = True
+        if self._misc_source is None:
+            # keepalive pings and the detection of a dead connection
+            self._misc_source = GLib.timeout_add_seconds(1, self._misc)
+        if self._client.socket() is None and not self._connecting:
+            self._connect_async(self._connect)
+
+    # like loop_stop() of paho, the connection stays open but is not reconnected anymore
+    def stop(self):
+        self._running = False
+        for source in (self._misc_source, self._reconnect_source):
+            if source is not None:
+                GLib.source_remove(source)
+        self._misc_source = None
+        self._reconnect_source = None
+
+    # closes the connection and connects again in the connect thread, with connect instead of
+    # the function of the constructor, e.g. to switch to another broker. Usable with idle_add
+    def reconnect(self, connect=None):
+        if not self._connecting:
+            if self._reconnect_source is not None:
+                GLib.source_remove(self._reconnect_source)
+                self._reconnect_source = None
+            self._connect_async(connect if connect is not None else self._connect)
+        return False
+
+    def _watch(self, sock):
+        self._sock = sock
+        self._tls = hasattr(sock, "pending")
+        self._read_source = GLib.io_add_watch(
+            sock.fileno(),
+            GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_PRI | GLib.IO_ERR | GLib.IO_HUP,
+            self._read,
+            sock,
+        )
+
+    def _unwatch(self):
+        for source in (self._read_source, self._write_source):
+            if source is not None:
+                GLib.source_remove(source)
+        self._read_source = None
+        self._write_source = None
+        self._sock = None
+
+    def _on_socket_open(self, client, userdata, sock):
+        if not self._connecting:
+            self._watch(sock)
+
+    def _on_socket_close(self, client, userdata, sock):
+        if self._connecting:
+            return
+        self._unwatch()
+        if self._running:
+            self._schedule_reconnect()
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        if self._write_source is None and not self._connecting:
+            self._write_source = GLib.io_add_watch(
+                sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_OUT, self._write, sock
+            )
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        if self._write_source is not None:
+            GLib.source_remove(self._write_source)
+            self._write_source = None
+
+    def _read(self, fd, condition, sock):
+        self._client.loop_read()
+        # with TLS, the rest of a record is already read from the socket and decrypted, so the
+        # socket does not signal it anymore. paho only reads one packet per call
+        while self._tls and self._sock is sock and sock.pending():
+            self._client.loop_read()
+        # the socket was closed and replaced by a new one while reading
+        return self._sock is sock
+
+    def _write(self, fd, condition, sock):
+        self._client.loop_write()
+        return self._sock is sock and self._write_source is not None
+
+    def _misc(self):
+        # the client is not touched, while the connect thread uses it
+        if self._connecting:
+            return True
+        self._client.loop_misc()
+        if self._client.is_connected():
+            self._delay = self._min_delay
+        return True
+
+    def _schedule_reconnect(self):
+        if self._reconnect_source is None:
+            logging.info("MQTT client: Reconnecting in %i seconds" % self._delay)
+            self._reconnect_source = GLib.timeout_add_seconds(self._delay, self._reconnect)
+            self._delay = min(self._delay * 2, self._max_delay)
+
+    def _reconnect(self):
+        self._reconnect_source = None
+        self._connect_async(self._connect)
+        return False
+
+    def _connect_async(self, connect):
+        # the old socket is closed by paho in the connect thread, it must not be watched anymore
+        self._unwatch()
+        self._connecting = True
+        threading.Thread(target=self._connect_thread, args=(connect,), daemon=True).start()
+
+    def _connect_thread(self, connect):
+        error = None
+        try:
+            connect(self._client)
+        except Exception as err:
+            error = err
+        GLib.idle_add(self._connected, error)
+
+    # back in the main loop: takes over the socket of the new connection
+    def _connected(self, error):
+        self._connecting = False
+        sock = self._client.socket()
+        if error is not None:
+            logging.error("MQTT client: Reconnecting failed: %s" % repr(error))
+        if sock is not None:
+            self._watch(sock)
+            # the CONNECT packet, if it was not sent completely in the connect thread
+            if self._client.want_write():
+                self._on_socket_register_write(self._client, None, sock)
+        elif self._running:
+            self._schedule_reconnect()
+        return False
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+# Exports the published measurements as InfluxDB line protocol, for InfluxDB, VictoriaMetrics or
+# Telegraf, without a second MQTT subscriber that decodes the payloads again.
+#
+# add() formats one line and appends it to a bounded buffer, it never waits for the target. A
+# background thread writes the buffered lines in batches every flush interval. If the target
+# is slower than the meter, the oldest lines are dropped and counted.
+#
+# Targets:
+#   /path/to/file.lp            appended to a file
+#   udp://host:8089             UDP datagrams of at most 1400 bytes
+#   unix:///run/telegraf.sock   UNIX stream socket
+#   unixgram:///run/x.sock      UNIX datagram socket
+
+import logging
+import math
+import socket
+import threading
+from collections import deque
+
+FIELDS = ("power", "current", "voltage", "frequency", "pf", "forward", "reverse")
+
+# datagrams larger than the MTU would be fragmented
+MAX_DATAGRAM = 1400
+
+
+def _escape(value, characters):
+    value = str(value).replace("\\", "\\\\")
+    for character in characters:
+        value = value.replace(character, "\\" + character)
+    return value
+
+
+class LineProtocolExporter:
+    def __init__(
+        self, target, measurement, tags, flush_interval=1.0, batch_size=500, buffer_size=10000
+    ):
+        self.target = target
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # measurement and tags are the same for every line
+        self._prefix = (
+            _escape(measurement, ", ")
+            + "".join(
+                ",%s=%s" % (_escape(key, ",= "), _escape(value, ",= "))
+                for key, value in sorted(tags.items())
+            )
+            + " "
+        )
+        self._buffer = deque(maxlen=buffer_size)
+        self._file = None
+        self._socket = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.lines = 0  # added
+        self.written = 0
+        self.dropped = 0  # oldest lines replaced by newer ones, because the buffer was full
+        self.failed = 0  # lines lost, because the target could not be written
+        self.errors = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="influx", daemon=True)
+        self._thread.start()
+
+    # called from the main loop with the values of a published sample, values of None are left out
+    def add(self, timestamp, values):
+        fields = ",".join(
+            "%s=%r" % (name, float(value))
+            for name, value in zip(FIELDS, values)
+            if value is not None and math.isfinite(value)
+        )
+        if not fields:
+            return
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append("%s%s %i" % (self._prefix, fields, int(timestamp * 1e9)))
+        self.lines += 1
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    # writes all buffered lines in batches, called by the thread and at exit
+    def flush(self):
+        with self._lock:
+            while self._buffer:
+                batch = []
+                while self._buffer and len(batch) < self.batch_size:
+                    batch.append(self._buffer.popleft())
+                try:
+                    self._write(batch)
+                    self.written += len(batch)
+                except OSError as err:
+                    self.failed += len(batch)
+                    self.errors += 1
+                    self._close()
+                    # logged once per flush, the next flush connects again
+                    logging.warning(
+                        "Influx: Writing %i lines to %s failed: %s"
+                        % (len(batch), self.target, repr(err))
+                    )
+                    return
+
+    def _write(self, batch):
+        target = self.target
+        if target.startswith("udp://") or target.startswith("unixgram://"):
+            if self._socket is None:
+                self._socket = self._connect()
+            # whole lines per datagram
+            datagram = []
+            size = 0
+            for line in batch:
+                line = line.encode() + b"\n"
+                if datagram and size + len(line) > MAX_DATAGRAM:
+                    self._socket.send(b"".join(datagram))
+                    datagram = []
+                    size = 0
+                datagram.append(line)
+                size += len(line)
+            if datagram:
+                self._socket.send(b"".join(datagram))
+        elif target.startswith("unix://"):
+            if self._socket is None:
+                self._socket = self._connect()
+            self._socket.sendall(("\n".join(batch) + "\n").encode())
+        else:
+            if self._file is None:
+                if target.startswith("file://"):
+                    target = target[len("file://"):]
+                self._file = open(target, "a")
+            self._file.write("\n".join(batch) + "\n")
+            self._file.flush()
+
+    def _connect(self):
+        target = self.target
+        if target.startswith("udp://"):
+            host, _, port = target[len("udp://"):].rpartition(":")
+            family, socktype, proto, _, address = socket.getaddrinfo(
+                host.strip("[]"), int(port), type=socket.SOCK_DGRAM
+            )[0]
+            sock = socket.socket(family, socktype, proto)
+        elif target.startswith("unixgram://"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            address = target[len("unixgram://"):]
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = target[len("unix://"):]
+        # a target that hangs must not block the flush forever
+        sock.settimeout(5)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _close(self):
+        for resource in (self._socket, self._file):
+            if resource is not None:
+                try:
+                    resource.close()
+                except OSError:
+                    pass
+        self._socket = None
+        self._file = None
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def stats(self):
+        return {
+            "target": self.target,
+            "buffered": len(self._buffer),
+            "lines": self.lines,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "errors": self.errors,
+        }
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# Splits the latency of the received values into the transport delay (Shelly -> broker ->
+# driver) and the processing delay of the driver (received -> published on D-Bus).
+#
+# The Shelly sends its own time with every notification ("ts" of NotifyStatus in the events
+# mode). The clocks of the Shelly and the GX device are not synchronized exactly, so the
+# difference "received - ts" is the clock offset plus the transport delay. The minimum of this
+# difference over a sliding window is used as clock offset: it is the message with the least
+# delay, so the transport delay of every message is the time it needed more than the fastest
+# one. The window is short enough to follow a drift of the clocks.
+
+from array import array
+from collections import deque
+from time import monotonic
+
+
+# minimum of the values of the last seconds, in constant time per value
+class WindowMinimum:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        # (time, value) with increasing values, the first one is the minimum
+        self._values = deque()
+
+    def add(self, now, value):
+        values = self._values
+        while values and values[-1][1] >= value:
+            values.pop()
+        values.append((now, value))
+        while values[0][0] < now - self.seconds:
+            values.popleft()
+        return values[0][1]
+
+
+class DelayStats:
+    # values are kept until the next report, at most this many
+    MAX_VALUES = 10000
+
+    def __init__(self):
+        self._values = array("d")
+        self.count = 0
+        self.last = None
+
+    def add(self, seconds):
+        self.count += 1
+        self.last = seconds
+        if len(self._values) < self.MAX_VALUES:
+            self._values.append(seconds)
+
+    # median, 95th percentile and maximum in ms since the last reset
+    def summary(self, reset=False):
+        values = self._values
+        if reset:
+            self._values = array("d")
+        if not values:
+            return None
+        values = sorted(values)
+        return {
+            "samples": len(values),
+            "median_ms": round(values[len(values) // 2] * 1000, 1),
+            "p95_ms": round(values[min(int(len(values) * 0.95), len(values) - 1)] * 1000, 1),
+            "max_ms": round(values[-1] * 1000, 1),
+        }
+
+
+class LatencyMonitor:
+    def __init__(self, window):
+        self._minimum = WindowMinimum(window)
+        # seconds the clock of the GX device is ahead of the Shelly, including the least
+        # transport delay of the window
+        self.offset = None
+        self.transport = DelayStats()
+        self.processing = DelayStats()
+
+    # device_time: "ts" of the Shelly, received: time() when the message was received
+    def device_time(self, device_time, received):
+        difference = received - device_time
+        self.offset = self._minimum.add(monotonic(), difference)
+        self.transport.add(difference - self.offset)
+
+    # seconds from receiving a message until its values were published
+    def processed(self, seconds):
+        self.processing.add(seconds)
+
+    def summary(self, reset=False):
+        return {
+            "clock_offset_ms": round(self.offset * 1000, 1) if self.offset is not None else None,
+            "transport": self.transport.summary(reset),
+            "processing": self.processing.summary(reset),
+        }
+
+    # one line for the log, resets the values
+    def report(self):
+        summary = self.summary(reset=True)
+        parts = []
+        for name in ("transport", "processing"):
+            delays = summary[name]
+            if delays is None:
+                parts.append("%s -" % name)
+            else:
+                parts.append(
+                    "%s %.1f/%.1f/%.1f ms" % (
+                        name,
+                        delays["median_ms"],
+                        delays["p95_ms"],
+                        delays["max_ms"],
+                    )
+                )
+        offset = summary["clock_offset_ms"]
+        return "%s (median/p95/max), clock offset %s" % (
+            ", ".join(parts),
+            "%.1f ms" % offset if offset is not None else "unknown",
+        )
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+# Compares mqtt_loop = thread with mqtt_loop = glib. For each mode the driver is started on a
+# private session bus, the benchmark publishes instant payloads with act_power = sequence number
+# to the broker of the config.ini and measures the time until the value arrives as
+# PropertiesChanged signal of /Ac/Power on D-Bus. The CPU time of the driver is read from /proc.
+#
+# Needs a broker, which is reachable with the [MQTT] settings of the config.ini:
+#   dbus-run-session -- python loop_benchmark.py [config.ini] [messages per second] [seconds]
+
+import configparser
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from time import monotonic, sleep
+
+import dbus  # pyright: ignore[reportMissingImports]
+import paho.mqtt.client as mqtt
+from dbus.mainloop.glib import DBusGMainLoop  # pyright: ignore[reportMissingImports]
+from gi.repository import GLib  # pyright: ignore[reportMissingImports]
+
+from brokers import client_settings, configure_client, parse_brokers
+from gateway import cpu_seconds
+
+DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+DRIVER = os.path.join(DIRECTORY, "dbus-mqtt-grid-shelly-EM50.py")
+TOPIC = "mqttgridbenchmark/status/em1:0"
+INSTANCE = 250
+
+
+def write_config(source, directory, mode):
+    config = configparser.ConfigParser()
+    config.read(source)
+    default = config["DEFAULT"]
+    default["device_instance"] = str(INSTANCE)
+    default["source"] = "mqtt"
+    default["timeout"] = "0"
+    default["dbus_compact"] = "0"
+    default["dbus_autobatch"] = "0"
+    default["low_memory"] = "0"
+    config["MQTT"]["topic_instant"] = TOPIC
+    config["MQTT"]["topic_energy"] = "mqttgridbenchmark/status/em1data:0"
+    config["MQTT"]["mode"] = "status"
+    config["MQTT"]["rpc_on_connect"] = "0"
+    config["MQTT"]["rpc_poll_interval"] = "0"
+    config["MQTT"]["mqtt_loop"] = mode
+    path = os.path.join(directory, "config_%s.ini" % mode)
+    with open(path, "w") as file:
+        config.write(file)
+    return config, path
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(config_path, config, rate, seconds):
+    mqtt_config = config["MQTT"]
+    # the first broker of the list
+    host, port = parse_brokers(mqtt_config["broker_address"], int(mqtt_config["broker_port"]))[0]
+
+    client = mqtt.Client("MqttGridBenchmark")
+    # the same TLS and login settings as the driver
+    configure_client(client, *client_settings(mqtt_config))
+    client.connect(host, port)
+    client.loop_start()
+
+    driver = subprocess.Popen([sys.executable, DRIVER, config_path])
+    bus = dbus.SessionBus()
+    service = "com.victronenergy.%s.mqtt_%s_%i" % (
+        config["DEFAULT"].get("device_type", "grid"),
+        config["DEFAULT"].get("device_type", "grid"),
+        INSTANCE,
+    )
+
+    # the driver registers on D-Bus after the first message
+    start = monotonic()
+    while not bus.name_has_owner(service):
+        if monotonic() - start > 60 or driver.poll() is not None:
+            driver.kill()
+            raise RuntimeError("The driver did not register on D-Bus")
+        client.publish(TOPIC, '{"act_power":-1,"freq":50.0,"pf":1.0}')
+        sleep(0.5)
+
+    sent = {}
+    latencies = []
+
+    def on_changed(changes):
+        value = changes.get("Value")
+        if value is not None and int(value) in sent:
+            latencies.append(monotonic() - sent.pop(int(value)))
+
+    bus.add_signal_receiver(
+        on_changed,
+        signal_name="PropertiesChanged",
+        dbus_interface="com.victronenergy.BusItem",
+        bus_name=service,
+        path="/Ac/Power",
+    )
+
+    def publish():
+        count = int(rate * seconds)
+        begin = monotonic()
+        for i in range(count):
+            delay = begin + i / rate - monotonic()
+            if delay > 0:
+                sleep(delay)
+            sent[i] = monotonic()
+            client.publish(
+                TOPIC,
+                '{"act_power":%i,"voltage":230.0,"current":1.0,"freq":50.0,"pf":1.0}' % i,
+            )
+
+    mainloop = GLib.MainLoop()
+    cpu_start = cpu_seconds(driver.pid)
+    time_start = monotonic()
+    publisher = threading.Thread(target=publish, daemon=True)
+    publisher.start()
+
+    def check():
+        if publisher.is_alive():
+            return True
+        GLib.timeout_add(1000, mainloop.quit)
+        return False
+
+    GLib.timeout_add(100, check)
+    mainloop.run()
+    cpu = cpu_seconds(driver.pid) - cpu_start
+    elapsed = monotonic() - time_start
+
+    driver.terminate()
+    driver.wait(10)
+    client.loop_stop()
+    client.disconnect()
+    return latencies, len(sent), cpu / elapsed * 100
+
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else os.path.join(DIRECTORY, "config.ini")
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 50
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    if "DBUS_SESSION_BUS_ADDRESS" not in os.environ:
+        print(
+            "Start the benchmark on a private session bus: dbus-run-session -- python "
+            + __file__
+        )
+        sys.exit(1)
+
+    DBusGMainLoop(set_as_default=True)
+    directory = tempfile.mkdtemp(prefix="dbus-mqtt-grid-benchmark-")
+
+    print("%i messages per second for %g seconds" % (rate, seconds))
+    print("mode     median ms   p95 ms   max ms   lost   CPU %")
+    for mode in ("thread", "glib"):
+        config, path = write_config(source, directory, mode)
+        latencies, lost, cpu = run(path, config, rate, seconds)
+        if not latencies:
+            print("%-7s  no values received" % mode)
+            continue
+        print(
+            "%-7s  %9.2f  %7.2f  %7.2f  %5i  %6.1f"
+            % (
+                mode,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.95) * 1000,
+                max(latencies) * 1000,
+                lost,
+                cpu,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
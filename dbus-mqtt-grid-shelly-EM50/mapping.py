@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+
+# Declarative mapping of the received JSON payloads to the measured values of the driver. The
+# mapping is read from the [MAPPING] section of the config.ini and compiled once into Python
+# functions per payload role, so a message is converted without interpreting the mapping again.
+#
+# One line per D-Bus path, with one or more alternatives separated by "|". The first alternative
+# that is available is used:
+#   /Ac/L1/Voltage = instant:/voltage | $voltage
+#
+# Alternatives:
+#   instant:/voltage        value of a JSON pointer in the "instant" or "energy" payload,
+#                           optionally scaled, e.g. "energy:/total_act_energy * 0.001"
+#   = power / voltage       derived from other measured values with + - * /. A division by zero
+#                           results in 0, a value that is not available results in none
+#   $voltage                value of a setting of the config.ini
+#   230.0                   constant
+#   none                    not available
+# A path without a fallback is required: a full payload without it is ignored as invalid.
+#
+# Usage to compare the speed of the compiled mapping with hand-written code:
+#   python mapping.py
+
+import re
+import sys
+from types import FunctionType
+
+# D-Bus path -> name of the measured value. The driver keeps the values in the module level
+# variables "grid_<name>" and publishes each of them on all related paths.
+TARGETS = {
+    "/Ac/Power": "power",
+    "/Ac/L1/Current": "current",
+    "/Ac/L1/Voltage": "voltage",
+    "/Ac/L1/Frequency": "frequency",
+    "/Ac/L1/PowerFactor": "pf",
+    "/Ac/Energy/Forward": "forward",
+    "/Ac/Energy/Reverse": "reverse",
+    "/Ac/ApparentPower": "apparent",
+}
+
+ROLES = ("instant", "energy")
+
+# mapping of a Shelly Pro EM / EM Gen3 (EM1 and EM1Data components)
+DEFAULT_MAPPING = {
+    "/Ac/Power": "instant:/act_power",
+    "/Ac/L1/Voltage": "instant:/voltage | $voltage",
+    "/Ac/L1/Current": "instant:/current | = power / voltage",
+    "/Ac/L1/Frequency": "instant:/freq | none",
+    "/Ac/L1/PowerFactor": "instant:/pf | none",
+    "/Ac/Energy/Forward": "energy:/total_act_energy",
+    "/Ac/Energy/Reverse": "energy:/total_act_ret_energy | none",
+    "/Ac/ApparentPower": "instant:/aprt_power | none",
+}
+
+_MISSING = object()
+
+
+class CompiledMapping:
+    __slots__ = ("full", "partial", "code")
+
+    def __init__(self, full, partial, code):
+        # role -> function(jsonpayload) that stores the values of a complete payload. Returns
+        # False and changes nothing, if a required value is missing.
+        self.full = full
+        # role -> function(jsonpayload) that stores only the values included in a payload with
+        # changes (NotifyStatus). Returns True, if a required value was included.
+        self.partial = partial
+        # generated source code, for debugging
+        self.code = code
+
+
+def _pointer(jsonpayload, keys):
+    # resolves a JSON pointer with more than one level, returns _MISSING if it does not exist
+    value = jsonpayload
+    for key in keys:
+        if isinstance(value, list):
+            try:
+                value = value[int(key)]
+            except (ValueError, IndexError):
+                return _MISSING
+        elif isinstance(value, dict) and key in value:
+            value = value[key]
+        else:
+            return _MISSING
+    return value
+
+
+def _parse_pointer(pointer):
+    # RFC 6901: "/a/b~1c" -> ("a", "b/c")
+    if not pointer.startswith("/"):
+        raise ValueError('The JSON pointer "%s" has to start with "/"' % pointer)
+    return tuple(
+        key.replace("~1", "/").replace("~0", "~") for key in pointer[1:].split("/")
+    )
+
+
+# names, numbers and operators of a derived expression. Checked with a regular expression instead
+# of the ast module, which needs more than 1 MB of memory
+_TOKEN = re.compile(
+    r"\s*(?:([A-Za-z_]\w*)|((?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|([-+*/()]))\s*"
+)
+
+
+def _parse_derived(expression, names):
+    expression = expression.strip()
+    used = set()
+    position = 0
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if match is None:
+            raise ValueError(
+                'The expression "%s" may only use measured values, numbers and + - * /'
+                % expression
+            )
+        name = match.group(1)
+        if name is not None:
+            if name not in names:
+                raise ValueError(
+                    '"%s" in "%s" is not a measured value, use one of: %s'
+                    % (name, expression, ", ".join(names))
+                )
+            used.add(name)
+        position = match.end()
+    try:
+        compile(expression, "<mapping>", "eval")
+    except SyntaxError:
+        raise ValueError('The expression "%s" is not valid' % expression) from None
+    return expression, sorted(used)
+
+
+# parses one line of the mapping into a list of alternatives:
+# ("source", role, keys, scale), ("derived", expression, names), ("constant", value)
+def _parse_line(path, text, constants):
+    alternatives = []
+    for alternative in text.split("|"):
+        alternative = alternative.strip()
+        if alternatives and alternatives[-1][0] != "source":
+            raise ValueError(
+                'The mapping of "%s" has alternatives after a fallback, that are never used'
+                % path
+            )
+        if alternative == "":
+            raise ValueError('The mapping of "%s" has an empty alternative' % path)
+
+        if alternative.startswith("="):
+            expression, names = _parse_derived(alternative[1:], list(TARGETS.values()))
+            alternatives.append(("derived", expression, names))
+        elif alternative.lower() == "none":
+            alternatives.append(("constant", None))
+        elif alternative.startswith("$"):
+            if alternative[1:] not in constants:
+                raise ValueError(
+                    'The mapping of "%s" uses the unknown setting "%s"' % (path, alternative)
+                )
+            alternatives.append(("constant", float(constants[alternative[1:]])))
+        elif ":" in alternative:
+            role, _, pointer = alternative.partition(":")
+            role = role.strip()
+            if role not in ROLES:
+                raise ValueError(
+                    'The mapping of "%s" uses the unknown payload "%s", use one of: %s'
+                    % (path, role, ", ".join(ROLES))
+                )
+            pointer, _, scale = pointer.partition("*")
+            alternatives.append(
+                (
+                    "source",
+                    role,
+                    _parse_pointer(pointer.strip()),
+                    float(scale) if scale.strip() else None,
+                )
+            )
+        else:
+            try:
+                alternatives.append(("constant", float(alternative)))
+            except ValueError:
+                raise ValueError(
+                    'The mapping of "%s" has the invalid alternative "%s"'
+                    % (path, alternative)
+                ) from None
+
+    if alternatives[0][0] != "source":
+        raise ValueError(
+            'The mapping of "%s" has to start with a value of the payload, like "instant:/act_power"'
+            % path
+        )
+    return alternatives
+
+
+def _sort(names, lines):
+    # values derived from other values of the same payload are calculated after them
+    ordered = []
+    visiting = set()
+
+    def visit(name):
+        if name in ordered:
+            return
+        if name in visiting:
+            raise ValueError('The mapping of "%s" has a circular dependency' % name)
+        visiting.add(name)
+        for alternative in lines[name]:
+            if alternative[0] == "derived":
+                for dependency in alternative[2]:
+                    if dependency in names:
+                        visit(dependency)
+        visiting.discard(name)
+        ordered.append(name)
+
+    for name in names:
+        visit(name)
+    return ordered
+
+
+class _Writer:
+    def __init__(self):
+        self.lines = []
+        self.pointers = 0
+
+    def add(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    # returns (code before the test, test, value expression) of a JSON pointer
+    def source(self, keys, scale):
+        if len(keys) == 1:
+            key = repr(keys[0])
+            test = "%s in p" % key
+            value = "p[%s]" % key
+            before = None
+        else:
+            variable = "_p%i" % self.pointers
+            self.pointers += 1
+            before = "%s = _pointer(p, %r)" % (variable, keys)
+            test = "%s is not _MISSING" % variable
+            value = variable
+        value = "float(%s)" % value
+        if scale is not None:
+            value = "%s * %r" % (value, scale)
+        return before, test, value
+
+
+def _write_alternatives(writer, indent, target, alternatives, prefix, checked=False):
+    alternative = alternatives[0]
+    if alternative[0] == "source":
+        before, test, value = writer.source(alternative[2], alternative[3])
+        if checked and len(alternatives) == 1:
+            # a required value, that was already checked to be included
+            if before is not None:
+                writer.add(indent, before)
+            writer.add(indent, "%s = %s" % (target, value))
+            return
+        if before is not None:
+            writer.add(indent, before)
+        writer.add(indent, "if %s:" % test)
+        writer.add(indent + 1, "%s = %s" % (target, value))
+        if len(alternatives) > 1:
+            writer.add(indent, "else:")
+            _write_alternatives(
+                writer, indent + 1, target, alternatives[1:], prefix, checked
+            )
+    elif alternative[0] == "constant":
+        writer.add(indent, "%s = %r" % (target, alternative[1]))
+    else:
+        # the names were checked by _parse_derived, numbers like 1e3 never match
+        expression = re.sub(
+            r"\b[A-Za-z_]\w*", lambda match: prefix + match.group(0), alternative[1]
+        )
+        writer.add(indent, "try:")
+        writer.add(indent + 1, "%s = %s" % (target, expression))
+        writer.add(indent, "except ZeroDivisionError:")
+        writer.add(indent + 1, "%s = 0.0" % target)
+        writer.add(indent, "except TypeError:")
+        writer.add(indent + 1, "%s = None" % target)
+
+
+def _write_full(writer, role, names, lines, prefix):
+    writer.add(0, "def %s_full(p):" % role)
+    writer.add(1, "global " + ", ".join(prefix + name for name in names))
+    # check the required values first, so nothing is changed by an invalid payload
+    for name in names:
+        if all(alternative[0] == "source" for alternative in lines[name]):
+            tests = []
+            for _, _, keys, scale in lines[name]:
+                if len(keys) == 1:
+                    tests.append("%r in p" % keys[0])
+                else:
+                    tests.append("_pointer(p, %r) is not _MISSING" % (keys,))
+            writer.add(1, "if not (%s):" % " or ".join(tests))
+            writer.add(2, "return False")
+    # the names are sorted, so derived values use the already updated values
+    for name in names:
+        _write_alternatives(writer, 1, prefix + name, lines[name], prefix, True)
+    writer.add(1, "return True")
+    writer.add(0, "")
+
+
+def _write_partial(writer, role, names, lines, prefix):
+    writer.add(0, "def %s_partial(p):" % role)
+    writer.add(1, "global " + ", ".join(prefix + name for name in names))
+    writer.add(1, "required = False")
+    for name in names:
+        sources = [alternative for alternative in lines[name] if alternative[0] == "source"]
+        required = len(sources) == len(lines[name])
+        for i, (_, _, keys, scale) in enumerate(sources):
+            before, test, value = writer.source(keys, scale)
+            indent = 1 + i
+            if before is not None:
+                writer.add(indent, before)
+            writer.add(indent, "if %s:" % test)
+            writer.add(indent + 1, "%s%s = %s" % (prefix, name, value))
+            if required:
+                writer.add(indent + 1, "required = True")
+            if i < len(sources) - 1:
+                writer.add(indent, "else:")
+    writer.add(1, "return required")
+    writer.add(0, "")
+
+
+# compiles a mapping {D-Bus path: line} into the functions of a CompiledMapping. The functions
+# store the values in the variables "<prefix><name>" of namespace, usually the globals() of
+# the driver. constants are the settings that can be used with "$<name>".
+def compile_mapping(mapping, namespace, prefix="grid_", constants=None):
+    targets = {path.lower(): name for path, name in TARGETS.items()}
+    constants = constants or {}
+
+    lines = {}
+    roles = {role: [] for role in ROLES}
+    for path, text in mapping.items():
+        name = targets.get(path.lower())
+        if name is None:
+            raise ValueError(
+                'The mapping has the unknown path "%s", use one of: %s'
+                % (path, ", ".join(TARGETS))
+            )
+        lines[name] = _parse_line(path, text, constants)
+        roles[lines[name][0][1]].append(name)
+
+    writer = _Writer()
+    for role in ROLES:
+        names = _sort(roles[role], lines)
+        if not names:
+            # payloads of this role are ignored
+            writer.add(0, "def %s_full(p):\n    return True\n" % role)
+            writer.add(0, "def %s_partial(p):\n    return False\n" % role)
+            continue
+        _write_full(writer, role, names, lines, prefix)
+        _write_partial(writer, role, names, lines, prefix)
+    code = "\n".join(writer.lines)
+
+    # the functions are created in the namespace of the driver, so they can write its values
+    # directly without returning them first
+    module = compile(code, "<mapping>", "exec")
+    functions = {}
+    for constant in module.co_consts:
+        if hasattr(constant, "co_name"):
+            functions[constant.co_name] = FunctionType(constant, namespace)
+    namespace.setdefault("_pointer", _pointer)
+    namespace.setdefault("_MISSING", _MISSING)
+
+    return CompiledMapping(
+        {role: functions[role + "_full"] for role in ROLES},
+        {role: functions[role + "_partial"] for role in ROLES},
+        code,
+    )
+
+
+# reads the mapping from the [MAPPING] section, missing paths use the DEFAULT_MAPPING
+def read_mapping(config):
+    mapping = dict(DEFAULT_MAPPING)
+    if config.has_section("MAPPING"):
+        configured = {
+            path.lower(): text
+            for path, text in config.items("MAPPING", raw=True)
+            if path.startswith("/")
+        }
+        mapping = {
+            path: configured.pop(path.lower(), text) for path, text in mapping.items()
+        }
+        mapping.update(configured)
+    return mapping
+
+
+if __name__ == "__main__":
+    import timeit
+
+    voltage = 230.0
+    payload = {
+        "id": 0,
+        "current": 2.054,
+        "voltage": 231.4,
+        "act_power": 468.7,
+        "aprt_power": 475.3,
+        "pf": 0.99,
+        "freq": 50.0,
+        "calibration": "factory",
+    }
+    grid_power = grid_current = grid_voltage = grid_frequency = grid_pf = grid_apparent = None
+
+    # the former hand-written conversion of the driver, with the apparent power of the mapping
+    def handwritten(jsonpayload):
+        global grid_power, grid_current, grid_voltage, grid_pf, grid_frequency, grid_apparent
+        if "act_power" in jsonpayload:
+            grid_power = float(jsonpayload["act_power"])
+            grid_voltage = (
+                float(jsonpayload["voltage"]) if "voltage" in jsonpayload else voltage
+            )
+            grid_current = (
+                float(jsonpayload["current"])
+                if "current" in jsonpayload
+                else (grid_power / grid_voltage if grid_voltage != 0 else 0)
+            )
+            grid_frequency = float(jsonpayload["freq"]) if "freq" in jsonpayload else None
+            grid_pf = float(jsonpayload["pf"]) if "pf" in jsonpayload else None
+            grid_apparent = (
+                float(jsonpayload["aprt_power"]) if "aprt_power" in jsonpayload else None
+            )
+            return True
+        return False
+
+    compiled = compile_mapping(DEFAULT_MAPPING, globals(), constants={"voltage": voltage})
+    if "-v" in sys.argv:
+        print(compiled.code)
+
+    number = 200000
+    for name, function in (
+        ("hand-written", handwritten),
+        ("compiled", compiled.full["instant"]),
+        ("compiled partial", compiled.partial["instant"]),
+    ):
+        seconds = min(timeit.repeat(lambda: function(payload), number=number, repeat=5))
+        print("%-17s %6.3f us per payload" % (name, seconds / number * 1e6))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# Memory benchmark of the driver. Loads the driver with a config.ini like the service does,
+# registers its D-Bus service and feeds instant and energy payloads through on_message and the
+# publisher, without MQTT. Reports the RSS after each step and, with tracemalloc, the memory
+# left behind per message (should be 0) and the peak of temporary memory per message.
+#
+# Runs on a private session bus, so the running driver is not disturbed. Compare a config.ini
+# with low_memory = 0 and one with low_memory = 1:
+#   dbus-run-session -- python memory_benchmark.py [config.ini] [number of messages]
+#
+# With the output "memory" the values are kept in a MemorySink instead of D-Bus, which shows
+# the cost of the processing alone and needs no D-Bus:
+#   python memory_benchmark.py [config.ini] [number of messages] memory
+
+import importlib.util
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+from types import SimpleNamespace
+
+DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+
+
+def rss():
+    # current and peak resident memory of this process in kB
+    values = {}
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                values[line[:5]] = int(line.split()[1])
+    return values.get("VmRSS", 0), values.get("VmHWM", 0)
+
+
+def report(step):
+    current, peak = rss()
+    print("%-28s RSS %6i kB   peak RSS %6i kB" % (step, current, peak))
+
+
+def messages(driver, count):
+    # the same payloads as a Shelly Pro EM sends, with changing values
+    for i in range(count):
+        if i % 10 == 0:
+            yield SimpleNamespace(
+                topic=driver.settings.topic_energy,
+                payload=b'{"id":0,"total_act_energy":%i.5,"total_act_ret_energy":%i.25}'
+                % (1000000 + i, 500000 + i),
+            )
+        yield SimpleNamespace(
+            topic=driver.settings.topic_instant,
+            payload=b'{"id":0,"current":%i.1,"voltage":230.%i,"act_power":%i.3,'
+            b'"aprt_power":%i.8,"pf":0.99,"freq":50.0,"calibration":"factory"}'
+            % (i % 20, i % 10, i % 4000, i % 4100),
+        )
+
+
+def run(driver, count):
+    publisher = driver.publisher
+    for i, msg in enumerate(messages(driver, count)):
+        driver.on_message(None, None, msg)
+        # like the main loop: the fast tier after every sample, the slow tier every few samples
+        publisher._publish("fast")
+        if i % 5 == 0:
+            publisher._publish("slow")
+
+
+def main():
+    config = sys.argv[1] if len(sys.argv) > 1 else os.path.join(DIRECTORY, "config.ini")
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    output = sys.argv[3] if len(sys.argv) > 3 else "dbus"
+
+    if output == "dbus" and "DBUS_SESSION_BUS_ADDRESS" not in os.environ:
+        print(
+            "Start the benchmark on a private session bus: dbus-run-session -- python "
+            + __file__
+        )
+        sys.exit(1)
+
+    report("Python")
+
+    # the driver reads the config.ini given as first argument while it is imported
+    sys.argv = [os.path.join(DIRECTORY, "dbus-mqtt-grid-shelly-EM50.py"), config]
+    spec = importlib.util.spec_from_file_location("driver", sys.argv[0])
+    driver = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(driver)
+    report("Driver imported")
+
+    driver.settings = driver.settings._replace(output=output)
+    if output == "dbus":
+        from dbus.mainloop.glib import DBusGMainLoop  # pyright: ignore[reportMissingImports]
+
+        DBusGMainLoop(set_as_default=True)
+    if driver.settings.low_memory:
+        driver.limit_malloc_arenas()
+    driver.publisher = driver.create_publisher()
+    report("Service registered (%s)" % output)
+
+    # warm up, so all caches and the D-Bus values are filled
+    run(driver, 1000)
+    report("After 1000 messages")
+
+    start = perf_counter()
+    run(driver, count)
+    seconds = perf_counter() - start
+    report("After %i messages" % (count + 1000))
+
+    tracemalloc.start()
+    run(driver, 100)
+    before, _ = tracemalloc.get_traced_memory()
+    if hasattr(tracemalloc, "reset_peak"):  # Python 3.9 and later
+        tracemalloc.reset_peak()
+    run(driver, count)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # every 10th message is an energy payload
+    total = count + count // 10
+    print()
+    print(
+        "Low memory profile:          %s"
+        % ("enabled" if driver.settings.low_memory else "disabled")
+    )
+    print("Output:                      %s" % output)
+    print("Time per message:            %.1f us" % (seconds / total * 1e6))
+    print("Memory left per message:     %.2f bytes" % ((after - before) / total))
+    print("Temporary memory per message: %i bytes (peak)" % (peak - before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+# Sampling profiler for the running driver. A background thread records the stacks of all other
+# threads (GLib main loop, MQTT network thread, HTTP/replay thread) every interval, so it works
+# without restarting the driver and costs almost nothing while it is not running.
+#
+# The result is written as:
+#   <name>.prof        pstats file, e.g. python -m pstats <name>.prof or snakeviz <name>.prof
+#                      The call counts are the number of samples, the times are estimated from them
+#   <name>.collapsed   one line per stack "thread;caller;...;function count", for flamegraph.pl
+#                      or https://www.speedscope.app
+
+import logging
+import marshal
+import os
+import sys
+import threading
+from time import monotonic, strftime
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # samples all threads every interval seconds for duration seconds, then writes the files
+    # <directory>/profile_<date>_<time>.prof and .collapsed
+    def start(self, duration, interval, directory):
+        if self.running:
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(duration, interval, directory),
+            name="profiler",
+            daemon=True,
+        )
+        self._thread.start()
+        return True
+
+    # ends the running profile early, the files are still written
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, duration, interval, directory):
+        own = threading.get_ident()
+        stacks = {}  # (thread name, code objects from the root to the leaf) -> samples
+        names = {}
+        names_updated = 0
+        samples = 0
+        end = monotonic() + duration
+
+        while not self._stop.wait(interval) and monotonic() < end:
+            # thread names change rarely, enumerate them only once per second
+            now = monotonic()
+            if now - names_updated > 1:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                names_updated = now
+
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                codes.reverse()
+                key = (names.get(ident, str(ident)), tuple(codes))
+                stacks[key] = stacks.get(key, 0) + 1
+            samples += 1
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, strftime("profile_%Y%m%d_%H%M%S"))
+            write_collapsed(path + ".collapsed", stacks)
+            write_pstats(path + ".prof", stacks, interval)
+            logging.warning(
+                "Profiler: Wrote %i samples of all threads to %s.prof and %s.collapsed"
+                % (samples, path, path)
+            )
+        except OSError as err:
+            logging.error("Profiler: Writing the profile failed: %s" % repr(err))
+
+
+def _function(code):
+    # the key of a function in a pstats file
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def write_collapsed(path, stacks):
+    with open(path, "w") as file:
+        for (thread, codes), count in sorted(stacks.items(), key=lambda item: -item[1]):
+            frames = [
+                "%s (%s:%i)"
+                % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+                for code in codes
+            ]
+            file.write("%s;%s %i\n" % (thread, ";".join(frames), count))
+
+
+def write_pstats(path, stacks, interval):
+    # pstats format: function -> (primitive calls, calls, own time, cumulative time, callers)
+    # with callers: function -> (primitive calls, calls, own time, cumulative time)
+    stats = {}
+    for (thread, codes), count in stacks.items():
+        seconds = count * interval
+        functions = [_function(code) for code in codes]
+        seen = set()
+        for i, function in enumerate(functions):
+            calls, own, cumulative, callers = stats.get(function, (0, 0.0, 0.0, {}))
+            leaf = i == len(functions) - 1
+            # recursive functions are counted once per stack
+            if function not in seen:
+                seen.add(function)
+                calls += count
+                cumulative += seconds
+            if leaf:
+                own += seconds
+            if i > 0:
+                caller = callers.get(functions[i - 1], (0, 0.0, 0.0))
+                callers[functions[i - 1]] = (
+                    caller[0] + count,
+                    caller[1] + (seconds if leaf else 0.0),
+                    caller[2] + seconds,
+                )
+            stats[function] = (calls, own, cumulative, callers)
+
+    with open(path, "wb") as file:
+        marshal.dump(
+            {
+                function: (
+                    calls,
+                    calls,
+                    own,
+                    cumulative,
+                    {
+                        caller: (count, count, caller_own, caller_cumulative)
+                        for caller, (count, caller_own, caller_cumulative) in callers.items()
+                    },
+                )
+                for function, (calls, own, cumulative, callers) in stats.items()
+            },
+            file,
+        )
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# Records every measurement snapshot as fixed size binary record in a ring file. The file is
+# memory mapped and never grows: when it is full, the oldest records are overwritten.
+# Records are collected in memory and written together every flush interval, so the flash
+# of the GX device is only written a few times per minute.
+#
+# Usage to read a ring file on any machine with Python:
+#   python recorder.py /data/dbus-mqtt-grid-shelly-EM50_samples.bin [number of records]
+
+import collections
+import math
+import mmap
+import os
+import struct
+import sys
+
+# magic, version, record size, capacity, index of the next record to write, number of records
+HEADER = struct.Struct("<8sIIIII")
+HEADER_SIZE = 64
+MAGIC = b"EM50RING"
+VERSION = 1
+
+# timestamp, power, current, voltage, frequency, power factor, energy forward, energy reverse
+# values that are not available are stored as NaN
+RECORD = struct.Struct("<d5f2d")
+FIELDS = (
+    "timestamp",
+    "power",
+    "current",
+    "voltage",
+    "frequency",
+    "pf",
+    "forward",
+    "reverse",
+)
+
+NAN = float("nan")
+
+
+class SampleRecorder:
+    def __init__(self, path, size_kb=1024):
+        self.path = path
+        self.capacity = (size_kb * 1024 - HEADER_SIZE) // RECORD.size
+        if self.capacity < 1:
+            raise ValueError("The recorder size of %i kB is too small" % size_kb)
+        size = HEADER_SIZE + self.capacity * RECORD.size
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size != size:
+            os.ftruncate(self._fd, size)
+        self._mmap = mmap.mmap(self._fd, size)
+
+        # continue an existing ring, if it was written with the same layout
+        magic, version, record_size, capacity, self.head, self.count = HEADER.unpack_from(
+            self._mmap, 0
+        )
+        if (
+            magic != MAGIC
+            or version != VERSION
+            or record_size != RECORD.size
+            or capacity != self.capacity
+            or self.head >= capacity
+            or self.count > capacity
+        ):
+            self.head = 0
+            self.count = 0
+            self._write_header()
+
+        # appended from the MQTT thread, written from the main loop. deque append and popleft
+        # are thread safe, and more than one ring of pending records is never needed
+        self._pending = collections.deque(maxlen=self.capacity)
+        self.dropped = 0
+
+    def _write_header(self):
+        HEADER.pack_into(
+            self._mmap,
+            0,
+            MAGIC,
+            VERSION,
+            RECORD.size,
+            self.capacity,
+            self.head,
+            self.count,
+        )
+
+    def append(self, timestamp, power, current, voltage, frequency, pf, forward, reverse):
+        if len(self._pending) == self.capacity:
+            self.dropped += 1
+        self._pending.append(
+            RECORD.pack(
+                timestamp,
+                NAN if power is None else power,
+                NAN if current is None else current,
+                NAN if voltage is None else voltage,
+                NAN if frequency is None else frequency,
+                NAN if pf is None else pf,
+                NAN if forward is None else forward,
+                NAN if reverse is None else reverse,
+            )
+        )
+
+    # writes all pending records and syncs the file
+    def flush(self):
+        if not self._pending:
+            return 0
+
+        written = 0
+        while self._pending:
+            # write as many records as fit until the end of the ring in one slice
+            chunk = []
+            while self._pending and self.head + len(chunk) < self.capacity:
+                chunk.append(self._pending.popleft())
+            offset = HEADER_SIZE + self.head * RECORD.size
+            data = b"".join(chunk)
+            self._mmap[offset : offset + len(data)] = data
+            self.head = (self.head + len(chunk)) % self.capacity
+            self.count = min(self.count + len(chunk), self.capacity)
+            written += len(chunk)
+
+        self._write_header()
+        self._mmap.flush()
+        return written
+
+    def close(self):
+        self.flush()
+        self._mmap.close()
+        os.close(self._fd)
+
+
+def _read(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    magic, version, record_size, capacity, head, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError("%s is not a sample ring file of this driver" % path)
+    # the oldest record is at head, once the ring is full
+    start = head if count == capacity else 0
+    first = data[HEADER_SIZE + start * record_size : HEADER_SIZE + count * record_size]
+    second = data[HEADER_SIZE : HEADER_SIZE + start * record_size]
+    return first + second, count
+
+
+# returns the records oldest first as tuples, see FIELDS. Missing values are NaN.
+def read_records(path):
+    data, count = _read(path)
+    return list(RECORD.iter_unpack(data[: count * RECORD.size]))
+
+
+# returns the records oldest first as NumPy structured array with the columns of FIELDS
+def load(path):
+    import numpy  # only needed for the analysis, not on the GX device
+
+    data, count = _read(path)
+    dtype = numpy.dtype(
+        [
+            ("timestamp", "<f8"),
+            ("power", "<f4"),
+            ("current", "<f4"),
+            ("voltage", "<f4"),
+            ("frequency", "<f4"),
+            ("pf", "<f4"),
+            ("forward", "<f8"),
+            ("reverse", "<f8"),
+        ]
+    )
+    return numpy.frombuffer(data, dtype=dtype, count=count)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: %s <ring file> [number of records]" % sys.argv[0])
+        sys.exit(1)
+
+    records = read_records(sys.argv[1])
+    if len(sys.argv) > 2:
+        records = records[-int(sys.argv[2]) :]
+    print(",".join(FIELDS))
+    for record in records:
+        print(",".join("" if math.isnan(value) else repr(value) for value in record))
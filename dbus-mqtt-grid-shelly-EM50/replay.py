@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# Capture and replay of the raw MQTT messages received by the driver, to reproduce field issues
+# offline with the exact message sequence of a site.
+#
+# A capture file has one JSON object per line:
+#   {"ts": 1720000000.123, "topic": "shellyproem50-xxx/status/em1:0", "payload": "{\"id\":0,...}"}
+# Payloads that are not valid UTF-8 are stored base64 encoded as "payload_b64" instead.
+
+import base64
+import json
+from time import monotonic, sleep, time
+
+
+class PayloadCapture:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self.messages = 0
+
+    def write(self, topic, payload):
+        record = {"ts": round(time(), 3), "topic": topic}
+        try:
+            record["payload"] = payload.decode("utf-8")
+        except UnicodeDecodeError:
+            record["payload_b64"] = base64.b64encode(payload).decode("ascii")
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.messages += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    # yields (timestamp, topic, payload as bytes) of a capture file
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if line == "":
+                continue
+            record = json.loads(line)
+            if "payload_b64" in record:
+                payload = base64.b64decode(record["payload_b64"])
+            else:
+                payload = record.get("payload", "").encode("utf-8")
+            yield record["ts"], record["topic"], payload
+
+
+# Calls deliver(topic, payload) for every message of the capture file, keeping the original
+# time between the messages divided by speed. With speed 0 the messages are delivered as
+# fast as possible. Returns the number of delivered messages.
+def replay(path, deliver, speed=1.0):
+    start = None
+    first_ts = None
+    count = 0
+    for ts, topic, payload in read_capture(path):
+        if speed > 0:
+            if start is None:
+                start = monotonic()
+                first_ts = ts
+            delay = (ts - first_ts) / speed - (monotonic() - start)
+            if delay > 0:
+                sleep(delay)
+        deliver(topic, payload)
+        count += 1
+    return count
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# Republishes the normalized values of the driver as one compact, retained MQTT message, so
+# Home Assistant, Node-RED and others can subscribe to one cheap feed instead of decoding the
+# topics of the Shelly themselves:
+#   {"ts":1720000000.1,"power":468.7,"current":2.05,"voltage":231.4,"frequency":50.0,"pf":0.99,
+#    "forward":123456.5,"reverse":2345.25,"age":0.4,"stale":false}
+#
+# The driver calls tick() every interval seconds. A message is only sent, if a value changed by
+# more than its deadband, the staleness changed or max_interval seconds passed since the last one.
+
+import json
+from time import monotonic, time
+
+NAMES = ("power", "current", "voltage", "frequency", "pf", "forward", "reverse")
+
+
+# "power:5, voltage:1" -> {"power": 5.0, "voltage": 1.0}
+def parse_deadbands(text):
+    deadbands = {}
+    for entry in text.split(","):
+        if entry.strip() == "":
+            continue
+        name, _, value = entry.partition(":")
+        name = name.strip()
+        if name not in NAMES:
+            raise ValueError(
+                'The deadband "%s" is not a measured value, use one of: %s'
+                % (entry.strip(), ", ".join(NAMES))
+            )
+        deadbands[name] = float(value)
+    return deadbands
+
+
+class SnapshotRepublisher:
+    def __init__(self, client, topic, qos=0, retain=True, deadbands=None, max_interval=60):
+        self.client = client
+        self.topic = topic
+        self.qos = qos
+        self.retain = retain
+        self.set_deadbands(deadbands)
+        self.max_interval = max_interval
+        self._last = None  # values of the last sent message
+        self._last_stale = None
+        self._last_time = None
+        self.messages = 0
+        self.skipped = 0  # ticks without a message, since nothing changed enough
+
+    # {name: deadband}, also called when the config.ini was reloaded
+    def set_deadbands(self, deadbands):
+        self.deadbands = deadbands
+        # (name, deadband) of all values, 0 = every change is sent
+        self._deadbands = tuple((name, (deadbands or {}).get(name, 0.0)) for name in NAMES)
+
+    def _changed(self, values):
+        last = self._last
+        if last is None:
+            return True
+        for (name, deadband), value, old in zip(self._deadbands, values, last):
+            if value is None or old is None:
+                if value is not old:
+                    return True
+            elif abs(value - old) > deadband:
+                return True
+        return False
+
+    # values in the order of NAMES, age: seconds since the last received sample
+    def tick(self, values, age, stale):
+        now = monotonic()
+        if (
+            not self._changed(values)
+            and stale == self._last_stale
+            and now - self._last_time < self.max_interval
+        ):
+            self.skipped += 1
+            return False
+
+        message = {"ts": round(time(), 3)}
+        for name, value in zip(NAMES, values):
+            message[name] = round(value, 2) if value is not None else None
+        message["age"] = round(age, 1)
+        message["stale"] = stale
+        self.client.publish(
+            self.topic,
+            json.dumps(message, separators=(",", ":")),
+            qos=self.qos,
+            retain=self.retain,
+        )
+        self._last = values
+        self._last_stale = stale
+        self._last_time = now
+        self.messages += 1
+        return True
+
+    def stats(self):
+        return {"topic": self.topic, "messages": self.messages, "skipped": self.skipped}
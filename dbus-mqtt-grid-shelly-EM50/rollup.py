@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+# Incremental statistics of the received samples in three resolutions: 1 second, 1 minute and
+# 15 minutes. Every sample only updates the open bucket of the 1 second resolution. When a
+# bucket is closed, it is stored in the ring of its resolution and added to the open bucket of
+# the next resolution, so no history is ever scanned again.
+#
+# Each closed bucket holds: start timestamp, average, minimum and maximum power, and the
+# forward and reverse energy since the end of the previous bucket. The memory is allocated once
+# at start, see RollupEngine.memory_bytes().
+#
+# Usage to show the statistics of a ring file written by recorder.py, recomputed offline:
+#   python rollup.py /data/dbus-mqtt-grid-shelly-EM50_samples.bin [1s|1m|15m] [number of buckets]
+# or the buckets of the running driver, from a state dump written on SIGUSR2:
+#   python rollup.py /data/log/dbus-mqtt-grid-shelly-EM50/state_<device_instance>_<time>.json [1s|1m|15m] [number]
+
+import math
+import sys
+from array import array
+
+# name, seconds per bucket, number of buckets kept
+RESOLUTIONS = (
+    ("1s", 1, 300),  # 5 minutes
+    ("1m", 60, 1440),  # 24 hours
+    ("15m", 900, 672),  # 7 days
+)
+
+COLUMNS = ("start", "avg", "min", "max", "forward", "reverse")
+
+
+class Rollup:
+    __slots__ = (
+        "name",
+        "seconds",
+        "size",
+        "parent",
+        "_rings",
+        "head",
+        "count",
+        "_start",
+        "_sum",
+        "_samples",
+        "_min",
+        "_max",
+        "_forward",
+        "_reverse",
+        "_last_forward",
+        "_last_reverse",
+    )
+
+    def __init__(self, name, seconds, size, parent=None):
+        self.name = name
+        self.seconds = seconds
+        self.size = size
+        self.parent = parent
+
+        # one preallocated ring per column
+        self._rings = {column: array("d", [math.nan]) * size for column in COLUMNS}
+        self.head = 0
+        self.count = 0
+
+        # open bucket
+        self._start = None
+        self._sum = 0.0
+        self._samples = 0
+        self._min = math.inf
+        self._max = -math.inf
+        self._forward = math.nan
+        self._reverse = math.nan
+
+        # energy counters at the end of the last closed bucket
+        self._last_forward = math.nan
+        self._last_reverse = math.nan
+
+    # add a bucket of the lower resolution, or a single sample with samples = 1
+    def add(self, start, power_sum, samples, power_min, power_max, forward, reverse):
+        bucket = start - start % self.seconds
+        if self._start is not None and bucket != self._start:
+            self._close()
+        if self._start is None or bucket != self._start:
+            self._start = bucket
+            self._sum = 0.0
+            self._samples = 0
+            self._min = math.inf
+            self._max = -math.inf
+
+        if samples:
+            self._sum += power_sum
+            self._samples += samples
+            if power_min < self._min:
+                self._min = power_min
+            if power_max > self._max:
+                self._max = power_max
+        if not math.isnan(forward):
+            self._forward = forward
+        if not math.isnan(reverse):
+            self._reverse = reverse
+
+    def _close(self):
+        if self._samples:
+            average = self._sum / self._samples
+            power_min = self._min
+            power_max = self._max
+        else:
+            average = power_min = power_max = math.nan
+
+        i = self.head
+        rings = self._rings
+        rings["start"][i] = self._start
+        rings["avg"][i] = average
+        rings["min"][i] = power_min
+        rings["max"][i] = power_max
+        # the first bucket has no start value for the energy
+        rings["forward"][i] = self._forward - self._last_forward
+        rings["reverse"][i] = self._reverse - self._last_reverse
+        self.head = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self._last_forward = self._forward
+        self._last_reverse = self._reverse
+
+        if self.parent is not None:
+            self.parent.add(
+                self._start,
+                self._sum,
+                self._samples,
+                self._min,
+                self._max,
+                self._forward,
+                self._reverse,
+            )
+
+    # the last closed bucket as dict with the keys of COLUMNS, None if there is none yet
+    def last(self):
+        if self.count == 0:
+            return None
+        i = (self.head - 1) % self.size
+        return {column: self._rings[column][i] for column in COLUMNS}
+
+    # one column of the last closed bucket, NaN if there is none yet
+    def last_value(self, column):
+        if self.count == 0:
+            return math.nan
+        return self._rings[column][(self.head - 1) % self.size]
+
+    # the last n closed buckets, oldest first, as tuples with the values of COLUMNS
+    def latest(self, n=None):
+        n = self.count if n is None else min(n, self.count)
+        rows = []
+        for k in range(n, 0, -1):
+            i = (self.head - k) % self.size
+            rows.append(tuple(self._rings[column][i] for column in COLUMNS))
+        return rows
+
+
+class RollupEngine:
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.rollups = {}
+        parent = None
+        # build from the coarsest resolution, each one feeds the next coarser one
+        for name, seconds, size in reversed(resolutions):
+            parent = Rollup(name, seconds, size, parent)
+            self.rollups[name] = parent
+        self._first = parent
+
+    # add one sample, values that are not available are None
+    def add(self, timestamp, power, forward, reverse):
+        self._first.add(
+            int(timestamp),
+            power if power is not None else 0.0,
+            1 if power is not None else 0,
+            power if power is not None else math.inf,
+            power if power is not None else -math.inf,
+            forward if forward is not None else math.nan,
+            reverse if reverse is not None else math.nan,
+        )
+
+    def last(self, name):
+        return self.rollups[name].last()
+
+    def last_value(self, name, column):
+        return self.rollups[name].last_value(column)
+
+    # all closed buckets per resolution, oldest first, for the state dump. NaN is None in JSON
+    def state(self):
+        return {
+            name: [
+                [None if math.isnan(value) else round(value, 3) for value in row]
+                for row in rollup.latest()
+            ]
+            for name, rollup in self.rollups.items()
+        }
+
+    def memory_bytes(self):
+        return sum(
+            rollup.size * len(COLUMNS) * array("d").itemsize
+            for rollup in self.rollups.values()
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(
+            "Usage: %s <ring file of recorder.py or state_<device_instance>_<time>.json> [1s|1m|15m] [number of buckets]"
+            % sys.argv[0]
+        )
+        sys.exit(1)
+
+    name = sys.argv[2] if len(sys.argv) > 2 else "1m"
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    if sys.argv[1].endswith(".json"):
+        import json
+
+        with open(sys.argv[1]) as file:
+            history = json.load(file).get("history")
+        if history is None:
+            print("The state dump has no history, enable history in the config.ini")
+            sys.exit(1)
+        rows = [
+            tuple(math.nan if value is None else value for value in row)
+            for row in history[name]
+        ]
+        if count is not None:
+            rows = rows[-count:] if count else []
+    else:
+        from recorder import read_records
+
+        engine = RollupEngine()
+        for record in read_records(sys.argv[1]):
+            timestamp, power = record[0], record[1]
+            forward, reverse = record[6], record[7]
+            engine.add(timestamp, None if math.isnan(power) else power, forward, reverse)
+        rows = engine.rollups[name].latest(count)
+
+    print(",".join(COLUMNS))
+    for row in rows:
+        print(",".join("" if math.isnan(value) else "%.2f" % value for value in row))
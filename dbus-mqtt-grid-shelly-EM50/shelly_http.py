@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Reads the EM1 status of a Shelly directly over its local HTTP RPC API, for setups without a
+# MQTT broker. One TCP connection is kept open for all polls (HTTP/1.1 keep-alive) and the
+# instant and energy requests can be sent back to back without waiting for the first answer
+# (HTTP pipelining), which saves one round trip per poll.
+
+import http.client
+import json
+import socket
+
+
+class _KeepOpenFile:
+    # http.client closes the file of a response when the body is read, but with keep-alive and
+    # pipelining the next response is read from the same buffered file
+    def __init__(self, fp):
+        self._fp = fp
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+    def close(self):
+        pass
+
+
+class _SharedSocket:
+    # http.client.HTTPResponse only needs makefile() from the socket it reads from
+    def __init__(self, fp):
+        self._fp = fp
+
+    def makefile(self, mode, *args, **kwargs):
+        return _KeepOpenFile(self._fp)
+
+
+class ShellyHttpPoller:
+    def __init__(self, host, port=80, channel=0, timeout=2.0, pipelining=True):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.pipelining = pipelining
+        self.paths = (
+            "/rpc/EM1.GetStatus?id=%i" % channel,
+            "/rpc/EM1Data.GetStatus?id=%i" % channel,
+        )
+        self._requests = [
+            (
+                "GET %s HTTP/1.1\r\nHost: %s\r\nConnection: keep-alive\r\n\r\n"
+                % (path, host)
+            ).encode()
+            for path in self.paths
+        ]
+        self._sock = None
+        self._fp = None
+        self.connects = 0
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._fp = self._sock.makefile("rb")
+        self.connects += 1
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _read_response(self):
+        response = http.client.HTTPResponse(_SharedSocket(self._fp))
+        response.begin()
+        body = response.read()
+        if response.status != 200:
+            raise http.client.HTTPException(
+                "HTTP status %i: %s" % (response.status, body[:100])
+            )
+        return json.loads(body), body, response.will_close
+
+    # Returns [(EM1 status, raw body), (EM1Data status, raw body)]. On any error the connection is
+    # closed and the error is raised, the next poll opens a new connection.
+    def poll(self):
+        results = []
+        try:
+            if self._sock is None:
+                self._connect()
+            if self.pipelining:
+                self._sock.sendall(b"".join(self._requests))
+                for _ in self._requests:
+                    results.append(self._read_response())
+            else:
+                for request in self._requests:
+                    self._sock.sendall(request)
+                    results.append(self._read_response())
+        except Exception:
+            self.close()
+            raise
+
+        # the Shelly may end the keep-alive connection at any time
+        if any(will_close for _, _, will_close in results):
+            self.close()
+        return [(jsonpayload, body) for jsonpayload, body, _ in results]
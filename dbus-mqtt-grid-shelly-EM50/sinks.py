@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# Output backends of the driver. The DbusMqttGridService publishes its paths to a sink, which
+# is used like a VeDbusService:
+#   sink.add_path(path, value, ...)   registers a path with its initial value
+#   sink[path] = value                publishes a new value
+#   sink[path]                        the last published value, or the value computed by the
+#                                     getvaluecallback of the path
+#   sink.commit()                     ends one update, after the values of a sample were set
+#   sink.flush()                      writes buffered output, called regularly and at exit
+#
+#   DbusSink        the D-Bus service of Venus OS
+#   MemorySink      keeps the values in a dict, to measure the processing without D-Bus
+#   JsonLinesSink   writes one JSON line per update to a file or stdout, to run the driver as
+#                   collector on Linux hosts without Venus OS
+
+import json
+import os
+import sys
+from time import time
+
+
+class DbusSink:
+    # private: an own connection to the bus, needed for several services in one process, which
+    # would otherwise all register their root object on the shared connection
+    def __init__(
+        self, servicename, autobatch=False, itemsignals=True, compact=False, private=False
+    ):
+        # imported here, so the other sinks also work without the dbus module
+        from vedbus import VeDbusService
+
+        bus = None
+        if private:
+            import dbus  # pyright: ignore[reportMissingImports]
+
+            if "DBUS_SESSION_BUS_ADDRESS" in os.environ:
+                bus = dbus.SessionBus(private=True)
+            else:
+                bus = dbus.SystemBus(private=True)
+        self.service = VeDbusService(
+            servicename,
+            bus=bus,
+            autobatch=autobatch,
+            itemsignals=itemsignals,
+            compact=compact,
+        )
+
+    def add_path(
+        self,
+        path,
+        value,
+        writeable=False,
+        onchangecallback=None,
+        gettextcallback=None,
+        getvaluecallback=None,
+    ):
+        self.service.add_path(
+            path,
+            value,
+            writeable=writeable,
+            onchangecallback=onchangecallback,
+            gettextcallback=gettextcallback,
+            getvaluecallback=getvaluecallback,
+        )
+
+    def __getitem__(self, path):
+        return self.service[path]
+
+    def __setitem__(self, path, value):
+        self.service[path] = value
+
+    # the VeDbusService sends every change itself, batched with autobatch
+    def commit(self):
+        pass
+
+    def flush(self):
+        pass
+
+
+class MemorySink:
+    def __init__(self):
+        self.values = {}
+        self.callbacks = {}  # path -> getvaluecallback
+        self.changes = 0
+        self.commits = 0
+
+    def add_path(
+        self,
+        path,
+        value,
+        writeable=False,
+        onchangecallback=None,
+        gettextcallback=None,
+        getvaluecallback=None,
+    ):
+        self.values[path] = value
+        if getvaluecallback is not None:
+            self.callbacks[path] = getvaluecallback
+
+    def __getitem__(self, path):
+        if path in self.callbacks:
+            return self.callbacks[path](path)
+        return self.values[path]
+
+    def __setitem__(self, path, value):
+        self.values[path] = value
+        self.changes += 1
+
+    def commit(self):
+        self.commits += 1
+
+    def flush(self):
+        pass
+
+
+class JsonLinesSink:
+    # lines are written, when this many are buffered or flush() is called
+    BUFFER_LINES = 100
+
+    # path "-" writes to stdout
+    def __init__(self, path):
+        self.path = path
+        self._file = sys.stdout if path == "-" else open(path, "a", encoding="utf-8")
+        self.values = {}
+        self.callbacks = {}  # path -> getvaluecallback
+        self.lines = 0
+        # changes of the current update, the first line includes all paths
+        self._changes = {}
+        self._buffer = []
+
+    def add_path(
+        self,
+        path,
+        value,
+        writeable=False,
+        onchangecallback=None,
+        gettextcallback=None,
+        getvaluecallback=None,
+    ):
+        self.values[path] = value
+        self._changes[path] = value
+        if getvaluecallback is not None:
+            self.callbacks[path] = getvaluecallback
+
+    def __getitem__(self, path):
+        if path in self.callbacks:
+            return self.callbacks[path](path)
+        return self.values[path]
+
+    def __setitem__(self, path, value):
+        self.values[path] = value
+        self._changes[path] = value
+
+    # one line {"ts": ..., "values": {path: value}} with the paths changed since the last line
+    def commit(self):
+        if not self._changes:
+            return
+        self._buffer.append(
+            json.dumps(
+                {"ts": round(time(), 3), "values": self._changes}, separators=(",", ":")
+            )
+        )
+        self._changes = {}
+        self.lines += 1
+        if len(self._buffer) >= self.BUFFER_LINES:
+            self.flush()
+
+    def flush(self):
+        self.commit()
+        if self._buffer:
+            self._file.write("\n".join(self._buffer) + "\n")
+            self._buffer = []
+        self._file.flush()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+# Compares the latency of source = mqtt with source = http. A simulated Shelly changes its
+# act_power to the next sequence number at a fixed rate. For mqtt it publishes every change to
+# the broker of the config.ini, like the status push of the Shelly. For http it answers the
+# EM1.GetStatus and EM1Data.GetStatus requests of the driver with the current values, from a
+# local HTTP server with keep-alive. For each source the driver is started on a private session
+# bus, and the benchmark measures the time from the change of a value until it arrives as
+# PropertiesChanged signal of /Ac/Power on D-Bus. Values that were replaced before the driver
+# polled them are counted as skipped. The CPU time of the driver is read from /proc.
+#
+# Needs a broker, which is reachable with the [MQTT] settings of the config.ini:
+#   dbus-run-session -- python source_benchmark.py [config.ini] [changes per second] [seconds]
+#       [HTTP poll interval in seconds, default: 1 / changes per second]
+
+import configparser
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+
+import dbus  # pyright: ignore[reportMissingImports]
+import paho.mqtt.client as mqtt
+from dbus.mainloop.glib import DBusGMainLoop  # pyright: ignore[reportMissingImports]
+from gi.repository import GLib  # pyright: ignore[reportMissingImports]
+
+from brokers import client_settings, configure_client, parse_brokers
+from gateway import cpu_seconds
+from loop_benchmark import percentile
+
+DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+DRIVER = os.path.join(DIRECTORY, "dbus-mqtt-grid-shelly-EM50.py")
+TOPIC = "mqttgridbenchmark/status/em1:0"
+INSTANCE = 251
+
+
+class SimulatedShelly:
+    def __init__(self):
+        self.power = -1
+        self.requests = 0
+
+    def instant(self):
+        return {
+            "id": 0,
+            "current": 1.0,
+            "voltage": 230.0,
+            "act_power": self.power,
+            "aprt_power": abs(self.power),
+            "pf": 1.0,
+            "freq": 50.0,
+            "calibration": "factory",
+        }
+
+    def energy(self):
+        return {"id": 0, "total_act_energy": 1000.0, "total_act_ret_energy": 10.0}
+
+
+def start_http_server(shelly):
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive, like the web server of the Shelly. Headers and body are written
+        # separately, without TCP_NODELAY the body would wait for the delayed ACK
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            shelly.requests += 1
+            if self.path.startswith("/rpc/EM1.GetStatus"):
+                body = json.dumps(shelly.instant()).encode()
+            elif self.path.startswith("/rpc/EM1Data.GetStatus"):
+                body = json.dumps(shelly.energy()).encode()
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+
+        # the driver closes its connection when it is stopped
+        def handle_error(self, request, client_address):
+            if not isinstance(sys.exc_info()[1], ConnectionError):
+                super().handle_error(request, client_address)
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_config(source, directory, name, http_port, http_interval):
+    config = configparser.ConfigParser()
+    config.read(source)
+    default = config["DEFAULT"]
+    default["device_instance"] = str(INSTANCE)
+    default["source"] = "http" if name.startswith("http") else "mqtt"
+    default["timeout"] = "0"
+    default["dbus_compact"] = "0"
+    default["dbus_autobatch"] = "0"
+    default["low_memory"] = "0"
+    config["MQTT"]["topic_instant"] = TOPIC
+    config["MQTT"]["topic_energy"] = "mqttgridbenchmark/status/em1data:0"
+    config["MQTT"]["mode"] = "status"
+    config["MQTT"]["rpc_on_connect"] = "0"
+    config["MQTT"]["rpc_poll_interval"] = "0"
+    if not config.has_section("HTTP"):
+        config.add_section("HTTP")
+    config["HTTP"]["host"] = "127.0.0.1"
+    config["HTTP"]["port"] = str(http_port)
+    config["HTTP"]["channel"] = "0"
+    config["HTTP"]["interval"] = str(http_interval)
+    config["HTTP"]["pipelining"] = "0" if name == "http-nopipe" else "1"
+    path = os.path.join(directory, "config_%s.ini" % name)
+    with open(path, "w") as file:
+        config.write(file)
+    return config, path
+
+
+def connect_broker(config):
+    mqtt_config = config["MQTT"]
+    # the first broker of the list
+    host, port = parse_brokers(mqtt_config["broker_address"], int(mqtt_config["broker_port"]))[0]
+
+    client = mqtt.Client("MqttGridSourceBenchmark")
+    # the same TLS and login settings as the driver
+    configure_client(client, *client_settings(mqtt_config))
+    client.connect(host, port)
+    client.loop_start()
+    return client
+
+
+def run(name, config_path, config, client, shelly, rate, seconds):
+    use_mqtt = config["DEFAULT"]["source"] == "mqtt"
+
+    def push():
+        if use_mqtt:
+            client.publish(TOPIC, json.dumps(shelly.instant()))
+
+    driver = subprocess.Popen([sys.executable, DRIVER, config_path])
+    bus = dbus.SessionBus()
+    device_type = config["DEFAULT"].get("device_type", "grid")
+    service = "com.victronenergy.%s.mqtt_%s_%i" % (device_type, device_type, INSTANCE)
+
+    # the driver registers on D-Bus after the first values
+    shelly.power = -1
+    start = monotonic()
+    while not bus.name_has_owner(service):
+        if monotonic() - start > 60 or driver.poll() is not None:
+            driver.kill()
+            raise RuntimeError("The driver did not register on D-Bus")
+        push()
+        sleep(0.5)
+
+    changed = {}
+    latencies = []
+
+    def on_changed(changes):
+        value = changes.get("Value")
+        if value is not None and int(value) in changed:
+            latencies.append(monotonic() - changed.pop(int(value)))
+
+    receiver = bus.add_signal_receiver(
+        on_changed,
+        signal_name="PropertiesChanged",
+        dbus_interface="com.victronenergy.BusItem",
+        bus_name=service,
+        path="/Ac/Power",
+    )
+
+    count = int(rate * seconds)
+
+    def simulate():
+        # at a random time within each interval, so the changes are not in phase with the polls
+        rng = random.Random(1)
+        begin = monotonic()
+        for i in range(count):
+            delay = begin + (i + rng.random()) / rate - monotonic()
+            if delay > 0:
+                sleep(delay)
+            changed[i] = monotonic()
+            shelly.power = i
+            push()
+
+    mainloop = GLib.MainLoop()
+    requests_start = shelly.requests
+    cpu_start = cpu_seconds(driver.pid)
+    time_start = monotonic()
+    simulator = threading.Thread(target=simulate, daemon=True)
+    simulator.start()
+
+    def check():
+        if simulator.is_alive():
+            return True
+        GLib.timeout_add(1000, mainloop.quit)
+        return False
+
+    GLib.timeout_add(100, check)
+    mainloop.run()
+    cpu = cpu_seconds(driver.pid) - cpu_start
+    elapsed = monotonic() - time_start
+    receiver.remove()
+
+    driver.terminate()
+    driver.wait(10)
+    requests = shelly.requests - requests_start
+    return latencies, len(changed), cpu / elapsed * 100, requests / elapsed
+
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else os.path.join(DIRECTORY, "config.ini")
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    http_interval = float(sys.argv[4]) if len(sys.argv) > 4 else 1 / rate
+
+    if "DBUS_SESSION_BUS_ADDRESS" not in os.environ:
+        print(
+            "Start the benchmark on a private session bus: dbus-run-session -- python "
+            + __file__
+        )
+        sys.exit(1)
+
+    DBusGMainLoop(set_as_default=True)
+    directory = tempfile.mkdtemp(prefix="dbus-mqtt-grid-benchmark-")
+    shelly = SimulatedShelly()
+    server = start_http_server(shelly)
+    client = None
+
+    print(
+        "%g changes per second for %g seconds, HTTP poll interval %g seconds"
+        % (rate, seconds, http_interval)
+    )
+    print("source        median ms   p95 ms   max ms   skipped   CPU %   HTTP requests/s")
+    for name in ("mqtt", "http", "http-nopipe"):
+        config, path = write_config(
+            source, directory, name, server.server_address[1], http_interval
+        )
+        if name == "mqtt":
+            client = connect_broker(config)
+        latencies, skipped, cpu, requests = run(
+            name, path, config, client, shelly, rate, seconds
+        )
+        if not latencies:
+            print("%-12s  no values received" % name)
+            continue
+        print(
+            "%-12s  %9.2f  %7.2f  %7.2f  %8i  %6.1f  %16.1f"
+            % (
+                name,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.95) * 1000,
+                max(latencies) * 1000,
+                skipped,
+                cpu,
+                requests,
+            )
+        )
+
+    client.loop_stop()
+    client.disconnect()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+# Checks the parsing of the broker_address list of the config.ini.
+#   python -m unittest test_brokers
+
+import os
+import sys
+import unittest
+
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)))
+
+from brokers import Broker, parse_brokers
+
+
+class TestParseBrokers(unittest.TestCase):
+    def test_host_names_and_ipv4(self):
+        self.assertEqual(
+            parse_brokers("localhost, 192.168.1.10:1884,broker.lan", 1883),
+            (("localhost", 1883), ("192.168.1.10", 1884), ("broker.lan", 1883)),
+        )
+
+    def test_ipv6(self):
+        # without brackets the whole entry is the address, the last group is no port
+        self.assertEqual(parse_brokers("fe80::1", 1883), (("fe80::1", 1883),))
+        self.assertEqual(parse_brokers("::1", 8883), (("::1", 8883),))
+        self.assertEqual(
+            parse_brokers("[fd00::1]:1884, [fd00::2]", 1883),
+            (("fd00::1", 1884), ("fd00::2", 1883)),
+        )
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            parse_brokers(" , ", 1883)
+
+    def test_str(self):
+        self.assertEqual(str(Broker("fd00::1", 1884)), "[fd00::1]:1884")
+        self.assertEqual(str(Broker("localhost", 1883)), "localhost:1883")
+
+
+if __name__ == "__main__":
+    unittest.main()
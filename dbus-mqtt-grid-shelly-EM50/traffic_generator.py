@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+# Synthetic traffic of many Shelly meters for scaling tests. Impersonates Shelly Pro EM50 (one or
+# two em1 channels) and Pro 3EM devices, which publish their status and energy payloads to an
+# MQTT broker at a configurable rate. The load of every meter follows a random base load with
+# noise and occasional load steps, also into feed-in, and the energy counters integrate it.
+# A fraction of the messages can be sent malformed or empty, like a flaky device or network.
+#
+# The [DEVICE:<name>] sections for the gateway.py are written for all simulated meters, so the
+# same meters can be received by the driver:
+#   python traffic_generator.py --devices 20 --config-sections devices.ini
+#   cat devices.ini >> config.ini
+#   python gateway.py config.ini
+#
+# Usage:
+#   python traffic_generator.py [--broker host:port] [--devices N] [--pro3em N] [--channels 1|2]
+#       [--rate messages per second per meter] [--energy-interval seconds] [--seconds seconds]
+#       [--malformed fraction] [--empty fraction] [--seed number] [--config-sections file]
+
+import argparse
+import heapq
+import json
+import math
+import random
+import sys
+from time import monotonic, sleep
+
+PREFIX_PRO_EM = "shellyproem50-sim%06i"
+PREFIX_PRO_3EM = "shellypro3em-sim%06i"
+
+# mapping of the Pro 3EM totals to the D-Bus paths of the driver, see the [MAPPING] section
+MAPPING_PRO_3EM = {
+    "/Ac/Power": "instant:/total_act_power",
+    "/Ac/L1/Voltage": "instant:/a_voltage | $voltage",
+    "/Ac/L1/Current": "instant:/total_current | = power / voltage",
+    "/Ac/L1/Frequency": "instant:/a_freq | none",
+    "/Ac/L1/PowerFactor": "instant:/a_pf | none",
+    "/Ac/Energy/Forward": "energy:/total_act",
+    "/Ac/Energy/Reverse": "energy:/total_act_ret | none",
+    "/Ac/ApparentPower": "instant:/total_aprt_power | none",
+}
+
+
+class Load:
+    # power of one phase in W: base load, noise and random steps
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.base = rng.uniform(150, 2500)
+        self.voltage = rng.uniform(225, 235)
+        self.forward = rng.uniform(1e5, 5e6)
+        self.reverse = rng.uniform(0, 1e6)
+        self.power = self.base
+
+    def step(self, seconds):
+        rng = self.rng
+        # about one load step per minute, a third of them into feed-in (PV)
+        if rng.random() < seconds / 60:
+            self.base = rng.uniform(-3000, -200) if rng.random() < 0.33 else rng.uniform(100, 4000)
+        self.power = self.base * (1 + rng.gauss(0, 0.02))
+        self.voltage += rng.gauss(0, 0.2) + (230 - self.voltage) * 0.01
+        if self.power > 0:
+            self.forward += self.power * seconds / 3600
+        else:
+            self.reverse -= self.power * seconds / 3600
+
+    def values(self):
+        pf = 0.9 + self.rng.random() * 0.1
+        apparent = abs(self.power) / pf
+        return (
+            round(apparent / self.voltage, 3),
+            round(self.voltage, 1),
+            round(self.power, 1),
+            round(apparent, 1),
+            round(pf if self.power >= 0 else -pf, 2),
+            round(50 + self.rng.gauss(0, 0.02), 2),
+        )
+
+
+class Meter:
+    # one simulated meter: a channel of a Pro EM or a Pro 3EM
+
+    def __init__(self, rng, name, topic_instant, topic_energy, channel, phases):
+        self.name = name
+        self.topic_instant = topic_instant
+        self.topic_energy = topic_energy
+        self.channel = channel
+        self.loads = [Load(rng) for _ in range(phases)]
+        self.last_step = None
+
+    def step(self, now):
+        seconds = now - self.last_step if self.last_step is not None else 0
+        self.last_step = now
+        for load in self.loads:
+            load.step(seconds)
+
+    def instant(self):
+        if len(self.loads) == 1:
+            current, voltage, power, apparent, pf, freq = self.loads[0].values()
+            payload = {
+                "id": self.channel,
+                "current": current,
+                "voltage": voltage,
+                "act_power": power,
+                "aprt_power": apparent,
+                "pf": pf,
+                "freq": freq,
+                "calibration": "factory",
+            }
+        else:
+            payload = {"id": self.channel}
+            total_current = total_power = total_apparent = 0.0
+            for phase, load in zip("abc", self.loads):
+                current, voltage, power, apparent, pf, freq = load.values()
+                payload.update(
+                    {
+                        phase + "_current": current,
+                        phase + "_voltage": voltage,
+                        phase + "_act_power": power,
+                        phase + "_aprt_power": apparent,
+                        phase + "_pf": pf,
+                        phase + "_freq": freq,
+                    }
+                )
+                total_current += current
+                total_power += power
+                total_apparent += apparent
+            payload.update(
+                {
+                    "n_current": None,
+                    "total_current": round(total_current, 3),
+                    "total_act_power": round(total_power, 3),
+                    "total_aprt_power": round(total_apparent, 3),
+                }
+            )
+        return json.dumps(payload, separators=(",", ":")).encode()
+
+    def energy(self):
+        if len(self.loads) == 1:
+            load = self.loads[0]
+            payload = {
+                "id": self.channel,
+                "total_act_energy": round(load.forward, 2),
+                "total_act_ret_energy": round(load.reverse, 2),
+            }
+        else:
+            payload = {"id": self.channel}
+            for phase, load in zip("abc", self.loads):
+                payload[phase + "_total_act_energy"] = round(load.forward, 2)
+                payload[phase + "_total_act_ret_energy"] = round(load.reverse, 2)
+            payload["total_act"] = round(sum(load.forward for load in self.loads), 2)
+            payload["total_act_ret"] = round(sum(load.reverse for load in self.loads), 2)
+        return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def create_meters(rng, devices, pro3em, channels):
+    meters = []
+    for device in range(devices):
+        prefix = PREFIX_PRO_EM % device
+        for channel in range(channels):
+            meters.append(
+                Meter(
+                    rng,
+                    "sim%i_%i" % (device, channel),
+                    "%s/status/em1:%i" % (prefix, channel),
+                    "%s/status/em1data:%i" % (prefix, channel),
+                    channel,
+                    1,
+                )
+            )
+    for device in range(pro3em):
+        prefix = PREFIX_PRO_3EM % device
+        meters.append(
+            Meter(
+                rng, "sim3em%i" % device, prefix + "/status/em:0", prefix + "/status/emdata:0", 0, 3
+            )
+        )
+    return meters
+
+
+# [DEVICE:<name>] sections of the gateway.py for the simulated meters
+def config_sections(meters, first_instance):
+    lines = []
+    for i, meter in enumerate(meters):
+        lines.append("[DEVICE:%s]" % meter.name)
+        lines.append("device_name = Simulated %s" % meter.name)
+        lines.append("device_instance = %i" % (first_instance + i))
+        lines.append("topic_instant = %s" % meter.topic_instant)
+        lines.append("topic_energy = %s" % meter.topic_energy)
+        if len(meter.loads) > 1:
+            for path, text in MAPPING_PRO_3EM.items():
+                lines.append("%s = %s" % (path, text))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def run(args, meters, rng):
+    import paho.mqtt.client as mqtt
+
+    host, _, port = args.broker.rpartition(":")
+    if not host or not port.isdigit():
+        host, port = args.broker, "1883"
+    client = mqtt.Client("MqttGridTrafficGenerator")
+    client.connect(host, int(port))
+    client.loop_start()
+
+    # (due time, sequence, meter, is energy), the sequence keeps the order of equal times
+    interval = 1 / args.rate
+    start = monotonic()
+    queue = []
+    for i, meter in enumerate(meters):
+        # spread the meters over the interval, like devices that were started at different times
+        heapq.heappush(queue, (start + rng.random() * interval, i, meter, False))
+        heapq.heappush(queue, (start + rng.random() * args.energy_interval, i, meter, True))
+
+    counts = {"instant": 0, "energy": 0, "malformed": 0, "empty": 0}
+    end = start + args.seconds
+    next_report = start + 10
+    try:
+        while queue:
+            due, i, meter, energy = heapq.heappop(queue)
+            if due >= end:
+                break
+            delay = due - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+            if energy:
+                payload = meter.energy()
+                topic = meter.topic_energy
+                counts["energy"] += 1
+                heapq.heappush(queue, (due + args.energy_interval, i, meter, True))
+            else:
+                meter.step(due)
+                payload = meter.instant()
+                topic = meter.topic_instant
+                counts["instant"] += 1
+                heapq.heappush(queue, (due + interval, i, meter, False))
+
+            chance = rng.random()
+            if chance < args.empty:
+                payload = b""
+                counts["empty"] += 1
+            elif chance < args.empty + args.malformed:
+                payload = payload[: rng.randrange(1, len(payload))]
+                counts["malformed"] += 1
+            client.publish(topic, payload)
+
+            now = monotonic()
+            if now >= next_report:
+                next_report += 10
+                print(
+                    "%6.0f s  %8.0f messages/s  behind %.3f s"
+                    % (now - start, (counts["instant"] + counts["energy"]) / (now - start), now - due)
+                )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        seconds = monotonic() - start
+        client.loop_stop()
+        client.disconnect()
+
+    total = counts["instant"] + counts["energy"]
+    print(
+        "%i meters: %i messages in %.1f s = %.0f messages/s (%i instant, %i energy, %i malformed, %i empty)"
+        % (
+            len(meters),
+            total,
+            seconds,
+            total / seconds,
+            counts["instant"],
+            counts["energy"],
+            counts["malformed"],
+            counts["empty"],
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Publishes the payloads of simulated Shelly meters to an MQTT broker"
+    )
+    parser.add_argument("--broker", default="localhost:1883", help="host:port of the broker")
+    parser.add_argument("--devices", type=int, default=1, help="number of simulated Pro EM50")
+    parser.add_argument("--pro3em", type=int, default=0, help="number of simulated Pro 3EM")
+    parser.add_argument(
+        "--channels", type=int, choices=(1, 2), default=1, help="em1 channels per Pro EM50"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=1, help="status messages per second of every meter"
+    )
+    parser.add_argument(
+        "--energy-interval", type=float, default=60, help="seconds between the energy messages"
+    )
+    parser.add_argument("--seconds", type=float, default=math.inf, help="duration")
+    parser.add_argument(
+        "--malformed", type=float, default=0.0, help="fraction of truncated messages"
+    )
+    parser.add_argument("--empty", type=float, default=0.0, help="fraction of empty messages")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random values")
+    parser.add_argument(
+        "--config-sections",
+        metavar="FILE",
+        help='write the [DEVICE:<name>] sections of the meters to FILE ("-" = stdout) and exit',
+    )
+    parser.add_argument(
+        "--first-instance", type=int, default=100, help="device_instance of the first meter"
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    meters = create_meters(rng, args.devices, args.pro3em, args.channels)
+    if not meters:
+        parser.error("no meters to simulate")
+
+    if args.config_sections:
+        sections = config_sections(meters, args.first_instance)
+        if args.config_sections == "-":
+            sys.stdout.write(sections)
+        else:
+            with open(args.config_sections, "w") as file:
+                file.write(sections)
+        return
+
+    run(args, meters, rng)
+
+
+if __name__ == "__main__":
+    main()
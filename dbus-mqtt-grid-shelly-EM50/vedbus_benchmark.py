@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# Compares the D-Bus export of the VeDbusService with one dbus.service.Object per path and tree
+# node (dbus_compact = 0) and with the single fallback object of the compact mode
+# (dbus_compact = 1). For each mode a service with the given number of paths is registered in a
+# child process, which reports its RSS and the time of add_path. The benchmark then reads all
+# values with GetItems and single values with GetValue over the bus, and measures the time to
+# remove all paths again.
+#
+# Runs on a private session bus:
+#   dbus-run-session -- python vedbus_benchmark.py [number of paths]
+
+import os
+import signal
+import subprocess
+import sys
+from time import perf_counter, sleep
+
+DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+SERVICE = "com.victronenergy.grid.vedbus_benchmark_%s"
+
+
+def rss():
+    # resident memory of this process in kB
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def paths(count):
+    # a tree like the one of a meter with many values: /Ac/L1/..., /Ac/L2/... and deeper nodes
+    return ["/Ac/L%i/Group%i/Value%i" % (i % 3 + 1, i // 30, i) for i in range(count)]
+
+
+# the child process: registers the service and answers the calls of the benchmark
+def serve(mode, count):
+    sys.path.insert(1, os.path.join(DIRECTORY, "ext", "velib_python"))
+    from dbus.mainloop.glib import DBusGMainLoop  # pyright: ignore[reportMissingImports]
+    from gi.repository import GLib  # pyright: ignore[reportMissingImports]
+    from vedbus import VeDbusService
+
+    DBusGMainLoop(set_as_default=True)
+    before = rss()
+    service = VeDbusService(SERVICE % mode, compact=mode == "compact")
+    start = perf_counter()
+    for i, path in enumerate(paths(count)):
+        service.add_path(path, float(i), gettextcallback=lambda p, v: "%.1f W" % v)
+    seconds = perf_counter() - start
+
+    # removes all paths, called by the benchmark after the reads
+    def remove_all():
+        start = perf_counter()
+        for path in paths(count):
+            del service[path]
+        print("remove %.1f" % ((perf_counter() - start) * 1000), flush=True)
+        GLib.idle_add(mainloop.quit)
+
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, remove_all)
+    print("ready %.1f %i" % (seconds * 1000, rss() - before), flush=True)
+    mainloop = GLib.MainLoop()
+    mainloop.run()
+
+
+def measure(mode, count):
+    import dbus  # pyright: ignore[reportMissingImports]
+
+    child = subprocess.Popen(
+        [sys.executable, __file__, "--serve", mode, str(count)],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    _, add_ms, memory_kb = child.stdout.readline().split()
+
+    bus = dbus.SessionBus()
+    root = bus.get_object(SERVICE % mode, "/")
+    start = perf_counter()
+    items = root.GetItems(dbus_interface="com.victronenergy.BusItem")
+    get_items_ms = (perf_counter() - start) * 1000
+    assert len(items) == count
+
+    reads = paths(count)[:: max(1, count // 200)]
+    start = perf_counter()
+    for path in reads:
+        bus.get_object(SERVICE % mode, path).GetValue(dbus_interface="com.victronenergy.BusItem")
+    get_value_us = (perf_counter() - start) / len(reads) * 1e6
+
+    child.send_signal(signal.SIGUSR1)
+    remove_ms = child.stdout.readline().split()[1]
+    child.wait()
+    sleep(0.2)
+
+    print(
+        "%-8s add_path %8.1f ms  RSS %7i kB (%6.0f bytes per path)  GetItems %7.1f ms  "
+        "GetValue %6.0f us  remove %8.1f ms"
+        % (
+            mode,
+            float(add_ms),
+            int(memory_kb),
+            int(memory_kb) * 1024 / count,
+            get_items_ms,
+            get_value_us,
+            float(remove_ms),
+        )
+    )
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        serve(sys.argv[2], int(sys.argv[3]))
+        return
+
+    if "DBUS_SESSION_BUS_ADDRESS" not in os.environ:
+        print(
+            "Start the benchmark on a private session bus: dbus-run-session -- python "
+            + __file__
+        )
+        sys.exit(1)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print("%i paths" % count)
+    for mode in ("objects", "compact"):
+        measure(mode, count)
+
+
+if __name__ == "__main__":
+    main()